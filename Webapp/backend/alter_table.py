@@ -10,19 +10,25 @@ COLUMNS_TO_ADD: dict[str, str] = {
     "bbox_x2": "REAL",
     "bbox_y2": "REAL",
     "disk_used_idx": "INTEGER",
+    "disk_x1": "REAL",
+    "disk_y1": "REAL",
+    "disk_x2": "REAL",
+    "disk_y2": "REAL",
 }
 
 
-def main() -> None:
-    conn = sqlite3.connect(DB_PATH)
+def main(db_path: str = DB_PATH, verbose: bool = True) -> None:
+    conn = sqlite3.connect(db_path)
     cur = conn.cursor()
 
     for col, col_type in COLUMNS_TO_ADD.items():
         try:
             cur.execute(f"ALTER TABLE PlateResults ADD COLUMN {col} {col_type};")
-            print(f"Added column {col} ({col_type}) successfully.")
+            if verbose:
+                print(f"Added column {col} ({col_type}) successfully.")
         except sqlite3.OperationalError as e:
-            print(f"OperationalError for {col}: {e} (Column might already exist)")
+            if verbose:
+                print(f"OperationalError for {col}: {e} (Column might already exist)")
 
     conn.commit()
     conn.close()
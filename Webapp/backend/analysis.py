@@ -4,15 +4,37 @@ import numpy as np
 import os
 import easyocr
 import re
+import contextvars
+import functools
+import io
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from skimage import filters
+from scipy.optimize import linear_sum_assignment
 import uuid
 from datetime import datetime
-import google.generativeai as genai
 from dotenv import load_dotenv
+from PIL import Image
+from ocr_cache import OCRCache
+from disk_templates import TemplateBank
+from gemini_client import GeminiClient
+import preprocessing
+import metrics
+import logs
+import zone_profile
+from preprocessing import preprocess
+from batching import MicroBatcher
+from model_registry import ModelRegistry
 
 # Load environment variables
 load_dotenv()
 
+log = logs.get_logger("analysis")
+ocr_log = logs.get_logger("ocr")
+
 try:
     PIXELS_PER_MM = float(os.getenv("PIXELS_PER_MM", "10.0"))
 except (ValueError, TypeError):
@@ -22,137 +44,355 @@ except (ValueError, TypeError):
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_PATH = os.path.join(BASE_DIR, "models", "yolo_best.pt")
 
+# Detector backend: "torch" (MODEL_PATH) or "onnx" (export_onnx.py output, served by ONNX Runtime).
+# The ONNX path defaults to the INT8 model when it exists, else the float32 export.
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "torch").strip().lower()
+ONNX_MODEL_PATH = os.getenv("DETECTOR_ONNX_PATH", "").strip() or next(
+    (p for p in (os.path.join(BASE_DIR, "models", "yolo_best_int8.onnx"),) if os.path.exists(p)),
+    os.path.join(BASE_DIR, "models", "yolo_best.onnx"),
+)
+
+def load_detector(backend=None):
+    """YOLO detector for the configured backend."""
+    backend = backend or DETECTOR_BACKEND
+    if backend == "onnx":
+        return YOLO(ONNX_MODEL_PATH, task="detect")
+    return YOLO(MODEL_PATH)
+
+# Models are loaded on first use, or warmed on a background thread at startup
+# (main.py, MODEL_WARMUP). Assigning `model` / `ocr_reader` directly bypasses the registry.
+registry = ModelRegistry()
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1").strip().lower() in ("1", "true", "yes")
+model = None
+
+def get_detector():
+    """The YOLO detector, loading it on first use; None if it cannot be loaded."""
+    global model
+    if model is None:
+        model = registry.get("detector")
+    return model
+
+# Concurrent requests share the detector through a micro-batching scheduler:
+# images arriving within YOLO_BATCH_WINDOW_MS are detected in one batched call,
+# and only the scheduler thread ever touches `model`.
+YOLO_BATCHING = os.getenv("YOLO_BATCHING", "1").strip().lower() in ("1", "true", "yes")
+try:
+    YOLO_BATCH_WINDOW_MS = float(os.getenv("YOLO_BATCH_WINDOW_MS", "20"))
+    YOLO_MAX_BATCH = max(1, int(os.getenv("YOLO_MAX_BATCH", "8")))
+except (ValueError, TypeError):
+    YOLO_BATCH_WINDOW_MS, YOLO_MAX_BATCH = 20.0, 8
+YOLO_CONF = 0.1
 try:
-    model = YOLO(MODEL_PATH)
-except Exception as e:
-    print(f"Error loading model: {e}")
-    model = None
+    # Uploads are decoded for detection at the largest JPEG DCT reduction (1/2, 1/4, 1/8)
+    # that keeps the long side at least this many pixels; 0 detects at full resolution
+    DETECTION_MIN_SIDE = max(0, int(os.getenv("DETECTION_MIN_SIDE", "1280")))
+except (ValueError, TypeError):
+    DETECTION_MIN_SIDE = 1280
+
+# Disk/zone detection: "yolo" (the neural detector), "hough" (classical
+# HoughCircles disks with radially measured zones, tens of ms on CPU, for
+# triage previews) or "auto" (Hough first; YOLO only when the Hough plate
+# confidence is below HOUGH_MIN_CONFIDENCE). Every mode uses Hough when the
+# YOLO detector cannot be loaded.
+DETECTION_MODE = os.getenv("DETECTION_MODE", "yolo").strip().lower()
+try:
+    # Hough runs on a copy whose long side is at most this many pixels
+    HOUGH_MAX_SIDE = max(256, int(os.getenv("HOUGH_MAX_SIDE", "1024")))
+    # Accumulator threshold: lower finds fainter circles (and more false ones)
+    HOUGH_PARAM2 = float(os.getenv("HOUGH_PARAM2", "30"))
+    HOUGH_MIN_CONFIDENCE = float(os.getenv("HOUGH_MIN_CONFIDENCE", "0.7"))
+except (ValueError, TypeError):
+    HOUGH_MAX_SIDE, HOUGH_PARAM2, HOUGH_MIN_CONFIDENCE = 1024, 30.0, 0.7
+# Disk radius range, as fractions of the image's short side (6 mm disks on 90-150 mm plates)
+HOUGH_RADIUS_RANGE = (0.012, 0.045)
+
+def _detect_batch(images):
+    return list(get_detector()(images, conf=YOLO_CONF))
+
+def _warm_detector(detector):
+    detector(np.full((640, 640, 3), 114, dtype=np.uint8), conf=YOLO_CONF, verbose=False)
+
+registry.register("detector", load_detector, warmup=_warm_detector)
+
+detector_batcher = MicroBatcher(
+    _detect_batch, max_batch=YOLO_MAX_BATCH, window_ms=YOLO_BATCH_WINDOW_MS, name="yolo-batcher"
+) if YOLO_BATCHING else None
+
+def run_detector(img):
+    """YOLO result for one BGR image, through the micro-batcher when YOLO_BATCHING is on."""
+    with metrics.timed("detect"):
+        if detector_batcher is not None:
+            return detector_batcher(img)
+        return _detect_batch([img])[0]
 
-# Load EasyOCR reader
+# EasyOCR reader, loaded through the registry (see get_ocr_reader)
+ocr_reader = None
+
+# Per-disk OCR work (preprocessing, hashing, EasyOCR) is spread over a thread
+# pool; torch and OpenCV release the GIL. Every pool thread loads its own reader.
 try:
-    ocr_reader = easyocr.Reader(['en'])
-except Exception as e:
-    print(f"Error loading OCR reader: {e}")
-    ocr_reader = None
+    OCR_WORKERS = max(1, int(os.getenv("OCR_WORKERS", str(min(4, os.cpu_count() or 1)))))
+except (ValueError, TypeError):
+    OCR_WORKERS = 1
+_ocr_local = threading.local()
+_ocr_pool = None
+_ocr_pool_size = 0
+_ocr_pool_lock = threading.Lock()
+
+def _create_reader():
+    return easyocr.Reader(['en'])
+
+def _mark_ocr_thread():
+    _ocr_local.pooled = True
+
+def get_ocr_reader():
+    """
+    EasyOCR reader for the calling thread. Pool threads lazily load their own
+    instance (reloaded if the module-level ocr_reader is replaced); other threads
+    share ocr_reader. None when EasyOCR is unavailable.
+    """
+    global ocr_reader
+    if ocr_reader is None:
+        ocr_reader = registry.get("ocr_reader")
+    if ocr_reader is None or not getattr(_ocr_local, "pooled", False):
+        return ocr_reader
+    if getattr(_ocr_local, "source", None) is not ocr_reader:
+        try:
+            _ocr_local.reader = _create_reader()
+        except Exception as e:
+            ocr_log.error("Error loading thread OCR reader: %s", e)
+            _ocr_local.reader = None
+        _ocr_local.source = ocr_reader
+    return _ocr_local.reader
+
+def _warm_ocr_readers(reader):
+    """Dummy readtext on the shared reader and on one reader per OCR pool thread."""
+    global ocr_reader
+    # Publish the reader first: pool threads clone it while the registry entry is still warming
+    ocr_reader = reader
+    blank = np.full((64, 256), 255, dtype=np.uint8)
+    reader.readtext(blank)
+    if OCR_WORKERS <= 1:
+        return
+    # The barrier holds every task until OCR_WORKERS run at once, i.e. one per pool thread
+    barrier = threading.Barrier(OCR_WORKERS)
+
+    def warm(_):
+        try:
+            barrier.wait(timeout=60)
+        except threading.BrokenBarrierError:
+            pass
+        thread_reader = get_ocr_reader()
+        if thread_reader is not None:
+            thread_reader.readtext(blank)
+
+    ocr_map(warm, range(OCR_WORKERS))
+
+registry.register("ocr_reader", lambda: _create_reader(), warmup=_warm_ocr_readers)
+
+def ocr_map(fn, items):
+    """
+    map() over the OCR thread pool; results keep the order of items.
+    Each call runs in a copy of the caller's context, so the plate and endpoint
+    of the request stay on its log records and metrics.
+    """
+    global _ocr_pool, _ocr_pool_size
+    items = list(items)
+    if OCR_WORKERS <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with _ocr_pool_lock:
+        if _ocr_pool is None or _ocr_pool_size != OCR_WORKERS:
+            if _ocr_pool is not None:
+                _ocr_pool.shutdown(wait=False)
+            _ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr", initializer=_mark_ocr_thread)
+            _ocr_pool_size = OCR_WORKERS
+        pool = _ocr_pool
+    contexts = [contextvars.copy_context() for _ in items]
+    return list(pool.map(lambda context, item: context.run(fn, item), contexts, items))
 
 # Configure Gemini
 GEMINI_API_KEY = os.getenv("GOOGLE_VISION_API_KEY")
-if GEMINI_API_KEY:
+# Optional endpoint override (e.g. a proxy or a local stand-in server)
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "").strip() or "https://generativelanguage.googleapis.com"
+try:
+    # In-flight request cap and token bucket sized to the API quota (requests per minute)
+    GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+    GEMINI_RATE_PER_MINUTE = float(os.getenv("GEMINI_RATE_PER_MINUTE", "15"))
+    GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+    GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "20"))
+    # Circuit breaker: open after this many consecutive failures (one 429 is enough),
+    # half-open again after GEMINI_RECOVERY_TIME seconds
+    GEMINI_FAILURE_THRESHOLD = int(os.getenv("GEMINI_FAILURE_THRESHOLD", "3"))
+    GEMINI_RECOVERY_TIME = float(os.getenv("GEMINI_RECOVERY_TIME", "60"))
+except (ValueError, TypeError):
+    GEMINI_MAX_CONCURRENCY, GEMINI_RATE_PER_MINUTE, GEMINI_BURST, GEMINI_TIMEOUT = 4, 15.0, 5, 20.0
+    GEMINI_FAILURE_THRESHOLD, GEMINI_RECOVERY_TIME = 3, 60.0
+gemini_client = GeminiClient(
+    GEMINI_API_KEY,
+    model="gemini-2.0-flash",
+    endpoint=GEMINI_API_ENDPOINT,
+    max_concurrency=GEMINI_MAX_CONCURRENCY,
+    rate_per_minute=GEMINI_RATE_PER_MINUTE,
+    burst=GEMINI_BURST,
+    timeout=GEMINI_TIMEOUT,
+    failure_threshold=GEMINI_FAILURE_THRESHOLD,
+    recovery_time=GEMINI_RECOVERY_TIME,
+) if GEMINI_API_KEY else None
+
+# Plate mode reads all disks of a plate from one labelled montage in a single
+# Gemini request; per-disk calls are only made for indices it could not read.
+GEMINI_PLATE_MODE = os.getenv("GEMINI_PLATE_MODE", "1").strip().lower() in ("1", "true", "yes")
+try:
+    GEMINI_MONTAGE_TILE = int(os.getenv("GEMINI_MONTAGE_TILE", "256"))
+    # Larger plates are split over several montages
+    GEMINI_MONTAGE_MAX_DISKS = int(os.getenv("GEMINI_MONTAGE_MAX_DISKS", "16"))
+except (ValueError, TypeError):
+    GEMINI_MONTAGE_TILE, GEMINI_MONTAGE_MAX_DISKS = 256, 16
+
+# EasyOCR angle search settings
+OCR_ALLOWLIST = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.'
+
+# Batched mode sends the rotated crops of every disk on a plate through
+# readtext_batched instead of calling readtext once per disk and angle.
+OCR_BATCHED = os.getenv("OCR_BATCHED", "1").strip().lower() in ("1", "true", "yes")
+try:
+    # Number of rotated 640x640 crops per readtext_batched call (bounds peak memory)
+    OCR_BATCH_SIZE = max(1, int(os.getenv("OCR_BATCH_SIZE", "48")))
+except (ValueError, TypeError):
+    OCR_BATCH_SIZE = 48
+
+# Coarse-to-fine angle search: the estimated text orientation is tried first,
+# then a coarse grid ordered by distance to it, then a refinement around the best angle.
+# The search for a disk stops as soon as the regex-adjusted confidence reaches
+# OCR_EARLY_EXIT_CONF (set it above 1.0 to always run the full search).
+try:
+    OCR_EARLY_EXIT_CONF = float(os.getenv("OCR_EARLY_EXIT_CONF", "0.9"))
+except (ValueError, TypeError):
+    OCR_EARLY_EXIT_CONF = 0.9
+try:
+    OCR_COARSE_STEP = max(1, int(os.getenv("OCR_COARSE_STEP", "15")))
+except (ValueError, TypeError):
+    OCR_COARSE_STEP = 15
+OCR_FINE_OFFSETS = (-15, 15, -5, 5)
+# Angles per disk in the first batched round (the orientation estimates come first)
+OCR_PRIORITY_ANGLES = 4
+
+# Polar disk representation: rows = angle, columns = radius. 2160 rows per turn
+# (1/6 degree) makes every 5-degree search step an exact whole-row shift.
+POLAR_ANGULAR_RES = 2160
+try:
+    # Height of the strip through the disk centre handed to EasyOCR (0 = full crop)
+    OCR_STRIP_HEIGHT = max(0, int(os.getenv("OCR_STRIP_HEIGHT", "0")))
+except (ValueError, TypeError):
+    OCR_STRIP_HEIGHT = 0
+
+# Disk-crop preprocessing for OCR, by pipeline name (see preprocessing.PIPELINES).
+# PREPROCESS_PIPELINES_FILE may add pipelines: {"name": [["stage", {params}], ...]}
+PREPROCESS_PIPELINES_FILE = os.getenv("PREPROCESS_PIPELINES_FILE", "").strip()
+if PREPROCESS_PIPELINES_FILE:
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        gemini_model = genai.GenerativeModel('gemini-2.0-flash')
-    except Exception as e:
-        print(f"Error configuring Gemini: {e}")
-        gemini_model = None
-else:
-    gemini_model = None
+        with open(PREPROCESS_PIPELINES_FILE) as f:
+            for _name, _stages in json.load(f).items():
+                preprocessing.register_pipeline(_name, _stages)
+    except (OSError, ValueError, TypeError) as e:
+        log.error("Error loading preprocessing pipelines from %s: %s", PREPROCESS_PIPELINES_FILE, e)
+PREPROCESS_PIPELINE = os.getenv("PREPROCESS_PIPELINE", "pipeline_4").strip()
+if PREPROCESS_PIPELINE not in preprocessing.PIPELINES:
+    log.warning("Unknown PREPROCESS_PIPELINE %r, using pipeline_4", PREPROCESS_PIPELINE)
+    PREPROCESS_PIPELINE = "pipeline_4"
+
+# OCR result cache keyed by a perceptual hash of the disk crop (memory LRU + SQLite)
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+try:
+    OCR_CACHE_SIZE = max(1, int(os.getenv("OCR_CACHE_SIZE", "2048")))
+    # Hashes within this many differing bits (of 256) count as the same disk print.
+    # Recaptures of one printed code land 0-24 bits apart, different codes 16+,
+    # so a radius of 5 takes the close recaptures and no neighbouring code
+    OCR_CACHE_MAX_DISTANCE = max(0, int(os.getenv("OCR_CACHE_MAX_DISTANCE", "5")))
+except (ValueError, TypeError):
+    OCR_CACHE_SIZE, OCR_CACHE_MAX_DISTANCE = 2048, 5
+# Only results that pass the Disk_N fallback threshold are cached
+OCR_CACHE_MIN_CONF = 0.3
+ocr_cache = OCRCache(
+    os.getenv("OCR_CACHE_PATH", os.path.join(BASE_DIR, "ocr_cache.db")),
+    capacity=OCR_CACHE_SIZE,
+    max_distance=OCR_CACHE_MAX_DISTANCE,
+) if OCR_CACHE_ENABLED else None
+
+try:
+    # A zone only pairs with a disk whose centre lies within this fraction of the zone's radius
+    ZONE_MATCH_GATE = float(os.getenv("ZONE_MATCH_GATE", "1.0"))
+except (ValueError, TypeError):
+    ZONE_MATCH_GATE = 1.0
 
-# Once quota is hit, skip Gemini for all remaining disks in the session
-_gemini_quota_exceeded = False
+# Template bank of disks confirmed by users (PUT /results), tried before Gemini and EasyOCR
+TEMPLATE_MATCHING = os.getenv("TEMPLATE_MATCHING", "1").strip().lower() in ("1", "true", "yes")
+try:
+    # Minimum rotation-invariant NCC to accept a template match
+    TEMPLATE_MATCH_THRESHOLD = float(os.getenv("TEMPLATE_MATCH_THRESHOLD", "0.8"))
+    # Required lead over the best template of any other antibiotic
+    TEMPLATE_MATCH_MARGIN = float(os.getenv("TEMPLATE_MATCH_MARGIN", "0.05"))
+except (ValueError, TypeError):
+    TEMPLATE_MATCH_THRESHOLD, TEMPLATE_MATCH_MARGIN = 0.8, 0.05
+template_bank = TemplateBank(
+    os.getenv("TEMPLATE_BANK_PATH", os.path.join(BASE_DIR, "disk_templates.db"))
+) if TEMPLATE_MATCHING else None
+
+# Lexicon mode decodes OCR output straight to an Antibiotics row ("MEM 10" -> antibiotic_id)
+# instead of leaving free text for crud.get_best_antibiotic_match.
+OCR_LEXICON_MODE = os.getenv("OCR_LEXICON_MODE", "1").strip().lower() in ("1", "true", "yes")
+# "all": whole table; "microbe": only antibiotics with a breakpoint for the selected microbe
+# (a disk outside that set can then only be read as a wrong in-scope code)
+OCR_LEXICON_SCOPE = os.getenv("OCR_LEXICON_SCOPE", "all").strip().lower()
+try:
+    # Minimum edit-distance similarity between OCR text and a lexicon code to score the read at all
+    OCR_LEXICON_MIN_SIMILARITY = float(os.getenv("OCR_LEXICON_MIN_SIMILARITY", "0.6"))
+    # A read becomes the lexicon code (and its antibiotic_id) only this close to it and this far
+    # ahead of the next code; otherwise the text is kept as read for crud.get_best_antibiotic_match
+    OCR_LEXICON_TRUST_SIMILARITY = float(os.getenv("OCR_LEXICON_TRUST_SIMILARITY", "0.8"))
+    OCR_LEXICON_TRUST_MARGIN = float(os.getenv("OCR_LEXICON_TRUST_MARGIN", "0.15"))
+except (ValueError, TypeError):
+    OCR_LEXICON_MIN_SIMILARITY, OCR_LEXICON_TRUST_SIMILARITY, OCR_LEXICON_TRUST_MARGIN = 0.6, 0.8, 0.15
 
 # Regex patterns for validating medicine name and dosage
 PATTERN_MAIN = re.compile(r'^([A-Za-z]+(?:\s[A-Za-z]+){0,3})\s+(\d+(?:\.\d+)?)$')
 PATTERN_UNDER = re.compile(r'^([A-Za-z]+(?:_[A-Za-z]+){0,3})_(\d+(?:\.\d+)?)$')
 PATTERN_SECOND = re.compile(r'^([A-Za-z]+)(\d+(?:\.\d+)?)$')
+PATTERN_LENIENT = re.compile(r'^[A-Za-z]+(?:\s+\d+(?:\.\d+)?)?(?:\s*[a-zA-Z]*)?$')
 
 # ==========================================
 # Preprocessing Functions for OCR
 # ==========================================
 
+# Stages, pipelines and the shared-prefix graph live in preprocessing.py;
+# these wrappers keep the original entry points.
+
 def global_threshold(img, white=200):
     """Apply global threshold to image."""
-    _, thresh = cv2.threshold(img, white, 255, cv2.THRESH_BINARY)
-    return thresh
+    return preprocessing.STAGES["threshold"](img, value=white)
 
 def histogram_equalization(img):
     """Apply histogram equalization to improve contrast."""
-    equalized = cv2.equalizeHist(img)
-    return equalized
+    return preprocess(img, "equalize")
 
 def adaptive_threshold_clahe(img):
     """IMPROVED: Use CLAHE (Contrast Limited Adaptive Histogram Equalization).
     More gentle than global thresholding, better for text extraction."""
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    enhanced = clahe.apply(img)
-    return enhanced
+    return preprocess(img, "clahe")
 
 def sharpening(img):
-    kernel = np.array([[-0.5,-0.5,-0.5], 
-                       [-0.5,5,-0.5],
-                       [-0.5,-0.5,-0.5]])
-    sharpen = cv2.filter2D(img, -1, kernel)
-    sharpen = np.clip(sharpen, 0, 255).astype(np.uint8)
-
-    return sharpen
+    return preprocess(img, "sharpen")
 
 def preprocess_pipeline_4(gray):
     """
     New optimized preprocessing pipeline (Pipeline 4) for antibiotic disks.
     Uses Laplacian sharpening and adaptive thresholding with a circular mask.
     """
-    h, w = gray.shape
-    # CLAHE for contrast
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    img_clahe = clahe.apply(gray)
-    
-    # Gaussian Blur
-    img_gaussian = cv2.GaussianBlur(img_clahe, (7, 7), 0)
-    
-    # Laplacian Sharpening
-    lap = cv2.Laplacian(img_gaussian, cv2.CV_16S, ksize=5, scale=1, delta=0)
-    lap_abs = cv2.convertScaleAbs(lap)
-    sharpened = cv2.addWeighted(img_gaussian, 1.5, lap_abs, 0.5, 0)
-    
-    # Adaptive Thresholding
-    img_thresh = cv2.adaptiveThreshold(
-        sharpened, 255,
-        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY,
-        blockSize=49,
-        C=6
-    )
-    
-    # Invert and Morphological operations
-    img_inverted = cv2.bitwise_not(img_thresh)
-    kernel = np.ones((2, 2), np.uint8)
-    kernel2 = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    
-    img_dilated = cv2.dilate(img_inverted, kernel, iterations=1)
-    img_closing = cv2.morphologyEx(img_dilated, cv2.MORPH_CLOSE, kernel2, iterations=1)
-    result = cv2.erode(img_closing, kernel, iterations=1)
-    
-    # Final result is black text on white background
-    return cv2.bitwise_not(result)
+    return preprocess(gray, "pipeline_4")
 
 def denoise_otsu(gray):
-    # 1. CLAHE normalize
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    gray_clahe = clahe.apply(gray)
-
-    # 2. Sharpen
-    sharpened = sharpening(gray_clahe)
-
-    # 3. Blur
-    blurred = cv2.GaussianBlur(sharpened, (3, 3), 0)
-
-    # 4. Otsu
-    _, processed = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-
-    # 5. Measure stroke width -> dilate/erode
-    inverted = cv2.bitwise_not(processed)
-    text_pixel_ratio = np.sum(inverted == 255) / inverted.size
-
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
-
-    if text_pixel_ratio < 0.15:
-        processed_fix = cv2.dilate(inverted, kernel, iterations=1)
-    elif text_pixel_ratio > 0.35:
-        processed_fix = cv2.erode(inverted, kernel, iterations=1)
-    else:
-        processed_fix = inverted
-
-    result = cv2.bitwise_not(processed_fix)
-    return result
+    """CLAHE, sharpen, blur, Otsu, then thicken or thin strokes by text-pixel ratio."""
+    return preprocess(gray, "denoise_otsu")
 
 def crop_and_pad_640(img, box, target=640, circle_shrink=30):
     """Crop ROI from image, pad to target size, and apply circular mask."""
@@ -218,6 +458,150 @@ def rotate_image(img, angle):
     )
     return rotated
 
+def unwrap_disk_polar(img, angular_res=POLAR_ANGULAR_RES):
+    """
+    Unwrap a square disk crop into polar form with a single warpPolar call.
+    Rows are angles (angular_res per full turn), columns are radius from the centre.
+    Rotating the disk is then a circular shift of the rows; see polar_strip.
+    """
+    h, w = img.shape[:2]
+    radius = min(h, w) / 2
+    return cv2.warpPolar(
+        img, (int(radius), angular_res), (w / 2, h / 2), radius,
+        cv2.WARP_POLAR_LINEAR + cv2.INTER_CUBIC
+    )
+
+@functools.lru_cache(maxsize=8)
+def _polar_strip_index(size, height, angular_res, radial_res):
+    """
+    Flat lookup into a row-doubled polar array for a size x height strip through the disk centre.
+    Returns (index, outside) where outside marks pixels beyond the disk radius.
+    """
+    half = size / 2
+    ys = np.arange(height) - height / 2 + 0.5
+    xs = np.arange(size) - half + 0.5
+    xx, yy = np.meshgrid(xs, ys)
+    cols = np.floor(np.hypot(xx, yy) * radial_res / half).astype(np.int64)
+    rows = np.rint(np.degrees(np.arctan2(yy, xx)) % 360 * angular_res / 360).astype(np.int64) % angular_res
+    outside = cols >= radial_res
+    cols = np.minimum(cols, radial_res - 1)
+    return rows * radial_res + cols, outside
+
+def polar_strip(polar, angle, size=640, height=None):
+    """
+    Render the disk rotated by angle (same convention as rotate_image) as a
+    size x height strip through its centre, straight from the polar array.
+    The rotation is a shift of the polar rows, so this is one array gather
+    instead of a warpAffine. Pixels beyond the disk radius are white.
+    """
+    height = size if height is None else height
+    angular_res, radial_res = polar.shape[:2]
+    index, outside = _polar_strip_index(size, height, angular_res, radial_res)
+    shift = int(round(angle * angular_res / 360.0)) % angular_res
+    # Doubling the rows turns the circular shift into a plain offset
+    doubled = np.concatenate([polar, polar[:shift]], axis=0) if shift else polar
+    strip = doubled.reshape(-1, *polar.shape[2:])[index + shift * radial_res]
+    strip[outside] = 255
+    return strip
+
+def _normalize_angle(angle):
+    """Wrap an angle in degrees into [-180, 180)."""
+    return (angle + 180.0) % 360.0 - 180.0
+
+def _angle_distance(a, b):
+    return abs(_normalize_angle(a - b))
+
+def estimate_text_orientation(binary, min_elongation=1.5):
+    """
+    Estimate the rotate_image angle that makes the printed code horizontal.
+    Works on the Pipeline 4 output (black text on white): the principal axis of
+    the text pixels, from second-order image moments, follows the text line.
+    The result is ambiguous by 180 degrees (upside-down text), so callers try both.
+    Returns None when there is no text or the text blob is not elongated enough.
+    """
+    text_mask = (binary < 128).astype(np.uint8)
+    m = cv2.moments(text_mask, binaryImage=True)
+    if m['m00'] < 50:
+        return None
+
+    mu20, mu02, mu11 = m['mu20'], m['mu02'], m['mu11']
+    spread = np.sqrt(4 * mu11 ** 2 + (mu20 - mu02) ** 2)
+    major, minor = (mu20 + mu02 + spread) / 2, (mu20 + mu02 - spread) / 2
+    if minor <= 0 or major / minor < min_elongation ** 2:
+        return None
+
+    theta = 0.5 * np.degrees(np.arctan2(2 * mu11, mu20 - mu02))
+    return float(_normalize_angle(theta))
+
+def ocr_angle_plan(binary, coarse_step=None):
+    """
+    Candidate angles for the EasyOCR search, most likely first: the two
+    orientation estimates, then a coarse grid ordered by distance to them.
+    """
+    coarse_step = OCR_COARSE_STEP if coarse_step is None else coarse_step
+    coarse = list(range(-180, 180, coarse_step))
+    estimate = estimate_text_orientation(binary)
+    if estimate is None:
+        return coarse
+
+    estimates = [round(estimate, 1), round(_normalize_angle(estimate + 180), 1)]
+    coarse.sort(key=lambda a: min(_angle_distance(a, e) for e in estimates))
+    return estimates + [a for a in coarse if min(_angle_distance(a, e) for e in estimates) >= 1]
+
+def disk_phashes(binary, grid=(32, 8)):
+    """
+    Perceptual hashes of a disk print for the OCR cache, as ints of grid[0] * grid[1] bits.
+    The Pipeline 4 mask is de-speckled and turned to its estimated text
+    orientation (via the polar form), then cropped to the text box and
+    downsampled, so the same print hashes alike whatever its rotation, position
+    and scale in the crop. The orientation estimate is only known up to 180
+    degrees, so two hashes are returned: upright and flipped.
+    """
+    clean = cv2.medianBlur(binary, 5)
+    estimate = estimate_text_orientation(clean) or 0.0
+    polar = unwrap_disk_polar(clean)
+    hashes = []
+    for angle in (estimate, estimate + 180):
+        strip = polar_strip(polar, angle, size=clean.shape[1], height=clean.shape[0] * 3 // 8)
+        text = strip < 128
+        rows, cols = text.sum(axis=1), text.sum(axis=0)
+        ys = np.flatnonzero(rows > 0.1 * rows.max()) if rows.any() else np.array([0, strip.shape[0] - 1])
+        xs = np.flatnonzero(cols > 0.1 * cols.max()) if cols.any() else np.array([0, strip.shape[1] - 1])
+        box = 255 - strip[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1]
+        small = cv2.resize(box, grid, interpolation=cv2.INTER_AREA)
+        bits = (small > np.median(small)).ravel()
+        hashes.append(int.from_bytes(np.packbits(bits).tobytes(), "big"))
+    return hashes
+
+def disk_signature(binary, angles=256, radii=32):
+    """
+    Compact polar signature of a disk print for template matching (rows = angle,
+    columns = radius, text pixels high). Rotating the disk shifts its rows.
+    """
+    clean = cv2.medianBlur(binary, 5)
+    small = cv2.resize(clean, (128, 128), interpolation=cv2.INTER_AREA)
+    polar = cv2.warpPolar(small, (radii, angles), (64, 64), 64, cv2.WARP_POLAR_LINEAR + cv2.INTER_LINEAR)
+    return 255.0 - polar.astype(np.float32)
+
+def classify_disk_template(binary):
+    """
+    First-pass classifier against the confirmed-disk template bank.
+    Returns (code, antibiotic_id, score) when the best match clears
+    TEMPLATE_MATCH_THRESHOLD and leads other antibiotics by TEMPLATE_MATCH_MARGIN, else None.
+    Until the bank holds templates of two antibiotics there is no margin to
+    check, and every disk over the threshold would get the only learned code,
+    so nothing is matched.
+    """
+    if template_bank is None:
+        return None
+    match = template_bank.match(disk_signature(binary))
+    if match is None:
+        return None
+    antibiotic_id, code, score, runner_up, _ = match
+    if runner_up is None or score < TEMPLATE_MATCH_THRESHOLD or score - runner_up < TEMPLATE_MATCH_MARGIN:
+        return None
+    return code, antibiotic_id, round(score, 3)
+
 def adjust_confidence_with_regex(text, conf, penalty=0.3):
     """
     Adjust confidence based on regex match for medicine name + dosage.
@@ -239,12 +623,136 @@ def adjust_confidence_with_regex(text, conf, penalty=0.3):
         return min(conf + 0.15, 1.0)
     
     # Fallback to lenient checks or penalty
-    lenient_pattern = re.compile(r'^[A-Za-z]+(?:\s+\d+(?:\.\d+)?)?(?:\s*[a-zA-Z]*)?$')
-    if lenient_pattern.match(t):
+    if PATTERN_LENIENT.match(t):
         return max(0.0, conf - 0.05)
         
     return max(0.0, conf - penalty)
 
+def adjust_confidences_with_regex(texts, confs, penalty=0.3):
+    """
+    Vectorized adjust_confidence_with_regex for many OCR candidates at once.
+    Each text is classified against the regex patterns once, then the bonuses
+    and penalties are applied to the whole confidence array in a single pass.
+    """
+    stripped = [(t or "").strip() for t in texts]
+    confs = np.asarray(confs, dtype=np.float64)
+
+    def matches(pattern):
+        return np.fromiter((bool(pattern.match(t)) for t in stripped), dtype=bool, count=len(stripped))
+
+    empty = np.fromiter((t == "" for t in stripped), dtype=bool, count=len(stripped))
+    return np.select(
+        [empty, matches(PATTERN_MAIN), matches(PATTERN_UNDER), matches(PATTERN_SECOND), matches(PATTERN_LENIENT)],
+        [0.0, np.minimum(confs + 0.3, 1.0), np.minimum(confs + 0.2, 1.0),
+         np.minimum(confs + 0.15, 1.0), np.maximum(confs - 0.05, 0.0)],
+        default=np.maximum(confs - penalty, 0.0),
+    )
+
+def _lexicon_key(text):
+    """Uppercase letters and digits only: 'Mem 10' -> 'MEM10'."""
+    return re.sub(r'[^A-Z0-9]', '', (text or "").upper())
+
+def build_ocr_lexicon(antibiotics):
+    """
+    Build the closed OCR lexicon from Antibiotics rows (crud.get_ocr_lexicon).
+    Each disk code is abbreviation + concentration_ug ("MEM 10", or just "OX"
+    when the concentration is 0). A code shared by several rows (Ampicillin
+    and Ampicillin-sulbactam are both "AMP" in some tables) gets no id: its
+    breakpoint row depends on the microbe, so crud.get_best_antibiotic_match
+    resolves it. Codes are stored as a padded uint8 matrix for vectorized matching.
+    """
+    codes, ids = [], []
+    index = {}
+    for ab in antibiotics:
+        abbreviation = (ab.abbreviation or "").strip().upper()
+        if not abbreviation:
+            continue
+        code = f"{abbreviation} {ab.concentration_ug}" if ab.concentration_ug else abbreviation
+        key = _lexicon_key(code)
+        if not key:
+            continue
+        if key in index:
+            if ids[index[key]] != ab.antibiotic_id:
+                ids[index[key]] = None
+            continue
+        index[key] = len(codes)
+        codes.append(code)
+        ids.append(ab.antibiotic_id)
+
+    keys = [_lexicon_key(code) for code in codes]
+    width = max((len(k) for k in keys), default=0)
+    chars = np.zeros((len(keys), width), dtype=np.uint8)
+    for i, key in enumerate(keys):
+        chars[i, :len(key)] = np.frombuffer(key.encode(), dtype=np.uint8)
+    allowlist = "".join(sorted(set("".join(keys)) | set("0123456789."))) if keys else OCR_ALLOWLIST
+    return {
+        "codes": codes,
+        "ids": ids,
+        "id_by_code": dict(zip(codes, ids)),
+        "chars": chars,
+        "lengths": np.array([len(k) for k in keys], dtype=np.int64),
+        "allowlist": allowlist,
+    }
+
+# Characters OCR swaps for each other; substituting one for its twin costs a quarter of an edit
+OCR_CONFUSABLE = {"0": "O", "O": "0", "1": "I", "I": "1", "5": "S", "S": "5", "8": "B", "B": "8", "2": "Z", "Z": "2"}
+OCR_CONFUSABLE_COST = 0.25
+
+def _lexicon_distances(query, lexicon):
+    """Levenshtein distance from query (a _lexicon_key) to every lexicon code at once."""
+    chars, lengths = lexicon["chars"], lexicon["lengths"]
+    steps = np.arange(chars.shape[1] + 1, dtype=np.float64)
+    row = np.broadcast_to(steps, (len(chars), len(steps))).copy()
+    for i, ch in enumerate(query, start=1):
+        cost = (chars != ord(ch)).astype(np.float64)
+        if ch in OCR_CONFUSABLE:
+            cost[chars == ord(OCR_CONFUSABLE[ch])] = OCR_CONFUSABLE_COST
+        substitution = row[:, :-1] + cost
+        new_row = np.empty_like(row)
+        new_row[:, 0] = i
+        new_row[:, 1:] = np.minimum(row[:, 1:] + 1, substitution)
+        # Insertions run along the row: d[j] = min_k<=j (d[k] + j - k)
+        row = np.minimum.accumulate(new_row - steps, axis=1) + steps
+    return np.take_along_axis(row, lengths[:, None], axis=1)[:, 0]
+
+def decode_with_lexicon(texts, confs, lexicon):
+    """
+    Decode OCR candidates against the closed lexicon.
+    Each text is compared with every code by edit distance; the score is the
+    best similarity times the confidence with the same +0.3 bonus a
+    well-formed "MEM 10" read gets from adjust_confidence_with_regex.
+    Candidates below OCR_LEXICON_MIN_SIMILARITY score 0. A text becomes its
+    nearest code only when the match is near-exact (OCR_LEXICON_TRUST_SIMILARITY,
+    OCR_LEXICON_TRUST_MARGIN over the next code); a looser match keeps the
+    text as read, so an antibiotic missing from the lexicon is not snapped to
+    a similar code ("MEM10" is not "IPM 10").
+    Returns (scores array, labels list), one per input.
+    """
+    confs = np.asarray(confs, dtype=np.float64)
+    similarities = np.zeros(len(texts))
+    labels = [""] * len(texts)
+    decoded = {}
+    for i, text in enumerate(texts):
+        key = _lexicon_key(text)
+        if not key or not lexicon["codes"]:
+            continue
+        if key not in decoded:
+            sims = 1.0 - _lexicon_distances(key, lexicon) / np.maximum(len(key), lexicon["lengths"])
+            best = int(sims.argmax())
+            runner_up = np.partition(sims, -2)[-2] if len(sims) > 1 else 0.0
+            trusted = sims[best] >= OCR_LEXICON_TRUST_SIMILARITY and sims[best] - runner_up >= OCR_LEXICON_TRUST_MARGIN
+            decoded[key] = (lexicon["codes"][best] if trusted else text.strip(), float(sims[best]))
+        labels[i], similarities[i] = decoded[key]
+
+    similarities[similarities < OCR_LEXICON_MIN_SIMILARITY] = 0.0
+    return similarities * np.minimum(confs + 0.3, 1.0), labels
+
+def _regex_scorer(texts, confs):
+    return adjust_confidences_with_regex(texts, confs), list(texts)
+
+def _lexicon_scorer(lexicon):
+    return lambda texts, confs: decode_with_lexicon(texts, confs, lexicon)
+
 GEMINI_PROMPT = (
     "This is a cropped image of an antibiotic disk from a disk diffusion susceptibility test.\n"
     "The disk has a short printed code: uppercase letters (antibiotic abbreviation) followed by a number (dosage in µg).\n"
@@ -253,41 +761,269 @@ GEMINI_PROMPT = (
     "Respond with ONLY the code printed on the disk. If the image is unclear, give your best estimate."
 )
 
-def extract_medicine_gemini(image):
+def gemini_prompt(lexicon=None):
+    """GEMINI_PROMPT, restricted to the lexicon's codes when one is given."""
+    if not lexicon or not lexicon["codes"]:
+        return GEMINI_PROMPT
+    return GEMINI_PROMPT + "\nThe code is one of: " + ", ".join(lexicon["codes"]) + "."
+
+GEMINI_PLATE_PROMPT = (
+    "This image is a grid of cropped antibiotic disks from a disk diffusion susceptibility test.\n"
+    "Each tile is labelled with its index (#0, #1, ...) in the bar above it.\n"
+    "Each disk has a short printed code: uppercase letters (antibiotic abbreviation) followed by a number (dosage in µg).\n"
+    "Examples: AMX 25, AMP 10, OX 1, CIP 5, CN 10, E 15, SXT 25, P 10, VA 30, TET 30, AZM 15, MEM 10.\n"
+    "Some disks have only letters without a number (e.g., OX, AMP).\n"
+    'Respond with ONLY a JSON array with one object per tile: [{"index": 0, "code": "MEM 10"}, ...].\n'
+    "Use null as the code when a disk cannot be read."
+)
+
+def gemini_plate_prompt(lexicon=None):
+    """GEMINI_PLATE_PROMPT, restricted to the lexicon's codes when one is given."""
+    if not lexicon or not lexicon["codes"]:
+        return GEMINI_PLATE_PROMPT
+    return GEMINI_PLATE_PROMPT + "\nEvery code is one of: " + ", ".join(lexicon["codes"]) + "."
+
+def build_disk_montage(images, tile=None):
     """
-    Primary OCR: Use Gemini AI with original color/grayscale crop (not preprocessed).
+    Tile disk crops into one BGR grid, each under a bar labelled with its index.
+    Tiles are resized to tile x tile; the grid is as close to square as possible.
     """
-    global _gemini_quota_exceeded
+    tile = tile or GEMINI_MONTAGE_TILE
+    label_h = max(24, tile // 8)
+    cols = int(np.ceil(np.sqrt(len(images))))
+    rows = int(np.ceil(len(images) / cols))
+    montage = np.full((rows * (tile + label_h), cols * tile, 3), 255, dtype=np.uint8)
+    for idx, image in enumerate(images):
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        y = (idx // cols) * (tile + label_h)
+        x = (idx % cols) * tile
+        montage[y:y + label_h, x:x + tile] = 0
+        cv2.putText(montage, f"#{idx}", (x + 6, y + label_h - 6), cv2.FONT_HERSHEY_SIMPLEX,
+                    label_h / 32, (255, 255, 255), 2, cv2.LINE_AA)
+        montage[y + label_h:y + label_h + tile, x:x + tile] = cv2.resize(image, (tile, tile), interpolation=cv2.INTER_AREA)
+        cv2.rectangle(montage, (x, y), (x + tile - 1, y + label_h + tile - 1), (0, 0, 0), 1)
+    return montage
 
-    if not gemini_model or _gemini_quota_exceeded:
+def parse_gemini_plate_response(text, count):
+    """
+    Parse the JSON array answer of a montage request into a list of codes (None
+    when unread) for indices 0..count-1. Tolerates markdown fences and an
+    {"index": code} object instead of an array.
+    """
+    codes = [None] * count
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`").split("\n", 1)[-1] if "\n" in text else ""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return codes
+    if isinstance(data, dict):
+        data = [{"index": k, "code": v} for k, v in data.items()]
+    if not isinstance(data, list):
+        return codes
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.get("index"))
+        except (TypeError, ValueError):
+            continue
+        code = item.get("code")
+        if 0 <= idx < count and isinstance(code, str) and code.strip() and code.strip().lower() != "unknown":
+            codes[idx] = code.strip().upper()
+    return codes
+
+def _gemini_available():
+    return gemini_client is not None and gemini_client.available()
+
+def _gemini_confidence(text):
+    return 0.98 if PATTERN_MAIN.match(text) else 0.90
+
+def extract_medicine_gemini_plate(images, lexicon=None):
+    """
+    Read every disk of a plate with one Gemini request per montage of up to
+    GEMINI_MONTAGE_MAX_DISKS crops. Returns a list of (text, confidence), with
+    (None, 0.0) for disks the model did not read.
+    """
+    results = [(None, 0.0)] * len(images)
+    if not _gemini_available():
+        return results
+    chunk = max(1, GEMINI_MONTAGE_MAX_DISKS)
+    for start in range(0, len(images), chunk):
+        batch = images[start:start + chunk]
+        _, buffer = cv2.imencode('.jpg', build_disk_montage(batch))
+        full_text = gemini_client.generate(gemini_plate_prompt(lexicon), buffer.tobytes(), json_response=True)
+        if full_text is None:
+            continue
+        for offset, code in enumerate(parse_gemini_plate_response(full_text, len(batch))):
+            if code:
+                results[start + offset] = (code, _gemini_confidence(code))
+    return results
+
+def _gemini_read(full_text):
+    """Map a per-disk Gemini answer to (text, confidence)."""
+    if full_text is None:
         return None, 0.0
+    if not full_text:
+        return "Unknown", 0.0
+    return full_text, _gemini_confidence(full_text)
 
-    try:
-        _, buffer = cv2.imencode('.jpg', image)
-        img_bytes = buffer.tobytes()
+def extract_medicine_gemini_many(images, lexicon=None):
+    """
+    Per-disk Gemini OCR for several crops, sent concurrently through the rate-limited
+    client. Returns a list of (text, confidence); (None, 0.0) when Gemini is unavailable.
+    """
+    if not images or not _gemini_available():
+        return [(None, 0.0)] * len(images)
+    prompt = gemini_prompt(lexicon)
+    texts = gemini_client.generate_many([(prompt, cv2.imencode('.jpg', image)[1].tobytes(), False) for image in images])
+    return [_gemini_read(text) for text in texts]
+
+def extract_medicine_gemini(image, lexicon=None):
+    """
+    Primary OCR: Use Gemini AI with original color/grayscale crop (not preprocessed).
+    """
+    return extract_medicine_gemini_many([image], lexicon=lexicon)[0]
+
+def _join_readtext(result):
+    """Collapse an EasyOCR detail=1 result into (display_text, mean_confidence)."""
+    texts = [t for _, t, _ in result]
+    confs = [c for _, _, c in result]
+    display_text = " ".join(texts) if texts else ""
+    avg_conf = float(np.mean(confs)) if confs else 0.0
+    return display_text, avg_conf
+
+def _angle_search(images_gray, recognize, first_round=None, round_size=None, scorer=_regex_scorer):
+    """
+    Coarse-to-fine, early-exit angle search shared by the sequential and batched EasyOCR paths.
+
+    Each disk starts from its ocr_angle_plan. Every round takes the next angles
+    of each unfinished disk (first_round in the first round, round_size after
+    that; None means the whole remaining queue), recognizes all of their rotated
+    crops with a single recognize(list_of_images) -> [(text, conf), ...] call and
+    scores them in one vectorized pass with scorer(texts, confs) -> (scores, labels);
+    the regex scorer keeps the raw text, the lexicon scorer returns lexicon codes.
+    A disk is finished once its best score reaches OCR_EARLY_EXIT_CONF; when
+    its coarse queue runs out, the angles around its best candidate
+    (OCR_FINE_OFFSETS) are queued once as the fine pass.
+
+    Returns a list of (text, confidence, angle, angles_tried), one per image.
+    """
+    queues = [ocr_angle_plan(gray) for gray in images_gray]
+    # One warpPolar per disk; every candidate angle is then a row shift of it
+    polars = [unwrap_disk_polar(gray) for gray in images_gray]
+    best = [("Unknown", 0.0, 0) for _ in images_gray]
+    tried = [[] for _ in images_gray]
+    refined = [False] * len(images_gray)
+    done = [False] * len(images_gray)
+    take_next = first_round
+    # Checked once: at INFO the per-angle lines cost nothing inside the loop
+    debug = ocr_log.isEnabledFor(logging.DEBUG)
+
+    while True:
+        jobs = []
+        for i, queue in enumerate(queues):
+            if done[i]:
+                continue
+            if not queue and not refined[i]:
+                refined[i] = True
+                if best[i][1] > 0:
+                    queue.extend(
+                        a for a in (_normalize_angle(best[i][2] + off) for off in OCR_FINE_OFFSETS)
+                        if min((_angle_distance(a, t) for t in tried[i]), default=360) >= 1
+                    )
+            take = len(queue) if take_next is None else take_next
+            jobs.extend((i, angle) for angle in queue[:take])
+            del queue[:take]
+        if not jobs:
+            break
+        take_next = round_size
 
-        response = gemini_model.generate_content([
-            GEMINI_PROMPT,
-            {"mime_type": "image/jpeg", "data": img_bytes}
+        outputs = recognize([
+            polar_strip(polars[i], angle, size=images_gray[i].shape[1], height=OCR_STRIP_HEIGHT or None)
+            for i, angle in jobs
         ])
+        scores, labels = scorer([t for t, _ in outputs], [c for _, c in outputs])
+        for (i, angle), text, score in zip(jobs, labels, scores):
+            if debug:
+                ocr_log.debug("Angle %s: %r (score %.3f)", angle, text, score, extra={"crop": i})
+            tried[i].append(angle)
+            if score > best[i][1]:
+                best[i] = (text, float(score), angle)
+        for i in set(i for i, _ in jobs):
+            if best[i][1] >= OCR_EARLY_EXIT_CONF:
+                done[i] = True
 
-        full_text = response.text.strip()
-        if not full_text:
-            return "Unknown", 0.0
+    results = []
+    for (best_text, best_conf, best_angle), angles in zip(best, tried):
+        if best_conf < 0.10 or best_text.strip() == "":
+            best_text = "Unknown"
+            best_conf = 0.0
+        results.append((best_text, round(best_conf, 3), best_angle, len(angles)))
+    return results
 
-        if PATTERN_MAIN.match(full_text):
-            return full_text, 0.98
+def extract_medicine_easyocr(image_gray, lexicon=None):
+    """
+    Local EasyOCR fallback for a single disk: one readtext call per candidate
+    angle, stopping as soon as a candidate passes OCR_EARLY_EXIT_CONF.
+    With a lexicon (build_ocr_lexicon) the recognizer is limited to the lexicon's
+    characters and the text returned is a lexicon code.
+    Returns (text, confidence, angle, angles_tried).
+    """
+    allowlist = lexicon["allowlist"] if lexicon else OCR_ALLOWLIST
+    reader = get_ocr_reader()
+    if reader is None:
+        return "Unknown", 0.0, 0, 0
 
-        return full_text, 0.90
+    def recognize(images):
+        outputs = []
+        for rotated in images:
+            try:
+                result = reader.readtext(rotated, allowlist=allowlist, detail=1)
+                outputs.append(_join_readtext(result))
+            except Exception:
+                outputs.append(("", 0.0))
+        return outputs
 
-    except Exception as e:
-        err = str(e).lower()
-        if any(k in err for k in ("quota", "resource_exhausted", "429", "rate limit", "ratequota")):
-            print(f"[DEBUG OCR] ⚠️ Gemini quota exceeded — switching to EasyOCR for all remaining disks")
-            _gemini_quota_exceeded = True
-        else:
-            print(f"[DEBUG OCR] Gemini API error: {e}")
-        return None, 0.0
+    # One angle per round so the early exit is checked after every readtext call
+    scorer = _lexicon_scorer(lexicon) if lexicon else _regex_scorer
+    return _angle_search([image_gray], recognize, first_round=1, round_size=1, scorer=scorer)[0]
+
+def extract_medicine_easyocr_batched(images_gray, batch_size=None, lexicon=None):
+    """
+    Batched EasyOCR fallback for all disks of a plate.
+    Every search round builds the rotated crops of all unfinished disks and
+    sends them through readtext_batched in chunks of batch_size, so text
+    detection runs as one tensor call per chunk. lexicon works as in extract_medicine_easyocr.
+    Returns a list of (text, confidence, angle, angles_tried), one per input image.
+    """
+    batch_size = OCR_BATCH_SIZE if batch_size is None else batch_size
+    allowlist = lexicon["allowlist"] if lexicon else OCR_ALLOWLIST
+    if not images_gray:
+        return []
+    reader = get_ocr_reader()
+    if reader is None:
+        return [("Unknown", 0.0, 0, 0) for _ in images_gray]
+
+    def recognize(crops):
+        # All strips share one shape (crop_and_pad_640 size), which readtext_batched requires
+        outputs = []
+        for start in range(0, len(crops), batch_size):
+            chunk = crops[start:start + batch_size]
+            try:
+                chunk_results = reader.readtext_batched(
+                    chunk, allowlist=allowlist, detail=1, batch_size=batch_size
+                )
+            except Exception as e:
+                ocr_log.error("Batched EasyOCR error: %s", e)
+                chunk_results = [[] for _ in chunk]
+            outputs.extend(_join_readtext(result) for result in chunk_results)
+        return outputs
+
+    scorer = _lexicon_scorer(lexicon) if lexicon else _regex_scorer
+    return _angle_search(images_gray, recognize, first_round=OCR_PRIORITY_ANGLES, scorer=scorer)
 
 def extract_medicine_ocr(image_gray, image_original=None):
     """
@@ -297,47 +1033,160 @@ def extract_medicine_ocr(image_gray, image_original=None):
     """
     # 1. Try Gemini — prefer original color image over preprocessed grayscale
     gemini_input = image_original if image_original is not None else image_gray
-    print(f"[DEBUG OCR] Attempting Gemini OCR (quota_exceeded={_gemini_quota_exceeded})...")
+    ocr_log.debug("Attempting Gemini OCR (available=%s)", _gemini_available())
     medicine_name, confidence = extract_medicine_gemini(gemini_input)
 
     if medicine_name and confidence > 0.5:
-        print(f"[DEBUG OCR] ✓ Gemini: '{medicine_name}' (conf: {confidence})")
+        ocr_log.debug("Gemini: %r (conf: %s)", medicine_name, confidence)
         return medicine_name, confidence, 0
 
     # 2. Fallback to EasyOCR
-    print(f"[DEBUG OCR] ⚠️ Falling back to Local EasyOCR...")
-    if ocr_reader is None:
-        return "Unknown", 0.0, 0
-    
-    best_text = "Unknown"
-    best_conf = 0.0
-    best_angle = 0
-    
-    angles = list(range(-180, 180, 15))
-    
-    for angle in angles:
-        rotated = rotate_image(image_gray, angle)
-        try:
-            result = ocr_reader.readtext(rotated, allowlist='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.', detail=1)
-            texts = [t for _, t, _ in result]
-            confs = [c for _, _, c in result]
-            display_text = " ".join(texts) if texts else ""
-            avg_conf = np.mean(confs) if confs else 0.0
-            # Use the upgraded regex adjuster with bonuses
-            adj_conf = adjust_confidence_with_regex(display_text, avg_conf)
-            
-            if adj_conf > best_conf:
-                best_conf = adj_conf
-                best_text = display_text
-                best_angle = angle
-        except:
-            continue
-            
-    if best_conf < 0.10 or best_text.strip() == "":
-        best_text = "Unknown"
-        best_conf = 0.0
-    
-    return best_text, round(best_conf, 3), best_angle
+    ocr_log.debug("Falling back to local EasyOCR")
+    medicine_name, confidence, angle, _ = extract_medicine_easyocr(image_gray)
+    return medicine_name, confidence, angle
+
+def _decode_one(text, confidence, lexicon):
+    """Map a single cache/Gemini read onto the lexicon: (code, text as read, or "Unknown"; score)."""
+    scores, codes = decode_with_lexicon([text], [confidence], lexicon)
+    return (codes[0], round(float(scores[0]), 3)) if scores[0] > 0 else ("Unknown", 0.0)
+
+def extract_medicine_ocr_plate(images_gray, images_original=None, lexicon=None):
+    """
+    Plate-level Hybrid OCR: the OCR cache first, then the confirmed-disk template
+    bank, then Gemini (one montage request for the plate when GEMINI_PLATE_MODE
+    is on, per-disk calls for what it missed), then every disk still unread
+    goes through EasyOCR together (batched when OCR_BATCHED is on).
+    With a lexicon (build_ocr_lexicon) every engine's output is decoded to a
+    lexicon code when it is a near-exact match, so the returned text can be
+    looked up in lexicon["id_by_code"] (None for codes shared by several
+    antibiotics and for text kept as read).
+    Returns a list of (text, confidence, angle, angles_tried) in input order;
+    angles_tried is 0 for disks read from the cache, a template or Gemini.
+    """
+    if images_original is None:
+        images_original = [None] * len(images_gray)
+
+    endpoint = metrics.endpoint()
+    results = [None] * len(images_gray)
+    engines = [None] * len(images_gray)
+    hashes = [None] * len(images_gray)
+    if ocr_cache is not None:
+        with metrics.timed("ocr_cache"):
+            hashes = ocr_map(disk_phashes, images_gray)
+            for i in range(len(images_gray)):
+                cached = ocr_cache.get(*hashes[i])
+                if cached is not None:
+                    ocr_log.debug("Cache: %r (conf: %s, engine: %s, distance: %s)", *cached, extra={"disk": i})
+                    text, confidence = _decode_one(*cached[:2], lexicon) if lexicon else cached[:2]
+                    results[i] = (text, confidence, 0, 0)
+        hits = sum(result is not None for result in results)
+        metrics.OCR_CACHE_HITS.inc(hits, endpoint=endpoint)
+        metrics.OCR_CACHE_MISSES.inc(len(images_gray) - hits, endpoint=endpoint)
+        metrics.OCR_ENGINE_DISKS.inc(hits, endpoint=endpoint, engine="cache")
+
+    unmatched = [i for i in range(len(images_gray)) if results[i] is None] if template_bank is not None else []
+    template_matches = []
+    if unmatched:
+        with metrics.timed("ocr_template"):
+            template_matches = ocr_map(classify_disk_template, [images_gray[i] for i in unmatched])
+    for i, matched in zip(unmatched, template_matches):
+        if matched is not None:
+            ocr_log.debug("Template: %r (score: %s)", matched[0], matched[2], extra={"disk": i})
+            text, confidence = _decode_one(matched[0], matched[2], lexicon) if lexicon else (matched[0], matched[2])
+            results[i] = (text, confidence, 0, 0)
+            metrics.OCR_ENGINE_DISKS.inc(endpoint=endpoint, engine="template")
+
+    gemini_inputs = [
+        image_original if image_original is not None else image_gray
+        for image_gray, image_original in zip(images_gray, images_original)
+    ]
+    plate_reads = {}
+    pending = [i for i in range(len(images_gray)) if results[i] is None]
+    if GEMINI_PLATE_MODE and len(pending) > 1 and _gemini_available():
+        started = time.perf_counter()
+        with metrics.timed("ocr_gemini"):
+            reads = extract_medicine_gemini_plate([gemini_inputs[i] for i in pending], lexicon=lexicon)
+        plate_reads = dict(zip(pending, reads))
+        ocr_log.info(
+            "Gemini plate OCR read %d of %d disk(s)", sum(bool(text) for text, _ in reads), len(pending),
+            extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)},
+        )
+
+    # Disks the plate request missed go to Gemini one by one, concurrently
+    unread = [i for i in pending if not plate_reads.get(i, (None, 0.0))[0]]
+    if unread and _gemini_available():
+        started = time.perf_counter()
+        with metrics.timed("ocr_gemini"):
+            reads = extract_medicine_gemini_many([gemini_inputs[i] for i in unread], lexicon=lexicon)
+        plate_reads.update(zip(unread, reads))
+        ocr_log.info(
+            "Gemini OCR read %d of %d disk(s)", sum(bool(text) for text, _ in reads), len(unread),
+            extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)},
+        )
+
+    fallback_indices = []
+    for i in pending:
+        medicine_name, confidence = plate_reads.get(i, (None, 0.0))
+        if medicine_name and lexicon:
+            medicine_name, confidence = _decode_one(medicine_name, confidence, lexicon)
+        if medicine_name and confidence > 0.5:
+            ocr_log.debug("Gemini: %r (conf: %s)", medicine_name, confidence, extra={"disk": i})
+            results[i] = (medicine_name, confidence, 0, 0)
+            engines[i] = "gemini"
+            metrics.OCR_ENGINE_DISKS.inc(endpoint=endpoint, engine="gemini")
+        else:
+            fallback_indices.append(i)
+
+    if fallback_indices:
+        if gemini_client is not None:
+            metrics.GEMINI_FALLBACKS.inc(len(fallback_indices), endpoint=endpoint)
+        fallback_grays = [images_gray[i] for i in fallback_indices]
+        easyocr_started = time.perf_counter()
+        if OCR_BATCHED:
+            # One contiguous chunk of disks per worker, each searched as a batch
+            n_chunks = min(OCR_WORKERS, len(fallback_grays))
+            bounds = np.linspace(0, len(fallback_grays), n_chunks + 1).astype(int)
+            chunks = [fallback_grays[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+            fallback_results = [
+                result for chunk_results in ocr_map(lambda chunk: extract_medicine_easyocr_batched(chunk, lexicon=lexicon), chunks)
+                for result in chunk_results
+            ]
+        else:
+            fallback_results = ocr_map(lambda gray: extract_medicine_easyocr(gray, lexicon=lexicon), fallback_grays)
+        easyocr_seconds = time.perf_counter() - easyocr_started
+        metrics.STAGE_SECONDS.observe(easyocr_seconds, stage="ocr_easyocr")
+        ocr_log.info(
+            "EasyOCR fallback for %d disk(s) (batched=%s, workers=%s)", len(fallback_indices), OCR_BATCHED, OCR_WORKERS,
+            extra={"duration_ms": round(easyocr_seconds * 1000, 1)},
+        )
+        metrics.OCR_ENGINE_DISKS.inc(len(fallback_indices), endpoint=endpoint, engine="easyocr")
+        for i, result in zip(fallback_indices, fallback_results):
+            results[i] = result
+            engines[i] = "easyocr"
+            ocr_log.debug("EasyOCR: %r (conf: %s, angle: %s, angles tried: %s)", *result, extra={"disk": i})
+
+    if ocr_cache is not None:
+        for i, engine in enumerate(engines):
+            text, confidence = results[i][:2]
+            if engine and text != "Unknown" and confidence >= OCR_CACHE_MIN_CONF:
+                ocr_cache.put(hashes[i][0], text, confidence, engine)
+
+    return results
+
+# Zone diameter from the YOLO zone box ("bbox"), or from radial intensity
+# profiles around the disk ("radial", zone_profile.measure_zones). A radial
+# measurement is only used when enough rays found an edge and they agree;
+# otherwise the zone falls back to its box.
+ZONE_MEASUREMENT = os.getenv("ZONE_MEASUREMENT", "bbox").strip().lower()
+try:
+    ZONE_RAYS = max(8, int(os.getenv("ZONE_RAYS", "72")))
+    ZONE_MIN_COVERAGE = float(os.getenv("ZONE_MIN_COVERAGE", "0.5"))
+    ZONE_MAX_SPREAD_MM = float(os.getenv("ZONE_MAX_SPREAD_MM", "2.0"))
+except (ValueError, TypeError):
+    ZONE_RAYS, ZONE_MIN_COVERAGE, ZONE_MAX_SPREAD_MM = 72, 0.5, 2.0
+
+def radial_zone_usable(measured):
+    return measured is not None and measured["coverage"] >= ZONE_MIN_COVERAGE and measured["spread_mm"] <= ZONE_MAX_SPREAD_MM
 
 def calculate_diameter_mm(bbox, image_width_px, pixels_per_mm=10):
     """Calculate diameter using hybrid geometric approach."""
@@ -349,114 +1198,396 @@ def calculate_diameter_mm(bbox, image_width_px, pixels_per_mm=10):
     avg_size_px = (d_diam + d_area) / 2
     return avg_size_px / pixels_per_mm
 
-def analyze_disk_image(image_path: str):
+def assign_zones_to_disks(zone_bboxes, disk_bboxes, gate=None):
+    """
+    One-to-one zone/disk pairing minimising the total centre distance
+    (Hungarian assignment). Pairs whose distance exceeds gate x the zone's
+    radius are dropped. Returns the disk index per zone, -1 when unmatched.
+    """
+    gate = ZONE_MATCH_GATE if gate is None else gate
+    assignment = np.full(len(zone_bboxes), -1, dtype=int)
+    if len(zone_bboxes) == 0 or len(disk_bboxes) == 0:
+        return assignment.tolist()
+    zones = np.asarray(zone_bboxes, dtype=np.float64).reshape(-1, 4)
+    disks = np.asarray(disk_bboxes, dtype=np.float64).reshape(-1, 4)
+    zone_centres = (zones[:, :2] + zones[:, 2:]) / 2
+    disk_centres = (disks[:, :2] + disks[:, 2:]) / 2
+    distances = np.linalg.norm(zone_centres[:, None, :] - disk_centres[None, :, :], axis=2)
+    limits = gate * (zones[:, 2] - zones[:, 0] + zones[:, 3] - zones[:, 1]) / 4
+
+    # Out-of-gate pairs get a cost no in-gate pairing can outweigh
+    allowed = distances <= limits[:, None]
+    cost = np.where(allowed, distances, distances.max() * len(zones) + 1.0)
+    rows, cols = linear_sum_assignment(cost)
+    keep = allowed[rows, cols]
+    assignment[rows[keep]] = cols[keep]
+    return assignment.tolist()
+
+def decode_image_bytes(data):
+    """Decode an uploaded image (bytes) to a BGR ndarray; None if it is not a readable image."""
+    if not data:
+        return None
+    with metrics.timed("decode"):
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+_REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+class PlateImage:
+    """
+    An encoded upload decoded at two resolutions, each on first use.
+
+    - detection: decoded with JPEG DCT-domain scaling (IMREAD_REDUCED_COLOR_*),
+      keeping the long side >= DETECTION_MIN_SIDE; scale maps its coordinates
+      back to the original.
+    - full: full-resolution decode, only needed for the disk crops and the
+      annotated result image.
+    Both decodes honour EXIF orientation.
+    """
+
+    def __init__(self, data, min_side=None):
+        self.data = data
+        self.min_side = DETECTION_MIN_SIDE if min_side is None else min_side
+        self._buffer = np.frombuffer(data, dtype=np.uint8) if data else None
+        self._full = None
+        self._detection = None
+        self.factor = 1
+        self._size = None
+        try:
+            # Header only: size and EXIF orientation without decoding pixels
+            header = Image.open(io.BytesIO(data))
+            width, height = header.size
+            if header.getexif().get(0x0112) in (5, 6, 7, 8):
+                width, height = height, width
+            self._size = (width, height)
+        except Exception:
+            # Not a format PIL knows: decode at full resolution (factor 1)
+            return
+        if self.min_side:
+            for factor in (8, 4, 2):
+                if max(self._size) / factor >= self.min_side:
+                    self.factor = factor
+                    break
+
+    @classmethod
+    def from_decoded(cls, full, detection=None):
+        """A PlateImage over arrays decoded elsewhere (the API process, via shared memory)."""
+        image = cls(b"")
+        image._full = full
+        image._detection = full if detection is None else detection
+        image._size = (full.shape[1], full.shape[0])
+        image.factor = round(full.shape[1] / image._detection.shape[1])
+        return image
+
+    @property
+    def full(self):
+        if self._full is None and self._buffer is not None:
+            with metrics.timed("decode"):
+                self._full = cv2.imdecode(self._buffer, cv2.IMREAD_COLOR)
+        return self._full
+
+    @property
+    def detection(self):
+        if self._detection is None and self._buffer is not None:
+            if self.factor == 1:
+                self._detection = self.full
+            else:
+                with metrics.timed("decode"):
+                    self._detection = cv2.imdecode(self._buffer, _REDUCED_FLAGS[self.factor])
+        return self._detection
+
+    @property
+    def size(self):
+        """(width, height) of the full-resolution image, after EXIF rotation."""
+        if self._size is None and self.detection is not None:
+            self._size = (self.detection.shape[1], self.detection.shape[0])
+        return self._size
+
+    @property
+    def scale(self):
+        """(sx, sy) from detection-image pixels to full-resolution pixels."""
+        detection = self.detection
+        if detection is None:
+            return 1.0, 1.0
+        return self.size[0] / detection.shape[1], self.size[1] / detection.shape[0]
+
+def load_image(image):
+    """Accept a decoded BGR ndarray as is, a PlateImage (full resolution), or read an image path."""
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, PlateImage):
+        return image.full
+    return cv2.imread(image)
+
+def prepare_disk_crop(img, disk_bbox):
+    """Crop and mask a disk, returning (color 640x640 crop, Pipeline 4 binary for EasyOCR)."""
+    with metrics.timed("crop"):
+        crop_640 = crop_and_pad_640(img, disk_bbox)
+        gray_crop = cv2.cvtColor(crop_640, cv2.COLOR_BGR2GRAY) if len(crop_640.shape) == 3 else crop_640
+    with metrics.timed("preprocess"):
+        return crop_640, preprocess(gray_crop, PREPROCESS_PIPELINE)
+
+def learn_disk_template(image_path, disk_bbox, antibiotic_id, code):
+    """
+    Add a user-confirmed disk to the template bank and the OCR cache.
+    disk_bbox is the disk's bbox in the original image; code is the printed
+    code of the confirmed antibiotic (e.g. "MEM 10").
+    """
+    if template_bank is None and ocr_cache is None:
+        return False
+    img = load_image(image_path)
+    if img is None:
+        return False
+    _, processed_crop = prepare_disk_crop(img, disk_bbox)
+    if template_bank is not None:
+        template_bank.add(disk_signature(processed_crop), antibiotic_id, code)
+    if ocr_cache is not None:
+        ocr_cache.put(disk_phashes(processed_crop)[0], code, 1.0, "confirmed")
+    return True
+
+def refresh_learned():
+    """Pick up templates and confirmed OCR results another process (the API) wrote since they were loaded."""
+    for tier in (template_bank, ocr_cache):
+        if tier is not None:
+            tier.refresh()
+
+def detect_yolo(detection_img, sx=1.0, sy=1.0):
+    """YOLO disks and zones: ([{"bbox", "confidence"}], [...]) with boxes scaled by (sx, sy)."""
+    detected_disks = []
+    detected_zones = []
+    result = run_detector(detection_img)
+    if result is not None and result.boxes is not None:
+        for box in result.boxes:
+            class_id = int(box.cls[0].cpu().numpy())
+            class_name = result.names[class_id]
+            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
+            # Back to original-image coordinates
+            bbox = [float(x1) * sx, float(y1) * sy, float(x2) * sx, float(y2) * sy]
+            conf = float(box.conf[0].cpu().numpy())
+
+            if class_name.lower() == "antibiotic":
+                detected_disks.append({"bbox": bbox, "confidence": conf})
+            elif class_name.lower() in ["disk_zone", "disk-zone"]:
+                detected_zones.append({"bbox": bbox, "confidence": conf})
+    return detected_disks, detected_zones
+
+def detect_hough(detection_img, sx=1.0, sy=1.0):
+    """
+    Classical disk detection without the neural detector.
+
+    cv2.HoughCircles runs on a grey, median-blurred copy (long side at most
+    HOUGH_MAX_SIDE). Circles are kept when their radius is within 25% of the
+    median radius and at least half of their inner area is bright, unsaturated
+    paper; their radii are then re-measured at the disk rim and zones measured
+    radially around them (zone_profile) at detection resolution.
+
+    Returns (disks, zones, confidence). Disks and zones have the YOLO path's
+    {"bbox", "confidence"} form in original-image coordinates, and each zone
+    also carries its "radial" measurement; disks without a visible zone get
+    none, like unpaired YOLO disks. confidence in [0, 1] is the mean disk
+    confidence (paper fraction; halved when a visible zone could not be
+    measured), scaled by the share of Hough circles that passed the filters.
+    """
+    h, w = detection_img.shape[:2]
+    scale = min(1.0, HOUGH_MAX_SIDE / max(h, w))
+    small = cv2.resize(detection_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else detection_img
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    gray = cv2.medianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), 5)
+    short = min(gray.shape)
+    min_r, max_r = (max(3, int(f * short)) for f in HOUGH_RADIUS_RANGE)
+    circles = cv2.HoughCircles(
+        gray, cv2.HOUGH_GRADIENT, dp=1.2, minDist=4 * min_r,
+        param1=100, param2=HOUGH_PARAM2, minRadius=min_r, maxRadius=max_r,
+    )
+    if circles is None:
+        return [], [], 0.0
+    circles = circles[0]
+
+    # Median-radius filter, then the paper check on the inner 80% of each disk
+    median_r = np.median(circles[:, 2])
+    paper = (hsv[:, :, 1] < 60) & (hsv[:, :, 2] > 150)
+    yy, xx = np.ogrid[:gray.shape[0], :gray.shape[1]]
+    kept = []
+    for x, y, r in circles:
+        if not 0.75 * median_r <= r <= 1.25 * median_r:
+            continue
+        x0, x1, y0, y1 = int(max(0, x - r)), int(min(gray.shape[1], x + r + 1)), int(max(0, y - r)), int(min(gray.shape[0], y + r + 1))
+        inside = (xx[:, x0:x1] - x) ** 2 + (yy[y0:y1] - y) ** 2 <= (0.8 * r) ** 2
+        fraction = float(paper[y0:y1, x0:x1][inside].mean()) if inside.any() else 0.0
+        if fraction >= 0.5:
+            kept.append((x / scale, y / scale, r / scale, fraction))
+    if not kept:
+        return [], [], 0.0
+
+    # Hough radii are quantised at the reduced size; the rim at full detection resolution sets the mm scale
+    radii = zone_profile.refine_disk_radii(detection_img, [k[:3] for k in kept], rays=ZONE_RAYS)
+    kept = [(cx, cy, float(r), fraction) for (cx, cy, _, fraction), r in zip(kept, radii)]
+    measured = zone_profile.measure_zones(detection_img, [k[:3] for k in kept], rays=ZONE_RAYS)
+    disks, zones, scores = [], [], []
+    for (cx, cy, r, fraction), m in zip(kept, measured):
+        disks.append({"bbox": [(cx - r) * sx, (cy - r) * sy, (cx + r) * sx, (cy + r) * sy], "confidence": round(fraction, 3)})
+        if radial_zone_usable(m):
+            zone_r = r * m["diameter_mm"] / zone_profile.DISK_DIAMETER_MM
+            zones.append({
+                "bbox": [(cx - zone_r) * sx, (cy - zone_r) * sy, (cx + zone_r) * sx, (cy + zone_r) * sy],
+                "confidence": m["coverage"],
+                "radial": m,
+            })
+        # A disk with no visible zone at all is a reading too; a zone whose edge was not found is not
+        scores.append(fraction if radial_zone_usable(m) or m["contrast"] < zone_profile.MIN_CONTRAST else fraction / 2)
+    confidence = float(np.mean(scores)) * len(kept) / len(circles)
+    return disks, zones, round(confidence, 3)
+
+
+def detect_plate(detection_img, sx=1.0, sy=1.0, mode=None):
+    """
+    Disks and zones of a plate for DETECTION_MODE (or mode), as
+    ([{"bbox", "confidence"}], [...]) in original-image coordinates.
+    """
+    mode = mode or DETECTION_MODE
+    hough = None
+    if mode in ("hough", "auto"):
+        with metrics.timed("detect_hough"):
+            hough = detect_hough(detection_img, sx, sy)
+        if mode == "hough" or hough[2] >= HOUGH_MIN_CONFIDENCE:
+            metrics.DETECTIONS.inc(endpoint=metrics.endpoint(), detector="hough")
+            return hough[:2]
+        log.debug("Hough confidence %s below %s, running YOLO", hough[2], HOUGH_MIN_CONFIDENCE)
+    if get_detector() is None:
+        log.warning("YOLO detector unavailable, using Hough detection")
+        if hough is None:
+            with metrics.timed("detect_hough"):
+                hough = detect_hough(detection_img, sx, sy)
+        metrics.DETECTIONS.inc(endpoint=metrics.endpoint(), detector="hough")
+        return hough[:2]
+    metrics.DETECTIONS.inc(endpoint=metrics.endpoint(), detector="yolo")
+    return detect_yolo(detection_img, sx, sy)
+
+def analyze_disk_image(image, lexicon=None):
+    """
+    Detect zones and disks, OCR every disk and measure each zone.
+    image is a decoded BGR ndarray (decode_image_bytes), an image path, or a
+    PlateImage: then detection runs on its reduced decode and only the disk
+    crops read full-resolution pixels.
+    With a lexicon (build_ocr_lexicon) results also carry the decoded antibiotic_id.
+    """
     detected_zones = []
     detected_disks = []
-    if not model: return detected_zones
 
     try:
-        img = cv2.imread(image_path)
-        if img is None: return detected_zones
-        image_height, image_width = img.shape[:2]
-        results = model(image_path, conf=0.1)
-        
-        if results and len(results) > 0:
-            result = results[0]
-            if result.boxes is not None:
-                for box in result.boxes:
-                    class_id = int(box.cls[0].cpu().numpy())
-                    class_name = result.names[class_id]
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                    bbox = [float(x1), float(y1), float(x2), float(y2)]
-                    conf = float(box.conf[0].cpu().numpy())
-                    
-                    if class_name.lower() == "antibiotic":
-                        detected_disks.append({"bbox": bbox, "confidence": conf})
-                    elif class_name.lower() in ["disk_zone", "disk-zone"]:
-                        detected_zones.append({"bbox": bbox, "confidence": conf})
+        if isinstance(image, PlateImage):
+            detection_img = image.detection
+            if detection_img is None: return detected_zones
+            (image_width, image_height), (sx, sy) = image.size, image.scale
+        else:
+            detection_img = load_image(image)
+            if detection_img is None: return detected_zones
+            image_height, image_width = detection_img.shape[:2]
+            sx = sy = 1.0
+        detected_disks, detected_zones = detect_plate(detection_img, sx, sy)
+
+        # 1. Pair zones and disks one-to-one
+        zone_disk_indices = assign_zones_to_disks(
+            [zone['bbox'] for zone in detected_zones], [disk['bbox'] for disk in detected_disks]
+        )
+
+        used_disk_indices = set(idx for idx in zone_disk_indices if idx >= 0)
 
+        # 2. OCR every disk of the plate exactly once, in one plate-level pass
+        ocr_disk_indices = [idx for idx in zone_disk_indices if idx >= 0]
+        ocr_disk_indices += [idx for idx in range(len(detected_disks)) if idx not in used_disk_indices]
+        # Full-resolution pixels are only needed for the disk crops
+        img = load_image(image) if ocr_disk_indices else None
+        crops = ocr_map(lambda idx: prepare_disk_crop(img, detected_disks[idx]['bbox']), ocr_disk_indices)
+        crops_color = [crop_640 for crop_640, _ in crops]
+        crops_processed = [processed_crop for _, processed_crop in crops]
+
+        # Radial zone measurement for every paired disk, as one batch of profiles
+        # (Hough zones come already measured)
+        radial = {}
+        paired = [idx for zone, idx in zip(detected_zones, zone_disk_indices) if idx >= 0 and "radial" not in zone]
+        if ZONE_MEASUREMENT == "radial" and paired:
+            with metrics.timed("measure"):
+                measured = zone_profile.measure_zones(
+                    img, [zone_profile.disk_circle(detected_disks[idx]['bbox']) for idx in paired], rays=ZONE_RAYS
+                )
+            radial = dict(zip(paired, measured))
+
+        disk_ocr = {}
+        for idx, (medicine_name, ocr_conf, _, angles_tried) in zip(
+            ocr_disk_indices, extract_medicine_ocr_plate(crops_processed, images_original=crops_color, lexicon=lexicon)
+        ):
+            if medicine_name == "Unknown" or ocr_conf < 0.3:
+                medicine_name = f"Disk_{idx + 1}"
+                metrics.DISK_FALLBACKS.inc(endpoint=metrics.endpoint())
+                ocr_conf = 0.0
+            disk_ocr[idx] = (medicine_name, ocr_conf, angles_tried)
+
+        # 3. Assemble per-zone results, then the disks no zone claimed
         results_with_medicine = []
-        used_disk_indices = set()
-        
-        for zone_idx, zone_data in enumerate(detected_zones):
+        for zone_data, disk_idx in zip(detected_zones, zone_disk_indices):
             zone_bbox = zone_data['bbox']
             current_pixels_per_mm = PIXELS_PER_MM
             medicine_name = "Unknown"
             ocr_conf = 0.0
+            angles_tried = 0
             disk_used_idx = -1
             
             if detected_disks:
-                min_dist = float('inf')
-                nearest_idx = -1
-                zx = (zone_bbox[0] + zone_bbox[2]) / 2
-                zy = (zone_bbox[1] + zone_bbox[3]) / 2
-                
-                for idx, disk in enumerate(detected_disks):
-                    dx = (disk['bbox'][0] + disk['bbox'][2]) / 2
-                    dy = (disk['bbox'][1] + disk['bbox'][3]) / 2
-                    dist = np.sqrt((zx - dx)**2 + (zy - dy)**2)
-                    if dist < min_dist:
-                        min_dist = dist
-                        nearest_idx = idx
-                
-                if nearest_idx >= 0:
-                    disk_bbox = detected_disks[nearest_idx]['bbox']
-                    disk_used_idx = nearest_idx
-                    used_disk_indices.add(nearest_idx)
+                if disk_idx >= 0:
+                    disk_bbox = detected_disks[disk_idx]['bbox']
+                    disk_used_idx = disk_idx
                     disk_avg_px = ((disk_bbox[2] - disk_bbox[0]) + (disk_bbox[3] - disk_bbox[1])) / 2
                     if disk_avg_px > 0:
-                        current_pixels_per_mm = disk_avg_px / 6.35
-                    
-                    # Crop and mask the disk area
-                    crop_640 = crop_and_pad_640(img, disk_bbox)
-                    gray_crop = cv2.cvtColor(crop_640, cv2.COLOR_BGR2GRAY) if len(crop_640.shape) == 3 else crop_640
-                    
-                    # Use Pipeline 4 for the EasyOCR path (within extract_medicine_ocr)
-                    processed_crop = preprocess_pipeline_4(gray_crop)
-                    medicine_name, ocr_conf, _ = extract_medicine_ocr(processed_crop, image_original=crop_640)
-                    
-                    if medicine_name == "Unknown" or ocr_conf < 0.3:
-                        medicine_name = f"Disk_{nearest_idx + 1}"
-                        ocr_conf = 0.0
+                        current_pixels_per_mm = disk_avg_px / zone_profile.DISK_DIAMETER_MM
+                    medicine_name, ocr_conf, angles_tried = disk_ocr[disk_idx]
             else:
                 medicine_name = "Unknown_Disk"
             
             diameter_mm = calculate_diameter_mm(zone_bbox, image_width, pixels_per_mm=current_pixels_per_mm)
+            measured = zone_data.get("radial") or radial.get(disk_idx)
+            if radial_zone_usable(measured):
+                diameter_mm = measured["diameter_mm"]
             results_with_medicine.append({
                 "medicine_name": medicine_name,
                 "diameter_mm": round(diameter_mm, 2),
+                "zone_measurement": "radial" if radial_zone_usable(measured) else "bbox",
+                "zone_spread_mm": measured["spread_mm"] if measured else None,
                 "ocr_confidence": ocr_conf,
+                "ocr_angles_tried": angles_tried,
+                "antibiotic_id": lexicon["id_by_code"].get(medicine_name) if lexicon else None,
                 "yolo_confidence": round(zone_data['confidence'], 3),
                 "disk_used_idx": disk_used_idx,
-                "bbox": zone_bbox
+                "bbox": zone_bbox,
+                "disk_bbox": detected_disks[disk_used_idx]['bbox'] if disk_used_idx >= 0 else None
             })
 
         for idx, disk in enumerate(detected_disks):
             if idx not in used_disk_indices:
-                crop_640 = crop_and_pad_640(img, disk['bbox'])
-                gray_crop = cv2.cvtColor(crop_640, cv2.COLOR_BGR2GRAY) if len(crop_640.shape) == 3 else crop_640
-                processed_crop = preprocess_pipeline_4(gray_crop)
-                medicine_name, ocr_conf, _ = extract_medicine_ocr(processed_crop, image_original=crop_640)
-                if medicine_name == "Unknown" or ocr_conf < 0.3:
-                    medicine_name = f"Disk_{idx + 1}"
-                    ocr_conf = 0.0
+                medicine_name, ocr_conf, angles_tried = disk_ocr[idx]
                 results_with_medicine.append({
                     "medicine_name": medicine_name,
                     "diameter_mm": 0.0,
+                    "zone_measurement": None,
+                    "zone_spread_mm": None,
                     "ocr_confidence": ocr_conf,
+                    "ocr_angles_tried": angles_tried,
+                    "antibiotic_id": lexicon["id_by_code"].get(medicine_name) if lexicon else None,
                     "yolo_confidence": round(disk['confidence'], 3),
                     "disk_used_idx": idx,
-                    "bbox": disk['bbox']
+                    "bbox": disk['bbox'],
+                    "disk_bbox": disk['bbox']
                 })
         return results_with_medicine
     except Exception as e:
-        print(f"Error during analysis: {e}")
+        log.exception("Error during analysis: %s", e)
         return detected_zones
 
-def draw_detections_on_image(image_path: str, detected_zones: list, output_dir: str = "uploaded_images"):
+def draw_detections_on_image(image, detected_zones: list, output_dir: str = "uploaded_images"):
     try:
-        img = cv2.imread(image_path)
+        img = load_image(image)
         if img is None: return None
+        # Draw on a copy; a decoded upload may still be in use by the caller
+        img = img.copy()
         for zone in detected_zones:
             bbox = zone.get('bbox', [])
             if not bbox or len(bbox) < 4: continue
@@ -0,0 +1,302 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from starlette.concurrency import run_in_threadpool
+
+import analysis
+import logs
+import metrics
+import profiler
+
+log = logs.get_logger("worker")
+
+try:
+    # Worker processes for /analyze; 0 runs the analysis in the API process (threadpool)
+    ANALYSIS_WORKERS = max(0, int(os.getenv("ANALYSIS_WORKERS", "0")))
+    # torch/OpenCV threads per worker; 0 splits the CPUs evenly between workers
+    ANALYSIS_TORCH_THREADS = max(0, int(os.getenv("ANALYSIS_TORCH_THREADS", "0")))
+    # OCR pool threads (each with its own EasyOCR reader) inside each worker
+    ANALYSIS_WORKER_OCR_THREADS = max(1, int(os.getenv("ANALYSIS_WORKER_OCR_THREADS", "1")))
+    # Shared-memory slots for decoded images (0 sends encoded bytes); one slot holds one plate
+    ANALYSIS_SHM_SLOTS = max(0, int(os.getenv("ANALYSIS_SHM_SLOTS", "4")))
+    # 64 MB fits a 12 MP (4032x3024) BGR photo plus its half-size detection decode
+    ANALYSIS_SHM_SLOT_MB = max(1, int(os.getenv("ANALYSIS_SHM_SLOT_MB", "64")))
+except (ValueError, TypeError):
+    ANALYSIS_WORKERS, ANALYSIS_TORCH_THREADS, ANALYSIS_WORKER_OCR_THREADS = 0, 0, 1
+    ANALYSIS_SHM_SLOTS, ANALYSIS_SHM_SLOT_MB = 4, 64
+
+
+class SharedImageRing:
+    """
+    Ring of pre-allocated shared-memory slots owned by the API process.
+
+    write() copies one or more decoded arrays (a plate's full-resolution and
+    detection decodes) into a free slot and returns a small handle (slot name,
+    offset, shape and dtype of each array) that pickles in bytes; a worker maps
+    them back with attach_image() as ndarrays over the same memory, without
+    copying. The slot stays reserved until release().
+    """
+
+    def __init__(self, slots, slot_bytes):
+        self.slot_bytes = slot_bytes
+        self._blocks = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(slots)]
+        self._free = queue.SimpleQueue()
+        for index in range(slots):
+            self._free.put(index)
+
+    def write(self, *images):
+        """Handle for images in a free slot, or None if they do not fit or every slot is busy."""
+        arrays, offset = [], 0
+        for image in images:
+            arrays.append((offset, image.shape, image.dtype.str))
+            # Keep each array cache-line aligned
+            offset += -(-image.nbytes // 64) * 64
+        if offset > self.slot_bytes:
+            return None
+        try:
+            index = self._free.get_nowait()
+        except queue.Empty:
+            return None
+        block = self._blocks[index]
+        for image, (start, shape, dtype) in zip(images, arrays):
+            np.copyto(np.ndarray(shape, dtype=image.dtype, buffer=block.buf, offset=start), image)
+        return {"index": index, "name": block.name, "arrays": arrays}
+
+    def release(self, handle):
+        self._free.put(handle["index"])
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+# Slots mapped by this worker process, by shared-memory name
+_attached = {}
+
+
+def attach_image(handle, part=0):
+    """
+    ndarray view of the part-th array in a SharedImageRing slot (no copy).
+    Valid until the API releases the slot.
+    """
+    block = _attached.get(handle["name"])
+    if block is None:
+        # The API process owns and unlinks the slots; a worker's resource tracker must not
+        if sys.version_info >= (3, 13):
+            block = shared_memory.SharedMemory(name=handle["name"], track=False)
+        else:
+            block = shared_memory.SharedMemory(name=handle["name"])
+            resource_tracker.unregister(block._name, "shared_memory")
+        _attached[handle["name"]] = block
+    offset, shape, dtype = handle["arrays"][part]
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, offset=offset)
+
+
+def analyze_image(image, lexicon=None, output_dir="uploaded_images", endpoint="/analyze", plate_id=None):
+    """Analyze and draw one decoded plate image. Returns (analysis_results, result_image_url)."""
+    token = metrics.current_endpoint.set(endpoint)
+    plate_token = logs.current_plate.set(plate_id)
+    try:
+        started = time.perf_counter()
+        results = analysis.analyze_disk_image(image, lexicon=lexicon)
+        log.info("Analysis returned %d zones", len(results), extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)})
+        # Forces the full-resolution decode when no disk needed it (counted as decode, not render)
+        analysis.load_image(image)
+        started = time.perf_counter()
+        with metrics.timed("render"):
+            result_image_url = analysis.draw_detections_on_image(image, results, output_dir)
+        log.debug("Visualization image saved to %s", result_image_url, extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)})
+        return results, result_image_url
+    finally:
+        logs.current_plate.reset(plate_token)
+        metrics.current_endpoint.reset(token)
+
+
+def analyze_upload(data, lexicon=None, output_dir="uploaded_images", endpoint="/analyze", plate_id=None):
+    """
+    Analyze an uploaded plate; None if data is not a readable image.
+    Detection uses a reduced decode; full resolution is decoded once, for the disk crops and drawing.
+    """
+    image = analysis.PlateImage(data)
+    if image.detection is None:
+        return None
+    return analyze_image(image, lexicon, output_dir, endpoint, plate_id)
+
+
+def decode_upload(data):
+    """
+    PlateImage of an upload with its detection and full-resolution decodes
+    done, ready for a SharedImageRing; None if data is not a readable image.
+    """
+    image = analysis.PlateImage(data)
+    if image.detection is None or image.full is None:
+        return None
+    return image
+
+
+def analyze_shared(handle, lexicon=None, output_dir="uploaded_images", endpoint="/analyze", plate_id=None):
+    """
+    analyze_image on a plate decoded into a SharedImageRing slot, read in place.
+    A second array in the slot is the reduced decode detection runs on.
+    """
+    arrays = [attach_image(handle, part) for part in range(len(handle["arrays"]))]
+    image = arrays[0] if len(arrays) == 1 else analysis.PlateImage.from_decoded(*arrays)
+    return analyze_image(image, lexicon, output_dir, endpoint, plate_id)
+
+
+def _in_worker(profile, fn, *args):
+    """Run fn on a worker; ship back the metrics it recorded and, if asked, its profile."""
+    session = profiler.SamplingProfiler().start() if profile else None
+    try:
+        # Templates and confirmed results are learned in the API process (PUT /results)
+        analysis.refresh_learned()
+        outcome = fn(*args)
+    finally:
+        if session is not None:
+            session.stop()
+    return outcome, metrics.REGISTRY.drain(), session.export() if session is not None else None
+
+
+def _init_worker(torch_threads, ocr_threads):
+    """Runs once per worker process: size the thread pools, then load and warm the models."""
+    import cv2
+    import torch
+
+    logs.configure()
+    torch.set_num_threads(torch_threads)
+    cv2.setNumThreads(torch_threads)
+    analysis.OCR_WORKERS = ocr_threads
+    # One plate at a time per worker: waiting for a YOLO batch window would only add latency
+    analysis.detector_batcher = None
+    analysis.registry.warm_up()
+    log.info("Worker ready (torch threads=%d, OCR threads=%d)", torch_threads, ocr_threads)
+
+
+def _ping():
+    return os.getpid()
+
+
+class AnalysisPool:
+    """
+    Pool of analysis worker processes, each loading YOLO and EasyOCR once at boot.
+
+    With shared-memory slots, the API decodes a plate once (full resolution
+    and, when DETECTION_MIN_SIDE allows, the reduced detection decode) into a
+    SharedImageRing slot and workers analyze it in place. Without them (or
+    when every slot is busy) plates go as encoded upload bytes and are decoded
+    by the worker. The API process only awaits the result, so its event loop
+    and threadpool stay free for other endpoints. With workers=0 the analysis
+    runs in the API process's threadpool instead.
+    """
+
+    def __init__(self, workers=0, torch_threads=0, ocr_threads=1, shm_slots=0, shm_slot_bytes=64 << 20):
+        self.workers = workers
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // max(1, workers))
+        self.ocr_threads = ocr_threads
+        self.shm_slots = shm_slots if workers else 0
+        self.shm_slot_bytes = shm_slot_bytes
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "shared_memory": 0, "bytes": 0}
+        self._executor = None
+        self._ring = None
+        self._boot = []
+
+    @property
+    def shared_memory(self):
+        """True when plates should be decoded by the API and passed through shared memory."""
+        return bool(self.shm_slots)
+
+    def start(self):
+        """Spawn the workers now and let them warm up in the background."""
+        if self.workers and self._executor is None:
+            # spawn, not fork: forking a process with torch/OpenMP threads is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.torch_threads, self.ocr_threads),
+            )
+            self._boot = [self._executor.submit(_ping) for _ in range(self.workers)]
+            if self.shm_slots:
+                self._ring = SharedImageRing(self.shm_slots, self.shm_slot_bytes)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+
+    def ready(self):
+        # A task can only run on a worker whose initializer (warm-up) has finished
+        return bool(self._boot) and all(f.done() and not f.exception() for f in self._boot)
+
+    async def run(self, data, lexicon=None, output_dir="uploaded_images", image=None, endpoint="/analyze", profile=None, plate_id=None):
+        """
+        analyze_upload on a worker process (or the threadpool when workers=0).
+        image, the already decoded upload (a PlateImage or an ndarray), is sent
+        through a shared-memory slot when one is free.
+        profile, a running SamplingProfiler of the request, also gets the worker's samples.
+        plate_id tags the analysis's log records.
+        """
+        self.stats["submitted"] += 1
+        handle = None
+        if self._ring is not None and image is not None:
+            if isinstance(image, analysis.PlateImage):
+                arrays = (image.full,) if image.factor == 1 else (image.full, image.detection)
+            else:
+                arrays = (image,)
+            handle = self._ring.write(*arrays)
+        try:
+            if self._executor is None:
+                outcome = await run_in_threadpool(analyze_upload, data, lexicon, output_dir, endpoint, plate_id)
+            else:
+                if handle is not None:
+                    self.stats["shared_memory"] += 1
+                    task = (analyze_shared, handle, lexicon, output_dir, endpoint, plate_id)
+                else:
+                    self.stats["bytes"] += 1
+                    task = (analyze_upload, data, lexicon, output_dir, endpoint, plate_id)
+                try:
+                    future = self._executor.submit(_in_worker, profile is not None, *task)
+                except Exception:
+                    if handle is not None:
+                        self._ring.release(handle)
+                    raise
+                if handle is not None:
+                    # Released when the worker is done with it, not when this request stops
+                    # waiting: a cancelled request cannot stop a task already running in a worker
+                    ring = self._ring
+                    future.add_done_callback(lambda _: ring.release(handle))
+                outcome, worker_metrics, worker_profile = await asyncio.wrap_future(future)
+                metrics.REGISTRY.merge(worker_metrics)
+                if worker_profile is not None:
+                    profile.add(worker_profile, prefix="analysis-worker")
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        self.stats["completed"] += 1
+        return outcome
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats["workers"] = self.workers
+        stats["torch_threads"] = self.torch_threads if self.workers else None
+        stats["in_flight"] = stats["submitted"] - stats["completed"] - stats["failed"]
+        return stats
+
+
+analysis_pool = AnalysisPool(
+    ANALYSIS_WORKERS, ANALYSIS_TORCH_THREADS, ANALYSIS_WORKER_OCR_THREADS,
+    shm_slots=ANALYSIS_SHM_SLOTS, shm_slot_bytes=ANALYSIS_SHM_SLOT_MB << 20,
+)
@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching in front of a batch function.
+
+    Callers submit single items from any thread. A dedicated worker thread takes
+    the first queued item, keeps collecting until `window_ms` has passed or
+    `max_batch` items are waiting, then makes one `batch_fn(items)` call (which
+    must return one result per item) and resolves each caller's Future. Only the
+    worker thread ever calls batch_fn, so the model behind it is never used by
+    two threads at once. When a batch call fails, its items are retried one at
+    a time, so only the items that fail on their own get the exception.
+    """
+
+    def __init__(self, batch_fn, max_batch=8, window_ms=20.0, name="micro-batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self.name = name
+        self.stats = {"items": 0, "batches": 0, "max_batch_seen": 0, "split_batches": 0, "failed_items": 0}
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        """Queue one item; returns a Future resolving to its result."""
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """Submit and wait for the result (re-raises batch_fn errors)."""
+        return self.submit(item).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _call(self, items):
+        results = self.batch_fn(items)
+        if len(results) != len(items):
+            raise RuntimeError(f"{self.name}: batch_fn returned {len(results)} results for {len(items)} items")
+        return results
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            split, failed = False, 0
+            try:
+                results = self._call(items)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    failed = 1
+                else:
+                    # One bad item must not fail the requests that happened to share its batch
+                    split = True
+                    for item, future in batch:
+                        try:
+                            future.set_result(self._call([item])[0])
+                        except Exception as item_error:
+                            future.set_exception(item_error)
+                            failed += 1
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            with self._stats_lock:
+                self.stats["items"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["max_batch_seen"] = max(self.stats["max_batch_seen"], len(batch))
+                self.stats["split_batches"] += split
+                self.stats["failed_items"] += failed
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["queued"] = self._queue.qsize()
+        stats["mean_batch"] = round(stats["items"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
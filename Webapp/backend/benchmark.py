@@ -0,0 +1,506 @@
+"""
+Stage-level benchmark of the plate analysis pipeline.
+
+    python benchmark.py run --images uploaded_images --out bench.json
+    python benchmark.py run --synthetic 8 --models stub --out base.json
+    python benchmark.py compare base.json bench.json --threshold 10
+
+Each image goes through every stage in isolation (decode, YOLO and Hough
+detection, crop, preprocess, one OCR angle, plate OCR, radial zone
+measurement, antibiotic matching, draw, DB write), then end-to-end through
+analyze_disk_image and the /analyze handler. Times are reported as
+p50/p95/p99 per stage; a separate tracemalloc pass records peak and net
+allocations per stage (kept apart so tracing does not skew the timings).
+
+Without YOLO weights or EasyOCR (or with --models stub) both are replaced by
+stubs, so the suite runs offline and measures the pipeline around the models.
+The OCR cache, template bank and Gemini are switched off, and the database
+work runs on a temporary copy of senior_project.db.
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+
+import zone_profile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+# Stage order in reports
+STAGES = (
+    "decode", "decode_full", "detect", "detect_hough", "crop", "preprocess", "ocr_angle", "ocr_plate",
+    "measure", "match", "draw", "db_write", "analyze", "handler",
+)
+
+
+# ==========================================
+# Stub models
+# ==========================================
+
+class _Array:
+    """Just enough of a torch tensor for analyze_disk_image (.cpu().numpy())."""
+
+    def __init__(self, values):
+        self._values = np.asarray(values)
+
+    def __getitem__(self, index):
+        return _Array(self._values[index])
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._values
+
+
+class _Box:
+    def __init__(self, cls, xyxy, conf):
+        self.cls = _Array([cls])
+        self.xyxy = _Array([xyxy])
+        self.conf = _Array([conf])
+
+
+class _Result:
+    names = {0: "antibiotic", 1: "disk_zone"}
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class StubDetector:
+    """
+    Stand-in for the YOLO detector: bright, unsaturated (white), roughly round
+    blobs are disks and each gets a zone 2.5 times its size. Called like
+    YOLO(images, conf=...).
+    """
+
+    def __init__(self, min_fraction=0.02, max_fraction=0.25):
+        self.min_fraction = min_fraction
+        self.max_fraction = max_fraction
+
+    def detect(self, img):
+        if img.ndim == 3:
+            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+            bright = ((hsv[..., 1] < 50) & (hsv[..., 2] > 150)).astype(np.uint8) * 255
+        else:
+            bright = cv2.threshold(img, 200, 255, cv2.THRESH_BINARY)[1]
+        h, w = bright.shape
+        count, _, stats, _ = cv2.connectedComponentsWithStats(bright)
+        boxes = []
+        for x, y, bw, bh, area in stats[1:count]:
+            side = max(bw, bh)
+            if not (self.min_fraction * min(h, w) <= side <= self.max_fraction * min(h, w)):
+                continue
+            if not 0.7 <= bw / bh <= 1.4 or area < 0.5 * bw * bh:
+                continue
+            cx, cy, r = x + bw / 2, y + bh / 2, side * 1.25
+            boxes.append(_Box(0, [x, y, x + bw, y + bh], 0.9))
+            boxes.append(_Box(1, [max(0, cx - r), max(0, cy - r), min(w, cx + r), min(h, cy + r)], 0.8))
+        return _Result(boxes)
+
+    def __call__(self, images, conf=None, verbose=False):
+        if isinstance(images, np.ndarray):
+            images = [images]
+        return [self.detect(img) for img in images]
+
+
+class StubReader:
+    """Stand-in for easyocr.Reader that reads every crop as the same disk code."""
+
+    def __init__(self, text="MEM 10", conf=0.9):
+        self.text = text
+        self.conf = conf
+
+    def readtext(self, img, **kwargs):
+        return [([[0, 0], [1, 0], [1, 1], [0, 1]], self.text, self.conf)]
+
+    def readtext_batched(self, images, **kwargs):
+        return [self.readtext(img) for img in images]
+
+
+def install_models(analysis, mode):
+    """Load the real models or install stubs; returns {"detector": ..., "ocr": ...} naming what runs."""
+    used = {}
+    detector = None
+    if mode != "stub" and os.path.exists(analysis.MODEL_PATH):
+        detector = analysis.get_detector()
+    if detector is None:
+        if mode == "real":
+            raise SystemExit("--models real: the YOLO detector could not be loaded")
+        analysis.model = StubDetector()
+    used["detector"] = "real" if detector is not None else "stub"
+
+    # EasyOCR downloads its weights on first use; only try it when they are already on disk
+    easyocr_dir = os.getenv("EASYOCR_MODULE_PATH", os.path.expanduser("~/.EasyOCR"))
+    have_easyocr = os.path.exists(os.path.join(easyocr_dir, "model", "craft_mlt_25k.pth"))
+    reader = analysis.get_ocr_reader() if mode == "real" or (mode == "auto" and have_easyocr) else None
+    if reader is None:
+        if mode == "real":
+            raise SystemExit("--models real: EasyOCR could not be loaded")
+        analysis.ocr_reader = StubReader()
+        analysis._create_reader = StubReader
+    used["ocr"] = "real" if reader is not None else "stub"
+    return used
+
+
+# ==========================================
+# Image set
+# ==========================================
+
+def load_image_set(images_dir, synthetic, limit):
+    """[(name, encoded bytes)] from a directory, or synthetic plates when synthetic > 0."""
+    if synthetic:
+        import synthetic_plates
+
+        return [
+            (f"synthetic_{i}.jpg", synthetic_plates.encode_plate(synthetic_plates.render_plate(i)[0]))
+            for i in range(synthetic)
+        ]
+    paths = sorted(
+        p for p in glob.glob(os.path.join(images_dir, "*"))
+        if p.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(p).startswith("detection_result_")
+    )[:limit]
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append((os.path.basename(path), f.read()))
+    return images
+
+
+# ==========================================
+# Measurement
+# ==========================================
+
+class StageRecorder:
+    """Per-stage wall times, or (with trace=True) tracemalloc peak / net bytes."""
+
+    def __init__(self):
+        self.times = defaultdict(list)
+        self.allocs = defaultdict(list)
+        self.trace = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            yield
+            current, peak = tracemalloc.get_traced_memory()
+            self.allocs[name].append((peak - before, current - before))
+        else:
+            start = time.perf_counter()
+            yield
+            self.times[name].append(time.perf_counter() - start)
+
+    def summary(self):
+        stages = {}
+        for name in sorted(set(self.times) | set(self.allocs), key=lambda n: STAGES.index(n) if n in STAGES else len(STAGES)):
+            ms = np.array(self.times.get(name, []), dtype=float) * 1000
+            entry = {"count": int(ms.size)}
+            if ms.size:
+                entry.update({
+                    "mean_ms": round(float(ms.mean()), 3),
+                    "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                    "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                    "p99_ms": round(float(np.percentile(ms, 99)), 3),
+                    "max_ms": round(float(ms.max()), 3),
+                })
+            allocs = self.allocs.get(name)
+            if allocs:
+                entry["alloc_peak_kb"] = round(max(peak for peak, _ in allocs) / 1024, 1)
+                entry["alloc_net_kb"] = round(float(np.mean([net for _, net in allocs])) / 1024, 1)
+            stages[name] = entry
+        return stages
+
+
+class BenchmarkContext:
+    """Temporary database, upload directory and /analyze client shared by every image."""
+
+    def __init__(self, workdir, microbe_name=None):
+        import main
+        import models
+        from fastapi import Depends
+        from fastapi.testclient import TestClient
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+
+        self.main = main
+        self.upload_dir = os.path.join(workdir, "uploaded_images")
+        os.makedirs(self.upload_dir, exist_ok=True)
+        db_path = os.path.join(workdir, "benchmark.db")
+        source_db = os.path.join(BASE_DIR, "senior_project.db")
+        if os.path.exists(source_db):
+            shutil.copyfile(source_db, db_path)
+            # The checked-in database may predate the newest PlateResults columns
+            import alter_table
+            alter_table.main(db_path, verbose=False)
+        self.engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+
+        self.db = self.Session()
+        user = models.User(email=f"benchmark-{os.getpid()}@localhost", password_hash="-", full_name="Benchmark")
+        self.db.add(user)
+        self.db.commit()
+        self.user = user
+        user_id = user.user_id
+        if microbe_name is None:
+            microbe = self.db.query(models.Microbe).first()
+            microbe_name = microbe.strain_name if microbe else "Escherichia coli"
+        self.microbe_name = microbe_name
+        microbe = self.db.query(models.Microbe).filter(models.Microbe.strain_name == microbe_name).first()
+        self.microbe_id = microbe.microbe_id if microbe else None
+        self.lexicon = main.build_request_lexicon(self.db, microbe_name)
+
+        def get_db():
+            db = self.Session()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        def get_current_user(db=Depends(main.get_db)):
+            return db.get(models.User, user_id)
+
+        self._upload_dir = main.UPLOAD_DIR
+        main.UPLOAD_DIR = self.upload_dir
+        main.app.dependency_overrides[main.get_db] = get_db
+        main.app.dependency_overrides[main.get_current_user] = get_current_user
+        self.client = TestClient(main.app)
+
+    def close(self):
+        self.main.app.dependency_overrides.clear()
+        self.main.UPLOAD_DIR = self._upload_dir
+        self.db.close()
+        self.engine.dispose()
+
+
+def _disk_bboxes(result, scale):
+    sx, sy = scale
+    bboxes = []
+    for box in result.boxes if result is not None and result.boxes is not None else []:
+        if result.names[int(box.cls[0].cpu().numpy())].lower() == "antibiotic":
+            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
+            bboxes.append([float(x1) * sx, float(y1) * sy, float(x2) * sx, float(y2) * sy])
+    return bboxes
+
+
+def bench_image(analysis, crud, rec, ctx, name, data):
+    """Run every stage, then the end-to-end paths, once on one encoded image."""
+    with rec.stage("decode"):
+        plate = analysis.PlateImage(data)
+        detection_img = plate.detection
+    if detection_img is None:
+        return
+    with rec.stage("decode_full"):
+        full = analysis.decode_image_bytes(data)
+    with rec.stage("detect"):
+        result = analysis._detect_batch([detection_img])[0]
+    with rec.stage("detect_hough"):
+        analysis.detect_hough(detection_img, *plate.scale)
+
+    crops, processed = [], []
+    reader = analysis.get_ocr_reader()
+    disk_bboxes = _disk_bboxes(result, plate.scale)
+    for bbox in disk_bboxes:
+        with rec.stage("crop"):
+            crop = analysis.crop_and_pad_640(full, bbox)
+        gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        with rec.stage("preprocess"):
+            binary = analysis.preprocess(gray, analysis.PREPROCESS_PIPELINE)
+        with rec.stage("ocr_angle"):
+            reader.readtext(analysis.rotate_image(binary, 45), detail=1)
+        crops.append(crop)
+        processed.append(binary)
+    if processed:
+        with rec.stage("ocr_plate"):
+            analysis.extract_medicine_ocr_plate(processed, images_original=crops, lexicon=ctx.lexicon)
+        with rec.stage("measure"):
+            zone_profile.measure_zones(full, [zone_profile.disk_circle(bbox) for bbox in disk_bboxes], rays=analysis.ZONE_RAYS)
+
+    with rec.stage("analyze"):
+        results = analysis.analyze_disk_image(analysis.PlateImage(data), lexicon=ctx.lexicon)
+    for res in results:
+        with rec.stage("match"):
+            crud.get_best_antibiotic_match(ctx.db, query=res.get("medicine_name", "Unknown"), microbe_id=ctx.microbe_id)
+    with rec.stage("draw"):
+        result_image_url = analysis.draw_detections_on_image(full, results, ctx.upload_dir)
+    with rec.stage("db_write"):
+        ctx.main.store_analysis(
+            ctx.db, ctx.user, ctx.microbe_name, None,
+            os.path.join(ctx.upload_dir, name), results, result_image_url,
+        )
+    with rec.stage("handler"):
+        response = ctx.client.post(
+            "/analyze", files={"file": (name, data, "image/jpeg")}, data={"microbe_name": ctx.microbe_name},
+        )
+    if response.status_code != 200:
+        print(f"/analyze returned {response.status_code} for {name}: {response.text[:200]}", file=sys.stderr)
+
+
+@contextlib.contextmanager
+def quiet_pipeline():
+    """Hide the pipeline's stdout and its log records below WARNING."""
+    logging.disable(logging.INFO)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def run(args):
+    import analysis
+    import crud
+
+    images = load_image_set(args.images, args.synthetic, args.limit)
+    if not images:
+        raise SystemExit(f"No images found in {args.images} (use --synthetic N for generated plates)")
+
+    # Isolate the pipeline: no cached or remote OCR results
+    analysis.ocr_cache = None
+    analysis.template_bank = None
+    analysis.gemini_client = None
+    used = install_models(analysis, args.models)
+
+    rec = StageRecorder()
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    quiet = quiet_pipeline() if not args.verbose else contextlib.nullcontext()
+    try:
+        with quiet:
+            ctx = BenchmarkContext(workdir, args.microbe)
+            try:
+                for _ in range(args.warmup):
+                    for name, data in images:
+                        bench_image(analysis, crud, StageRecorder(), ctx, name, data)
+                for _ in range(args.repeat):
+                    for name, data in images:
+                        bench_image(analysis, crud, rec, ctx, name, data)
+                if not args.no_alloc:
+                    rec.trace = True
+                    tracemalloc.start()
+                    try:
+                        for name, data in images:
+                            bench_image(analysis, crud, rec, ctx, name, data)
+                    finally:
+                        tracemalloc.stop()
+            finally:
+                ctx.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "models": used,
+            "images": len(images),
+            "source": "synthetic" if args.synthetic else os.path.abspath(args.images),
+            "repeat": args.repeat,
+            "config": {
+                "PREPROCESS_PIPELINE": analysis.PREPROCESS_PIPELINE,
+                "DETECTION_MIN_SIDE": analysis.DETECTION_MIN_SIDE,
+                "DETECTION_MODE": analysis.DETECTION_MODE,
+                "ZONE_MEASUREMENT": analysis.ZONE_MEASUREMENT,
+                "OCR_WORKERS": analysis.OCR_WORKERS,
+                "OCR_BATCHED": analysis.OCR_BATCHED,
+                "YOLO_BATCHING": analysis.YOLO_BATCHING,
+            },
+        },
+        "stages": rec.summary(),
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    print_report(report)
+    return report
+
+
+def print_report(report):
+    meta = report["meta"]
+    print(f"{meta['images']} image(s) x {meta['repeat']}, models: {meta['models']}")
+    print(f"{'stage':<12} {'n':>5} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'peak KB':>10} {'net KB':>10}")
+    for name, s in report["stages"].items():
+        print(f"{name:<12} {s['count']:>5} {s.get('p50_ms', 0):>10.2f} {s.get('p95_ms', 0):>10.2f} "
+              f"{s.get('p99_ms', 0):>10.2f} {s.get('alloc_peak_kb', 0):>10.1f} {s.get('alloc_net_kb', 0):>10.1f}")
+
+
+def compare(base, new, threshold=10.0, metric="p50_ms"):
+    """
+    Per-stage change of metric between two reports, in percent.
+    Returns (rows, regressions): rows are (stage, base, new, change_pct).
+    """
+    rows, regressions = [], []
+    for name in list(base["stages"]) + [n for n in new["stages"] if n not in base["stages"]]:
+        old_value = base["stages"].get(name, {}).get(metric)
+        new_value = new["stages"].get(name, {}).get(metric)
+        change = None
+        if old_value and new_value is not None:
+            change = round((new_value - old_value) / old_value * 100, 1)
+            if change > threshold:
+                regressions.append(name)
+        rows.append((name, old_value, new_value, change))
+    return rows, regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="benchmark every stage over an image set")
+    run_parser.add_argument("--images", default=os.path.join(BASE_DIR, "uploaded_images"))
+    run_parser.add_argument("--synthetic", type=int, default=0, help="use N generated plates instead of --images")
+    run_parser.add_argument("--limit", type=int, default=20)
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--warmup", type=int, default=1)
+    run_parser.add_argument("--models", choices=("auto", "real", "stub"), default="auto")
+    run_parser.add_argument("--microbe", default=None, help="strain name for lexicon, matching and DB writes")
+    run_parser.add_argument("--no-alloc", action="store_true", help="skip the tracemalloc pass")
+    run_parser.add_argument("--out", default=None, help="write the report as JSON")
+    run_parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own logging")
+
+    compare_parser = sub.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--metric", default="p50_ms", choices=("mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"))
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="percent slowdown that counts as a regression")
+    compare_parser.add_argument("--fail-on-regression", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+        return
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows, regressions = compare(base, new, args.threshold, args.metric)
+    print(f"{'stage':<12} {'base':>10} {'new':>10} {'change':>9}   ({args.metric})")
+    for name, old_value, new_value, change in rows:
+        fmt = lambda v: f"{v:>10.2f}" if v is not None else f"{'-':>10}"
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:<12} {fmt(old_value)} {fmt(new_value)} {f'{change:+.1f}%' if change is not None else '-':>9}{flag}")
+    if regressions and args.fail_on_regression:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -41,8 +41,11 @@ def create_analysis_batch(db: Session, batch: schemas.AnalysisBatchBase, user_id
     db.refresh(db_batch)
     return db_batch
 
-def create_plate(db: Session, plate: schemas.PlateBase, batch_id: str):
+def create_plate(db: Session, plate: schemas.PlateBase, batch_id: str, plate_id: str = None):
     db_plate = models.Plate(**plate.dict(), batch_id=batch_id)
+    if plate_id:
+        # Assigned before analysis so its log records carry the same id
+        db_plate.plate_id = plate_id
     db.add(db_plate)
     db.commit()
     db.refresh(db_plate)
@@ -189,6 +192,24 @@ def get_best_antibiotic_match(db: Session, query: str, microbe_id: int):
 
     return None
 
+def get_ocr_lexicon(db: Session, microbe_id: int = None):
+    """
+    Antibiotics a disk can be decoded to (see analysis.build_ocr_lexicon).
+    With microbe_id, narrowed to antibiotics that have a disk diffusion breakpoint
+    for that microbe; falls back to every antibiotic when there are none.
+    """
+    query = db.query(models.Antibiotic).filter(
+        models.Antibiotic.abbreviation.isnot(None),
+        models.Antibiotic.abbreviation != ""
+    )
+    if microbe_id is not None:
+        narrowed = query.join(models.BreakpointDiskDiffusion).filter(
+            models.BreakpointDiskDiffusion.microbe_id == microbe_id
+        ).distinct().order_by(models.Antibiotic.antibiotic_id).all()
+        if narrowed:
+            return narrowed
+    return query.order_by(models.Antibiotic.antibiotic_id).all()
+
 def get_all_antibiotics(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Antibiotic).offset(skip).limit(limit).all()
 
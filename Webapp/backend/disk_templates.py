@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class TemplateBank:
+    """
+    Disk templates learned from user-confirmed results, matched by rotation-invariant NCC.
+
+    Templates are polar signatures (rows = angle, columns = radius, see
+    analysis.disk_signature). Rotating a disk circularly shifts its signature's
+    rows, so the normalized cross-correlation for every rotation at once is one
+    FFT product along the angle axis. Templates persist in a SQLite file and are
+    loaded into memory on first use; refresh() reloads them when another
+    process (the API learning from PUT /results) has changed the file.
+    """
+
+    def __init__(self, path, max_per_code=20):
+        self.path = path
+        self.max_per_code = max_per_code
+        self._lock = threading.Lock()
+        self._conn = None
+        self._labels = []  # (antibiotic_id, code) per template
+        self._spectra = None  # (n_templates, angles // 2 + 1, radii) complex
+        self._shape = None
+        self._row_ids = []
+        self._data_version = None
+
+    def _connect(self):
+        if self._conn is None and self.path:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS disk_templates ("
+                "template_id INTEGER PRIMARY KEY AUTOINCREMENT, antibiotic_id INTEGER NOT NULL, "
+                "code TEXT NOT NULL, angles INTEGER NOT NULL, radii INTEGER NOT NULL, "
+                "signature BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+            self._load()
+        return self._conn
+
+    def _load(self):
+        self._labels, self._spectra, self._shape, self._row_ids = [], None, None, []
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        rows = self._conn.execute(
+            "SELECT template_id, antibiotic_id, code, angles, radii, signature FROM disk_templates "
+            "ORDER BY template_id"
+        ).fetchall()
+        for template_id, antibiotic_id, code, angles, radii, blob in rows:
+            signature = np.frombuffer(blob, dtype=np.float32).reshape(angles, radii)
+            self._append(template_id, antibiotic_id, code, signature)
+
+    def refresh(self):
+        """Reload the templates if another connection committed to the file since they were read."""
+        with self._lock:
+            if self._conn is None:
+                return False
+            # data_version only moves for commits made through other connections
+            if self._conn.execute("PRAGMA data_version").fetchone()[0] == self._data_version:
+                return False
+            self._load()
+            return True
+
+    @staticmethod
+    def _normalize(signature):
+        signature = np.asarray(signature, dtype=np.float32)
+        centered = signature - signature.mean()
+        norm = np.linalg.norm(centered)
+        return centered / norm if norm > 0 else None
+
+    def _append(self, row_id, antibiotic_id, code, signature):
+        if self._shape is not None and signature.shape != self._shape:
+            return
+        self._shape = signature.shape
+        spectrum = np.fft.rfft(signature, axis=0)[None]
+        self._spectra = spectrum if self._spectra is None else np.concatenate([self._spectra, spectrum])
+        self._labels.append((antibiotic_id, code))
+        self._row_ids.append(row_id)
+
+    def add(self, signature, antibiotic_id, code):
+        """Store a confirmed disk signature; keeps the newest max_per_code per antibiotic."""
+        normalized = self._normalize(signature)
+        if normalized is None:
+            return False
+        with self._lock:
+            conn = self._connect()
+            row_id = None
+            if conn is not None:
+                cur = conn.execute(
+                    "INSERT INTO disk_templates (antibiotic_id, code, angles, radii, signature, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (antibiotic_id, code, *normalized.shape, normalized.tobytes(), time.time()),
+                )
+                row_id = cur.lastrowid
+            self._append(row_id, antibiotic_id, code, normalized)
+
+            owned = [i for i, (ab_id, _) in enumerate(self._labels) if ab_id == antibiotic_id]
+            stale = owned[:max(0, len(owned) - self.max_per_code)]
+            if stale:
+                if conn is not None:
+                    conn.executemany(
+                        "DELETE FROM disk_templates WHERE template_id = ?",
+                        [(self._row_ids[i],) for i in stale],
+                    )
+                keep = [i for i in range(len(self._labels)) if i not in set(stale)]
+                self._spectra = self._spectra[keep]
+                self._labels = [self._labels[i] for i in keep]
+                self._row_ids = [self._row_ids[i] for i in keep]
+            if conn is not None:
+                conn.commit()
+        return True
+
+    def match(self, signature):
+        """
+        Best template for a signature over all rotations.
+        Returns (antibiotic_id, code, score, runner_up_score, angle_degrees) or
+        None when the bank is empty. runner_up_score is the best score of any
+        other antibiotic, for margin checks; None while the bank holds a single
+        antibiotic, when there is nothing to measure a margin against.
+        """
+        query = self._normalize(signature)
+        with self._lock:
+            self._connect()
+            if query is None or self._spectra is None or query.shape != self._shape:
+                return None
+            spectra, labels = self._spectra, list(self._labels)
+
+        angles = query.shape[0]
+        cross = (np.fft.rfft(query, axis=0)[None] * np.conj(spectra)).sum(axis=2)
+        correlation = np.fft.irfft(cross, n=angles, axis=1)
+        shifts = correlation.argmax(axis=1)
+        scores = correlation[np.arange(len(labels)), shifts]
+
+        best = int(scores.argmax())
+        best_id = labels[best][0]
+        others = [s for s, (ab_id, _) in zip(scores, labels) if ab_id != best_id]
+        angle = float(shifts[best]) * 360.0 / angles
+        runner_up = float(max(others)) if others else None
+        return best_id, labels[best][1], float(scores[best]), runner_up, angle
+
+    def __len__(self):
+        with self._lock:
+            self._connect()
+            return len(self._labels)
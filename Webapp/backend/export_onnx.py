@@ -0,0 +1,111 @@
+"""
+Export the zone/disk detector to ONNX, optionally with static INT8 quantization.
+
+    python export_onnx.py                          # models/yolo_best.onnx (float32)
+    python export_onnx.py --int8 --calib-dir uploaded_images
+                                                   # + models/yolo_best_int8.onnx
+
+Serve the result with DETECTOR_BACKEND=onnx (see analysis.py). Requires the
+onnx and onnxruntime packages (pip install -r requirements-onnx.txt).
+"""
+import argparse
+import glob
+import os
+
+import cv2
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_WEIGHTS = os.path.join(BASE_DIR, "models", "yolo_best.pt")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def letterbox(img, size=640):
+    """Resize keeping the aspect ratio and pad to size x size, as Ultralytics does (gray 114 border)."""
+    h, w = img.shape[:2]
+    scale = min(size / h, size / w)
+    nh, nw = int(round(h * scale)), int(round(w * scale))
+    resized = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top, left = (size - nh) // 2, (size - nw) // 2
+    out = np.full((size, size, 3), 114, dtype=np.uint8)
+    out[top:top + nh, left:left + nw] = resized
+    return out
+
+
+def to_input_tensor(img, size=640):
+    """BGR image -> float32 NCHW RGB tensor in [0, 1], the exported model's input."""
+    boxed = letterbox(img, size)
+    return np.ascontiguousarray(boxed[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+
+
+def calibration_images(calib_dir, limit):
+    paths = sorted(
+        p for p in glob.glob(os.path.join(calib_dir, "*"))
+        if p.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(p).startswith("detection_result_")
+    )
+    return paths[:limit]
+
+
+def export_float(weights, imgsz):
+    """Export with a dynamic batch axis so the micro-batcher can send several plates at once."""
+    from ultralytics import YOLO
+
+    return YOLO(weights).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+
+
+def quantize_int8(fp32_path, int8_path, calib_paths, imgsz):
+    """Static QDQ INT8 quantization calibrated on real plate photos."""
+    from onnxruntime.quantization import (
+        CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static,
+    )
+    import onnxruntime as ort
+
+    input_name = ort.InferenceSession(fp32_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+
+    class PlateReader(CalibrationDataReader):
+        def __init__(self):
+            self._paths = iter(calib_paths)
+
+        def get_next(self):
+            for path in self._paths:
+                img = cv2.imread(path)
+                if img is not None:
+                    return {input_name: to_input_tensor(img, imgsz)}
+            return None
+
+    quantize_static(
+        fp32_path,
+        int8_path,
+        PlateReader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+        calibrate_method=CalibrationMethod.MinMax,
+    )
+    return int8_path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--weights", default=DEFAULT_WEIGHTS)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--int8", action="store_true", help="also write a static INT8 model")
+    parser.add_argument("--calib-dir", default=os.path.join(BASE_DIR, "uploaded_images"))
+    parser.add_argument("--calib-limit", type=int, default=200)
+    args = parser.parse_args()
+
+    fp32_path = export_float(args.weights, args.imgsz)
+    print(f"Exported {fp32_path}")
+
+    if args.int8:
+        calib_paths = calibration_images(args.calib_dir, args.calib_limit)
+        if not calib_paths:
+            raise SystemExit(f"No calibration images found in {args.calib_dir}")
+        int8_path = os.path.splitext(fp32_path)[0] + "_int8.onnx"
+        quantize_int8(fp32_path, int8_path, calib_paths, args.imgsz)
+        print(f"Quantized {int8_path} on {len(calib_paths)} calibration image(s)")
+
+
+if __name__ == "__main__":
+    main()
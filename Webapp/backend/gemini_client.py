@@ -0,0 +1,260 @@
+import asyncio
+import base64
+import threading
+import time
+
+import httpx
+
+import logs
+import metrics
+
+log = logs.get_logger("gemini")
+
+
+# Values of the zone_analyzer_gemini_breaker_state gauge
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitBreaker:
+    """
+    Time-based circuit breaker.
+
+    - closed: calls go through; `failure_threshold` consecutive failures (or one
+      quota error) open it.
+    - open: calls are rejected until `recovery_time` seconds have passed, then
+      it half-opens.
+    - half_open: a single probe call goes through; success closes the breaker,
+      failure opens it again for another `recovery_time`.
+    """
+
+    def __init__(self, failure_threshold=3, recovery_time=60.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self._set_state("closed")
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.GEMINI_BREAKER_STATE.set(BREAKER_STATES[state])
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.recovery_time:
+                self._set_state("half_open")
+                self._probe_in_flight = False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._set_state("closed")
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release(self):
+        """Give back a half-open probe slot for a call that never reached the API."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self, trip=False):
+        with self._lock:
+            self.failures += 1
+            if trip or self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                self._set_state("open")
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = max(0.0, self.recovery_time - (time.monotonic() - self.opened_at)) if self.state == "open" else 0.0
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "trips": self.trips,
+                "retry_in_s": round(retry_in, 1),
+            }
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, max_wait=None):
+        """Take one token, sleeping until one is available. False if that would exceed max_wait."""
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                return False
+            # Reserve the token now so concurrent callers queue behind it
+            self.tokens -= 1
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+
+class GeminiClient:
+    """
+    Asyncio client for the Gemini generateContent REST API.
+
+    Calls run on a private event loop in a background thread, so the
+    synchronous analysis code can submit several at once (generate_many) and
+    wait with a bounded latency. Every call passes the circuit breaker, the
+    token bucket (at most `timeout` seconds of queueing) and a semaphore of
+    `max_concurrency` in-flight requests, and is cut off after `timeout` seconds.
+    Returns None instead of raising, so callers fall back to local OCR.
+    """
+
+    def __init__(self, api_key, model="gemini-2.0-flash", endpoint="https://generativelanguage.googleapis.com",
+                 max_concurrency=4, rate_per_minute=15, burst=5, timeout=20.0,
+                 failure_threshold=3, recovery_time=60.0):
+        self.api_key = api_key
+        self.model = model
+        self.endpoint = endpoint.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, recovery_time)
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst)
+        self.stats = {"calls": 0, "successes": 0, "failures": 0, "timeouts": 0, "rejected": 0, "rate_limited": 0}
+        self._loop = None
+        self._client = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True).start()
+        return self._loop
+
+    def _url(self):
+        return f"{self.endpoint}/v1beta/models/{self.model}:generateContent"
+
+    @staticmethod
+    def _payload(prompt, image_bytes, mime_type, json_response):
+        payload = {"contents": [{"role": "user", "parts": [
+            {"text": prompt},
+            {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode("ascii")}},
+        ]}]}
+        if json_response:
+            payload["generationConfig"] = {"responseMimeType": "application/json"}
+        return payload
+
+    @staticmethod
+    def _response_text(data):
+        candidates = data.get("candidates") or []
+        if not candidates:
+            return ""
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts).strip()
+
+    async def _generate(self, prompt, image_bytes, mime_type="image/jpeg", json_response=False):
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            metrics.GEMINI_REJECTED.inc()
+            return None
+        if not await self.bucket.acquire(max_wait=self.timeout):
+            self.stats["rate_limited"] += 1
+            self.breaker.release()
+            return None
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            self.stats["calls"] += 1
+            try:
+                response = await asyncio.wait_for(
+                    self._client.post(self._url(), params={"key": self.api_key},
+                                      json=self._payload(prompt, image_bytes, mime_type, json_response)),
+                    timeout=self.timeout,
+                )
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                self.breaker.record_failure()
+                log.warning("Gemini request timed out after %ss", self.timeout)
+                return None
+            except httpx.HTTPError as e:
+                self.stats["failures"] += 1
+                self.breaker.record_failure()
+                log.warning("Gemini API error: %s", e)
+                return None
+
+        if response.status_code == 429 or "resource_exhausted" in response.text[:500].lower():
+            self.stats["failures"] += 1
+            self.breaker.record_failure(trip=True)
+            log.warning("Gemini quota exceeded, pausing Gemini for %ss", self.breaker.recovery_time)
+            return None
+        if response.status_code >= 500:
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            log.warning("Gemini API error: HTTP %s", response.status_code)
+            return None
+        if response.status_code >= 400:
+            # A bad request is not an outage; do not count it against the breaker
+            self.stats["failures"] += 1
+            self.breaker.record_success()
+            log.warning("Gemini API error: HTTP %s %s", response.status_code, response.text[:200])
+            return None
+
+        self.stats["successes"] += 1
+        self.breaker.record_success()
+        try:
+            return self._response_text(response.json())
+        except ValueError:
+            return ""
+
+    def generate_many(self, requests):
+        """
+        Run several (prompt, image_bytes, json_response) requests concurrently.
+        Returns the response texts in order, None for failed or rejected calls.
+        """
+        if not requests:
+            return []
+
+        async def run_all():
+            return await asyncio.gather(*(
+                self._generate(prompt, image_bytes, json_response=json_response)
+                for prompt, image_bytes, json_response in requests
+            ))
+
+        future = asyncio.run_coroutine_threadsafe(run_all(), self._ensure_loop())
+        try:
+            # Queueing + the call itself are each capped at timeout
+            return future.result(timeout=self.timeout * 2 + 1)
+        except Exception as e:
+            future.cancel()
+            log.error("Gemini batch error: %s", e)
+            return [None] * len(requests)
+
+    def generate(self, prompt, image_bytes, json_response=False):
+        """Single request; returns the response text or None."""
+        return self.generate_many([(prompt, image_bytes, json_response)])[0]
+
+    def available(self):
+        """False while the breaker is open, so callers can skip encoding work."""
+        snapshot = self.breaker.snapshot()
+        return snapshot["state"] != "open" or snapshot["retry_in_s"] <= 0
+
+    def snapshot(self):
+        """Breaker state and call counters, for /ocr/stats."""
+        return {"breaker": self.breaker.snapshot(), **dict(self.stats)}
@@ -0,0 +1,147 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT = "zone_analyzer"
+
+# Default level, and per-stage overrides such as "ocr=DEBUG,gemini=WARNING"
+# (stages: api, worker, analysis, ocr, gemini, models)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper() or "INFO"
+LOG_STAGE_LEVELS = os.getenv("LOG_STAGE_LEVELS", "").strip()
+# json (one object per line) or text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+try:
+    # Records waiting for the writer thread; beyond this they are dropped, never waited on
+    LOG_QUEUE_SIZE = max(1, int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+except (ValueError, TypeError):
+    LOG_QUEUE_SIZE = 10000
+
+# Plate the current request or analysis works on; added to every record
+current_plate = contextvars.ContextVar("log_plate_id", default=None)
+
+# LogRecord attributes that are not extra=... fields
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "plate_id"}
+
+_listener = None
+_handler = None
+
+
+def get_logger(stage):
+    """Logger of one pipeline stage; its records carry stage=<stage>."""
+    return logging.getLogger(f"{ROOT}.{stage}")
+
+
+def parse_stage_levels(spec):
+    """{"ocr": logging.DEBUG, ...} from "ocr=DEBUG,gemini=WARNING"; bad entries are skipped."""
+    levels = {}
+    for item in spec.split(","):
+        stage, _, level = item.partition("=")
+        level = logging.getLevelName(level.strip().upper())
+        if stage.strip() and isinstance(level, int):
+            levels[stage.strip()] = level
+    return levels
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, stage, plate_id, msg and any extra=... fields (e.g. duration_ms)."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "stage": record.name.rpartition(".")[2],
+            "plate_id": getattr(record, "plate_id", None),
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        entry.update(_fields(record))
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        stage = record.name.rpartition(".")[2]
+        plate = getattr(record, "plate_id", None)
+        extra = " ".join(f"{key}={value}" for key, value in _fields(record).items())
+        return f"[{stage.upper()}] {record.getMessage()}" + (f" (plate={plate})" if plate else "") + (f" {extra}" if extra else "")
+
+
+class _PlateFilter(logging.Filter):
+    def filter(self, record):
+        # Runs in the calling thread, where the request's context is visible
+        if not hasattr(record, "plate_id"):
+            record.plate_id = current_plate.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of blocking the caller."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure(stream=None):
+    """
+    Route the zone_analyzer loggers through a queue to a background writer thread.
+
+    Callers only format the message and enqueue the record; the JSON encoding
+    and the write to stream (stdout by default) happen on the listener thread,
+    so a slow or redirected stdout never stalls an analysis. Safe to call again
+    (the first call wins); each worker process calls it for itself.
+    """
+    global _listener, _handler
+    if _listener is not None:
+        return
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    _handler = _QueueHandler(records)
+    _handler.addFilter(_PlateFilter())
+
+    root = logging.getLogger(ROOT)
+    level = logging.getLevelName(LOG_LEVEL)
+    root.setLevel(level if isinstance(level, int) else logging.INFO)
+    root.addHandler(_handler)
+    # Not duplicated through the root logger uvicorn configures
+    root.propagate = False
+    for stage, level in parse_stage_levels(LOG_STAGE_LEVELS).items():
+        get_logger(stage).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Flush queued records and stop the writer thread."""
+    global _listener, _handler
+    if _listener is None:
+        return
+    logging.getLogger(ROOT).removeHandler(_handler)
+    _listener.stop()
+    _listener = _handler = None
+
+
+def dropped():
+    """Records dropped because the queue was full."""
+    return _handler.dropped if _handler is not None else 0
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, Depends, UploadFile, File, HTTPException, Form, status
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, BackgroundTasks, Depends, UploadFile, File, HTTPException, Form, Header, Request, status
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -8,12 +8,20 @@ from sqlalchemy.exc import IntegrityError
 from typing import List
 from datetime import timedelta, datetime
 from jose import JWTError, jwt
-import crud, models, schemas, analysis, auth, interpretation
+import crud, models, schemas, analysis, auth, interpretation, logs, metrics, profiler
+from analysis_workers import analysis_pool, decode_upload
+from starlette.concurrency import run_in_threadpool
 from analysis import draw_detections_on_image
 from database import SessionLocal, engine
-import shutil
 import os
 import uuid
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Structured logs go through a queue to a background writer thread
+logs.configure()
+log = logs.get_logger("api")
 
 # Create tables
 models.Base.metadata.create_all(bind=engine)
@@ -102,9 +110,82 @@ def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 # Directory to save uploaded images
 UPLOAD_DIR = "uploaded_images"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Writes uploaded originals to storage while the analysis runs
+storage_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="storage")
+
+def write_upload(path: str, data: bytes):
+    with open(path, "wb") as buffer:
+        buffer.write(data)
 
 app.mount("/uploaded_images", StaticFiles(directory=UPLOAD_DIR), name="uploaded_images")
 
+@app.on_event("startup")
+def warm_up_models():
+    # Analysis worker processes load their own models; otherwise warm them here, off the request path
+    if analysis_pool.workers:
+        analysis_pool.start()
+    elif analysis.MODEL_WARMUP:
+        analysis.registry.start_background()
+
+@app.on_event("shutdown")
+def stop_analysis_workers():
+    analysis_pool.shutdown()
+
+# Monitoring routes are registered before the SPA catch-all below, which would shadow them
+@app.get("/health/live")
+def health_live():
+    """Process is up (does not wait for models)."""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+def health_ready():
+    """200 once every required model is loaded and warmed, else 503; route analysis traffic on this."""
+    if analysis_pool.workers:
+        ready, failed = analysis_pool.ready(), False
+        content = {"workers": analysis_pool.snapshot()}
+    else:
+        models_status = analysis.registry.status()
+        ready = analysis.registry.ready()
+        failed = any(m["state"] == "failed" for m in models_status.values() if m["required"])
+        content = {"models": models_status}
+    content["status"] = "ready" if ready else "failed" if failed else "starting"
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
+@app.get("/ocr/stats")
+def read_ocr_stats(current_user: models.User = Depends(get_current_user)):
+    """OCR cache hit/miss counters (for sizing OCR_CACHE_SIZE), Gemini client breaker state and YOLO batch sizes."""
+    return {
+        "cache": analysis.ocr_cache.snapshot() if analysis.ocr_cache else None,
+        "gemini": analysis.gemini_client.snapshot() if analysis.gemini_client else None,
+        "detector": analysis.detector_batcher.snapshot() if analysis.detector_batcher else None,
+        "workers": analysis_pool.snapshot(),
+    }
+
+@app.get("/metrics")
+def read_metrics():
+    """Prometheus text exposition: per-stage latency histograms, OCR engine and fallback counters, in-flight analyses."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+def require_profile_token(x_profile_token: str = Header(None)):
+    # Without PROFILE_TOKEN the profiling endpoints do not exist
+    if not profiler.PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not profiler.token_valid(x_profile_token):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+@app.get("/profiles", dependencies=[Depends(require_profile_token)])
+def read_profiles():
+    """Stored request profiles, newest first (duration, samples, peak memory)."""
+    return profiler.list_profiles()
+
+@app.get("/profiles/{plate_id}", dependencies=[Depends(require_profile_token)])
+def read_profile(plate_id: str):
+    """Folded stacks of one profiled /analyze request, for flamegraph.pl or speedscope."""
+    path = profiler.profile_path(plate_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain", filename=f"{plate_id}.folded")
+
 # If frontend build exists, serve it from the same FastAPI app (single-port deploy).
 FRONTEND_BUILD_DIR = os.path.join(os.path.dirname(__file__), "..", "ZoneAnalyzer2", "build")
 FRONTEND_BUILD_DIR = os.path.abspath(FRONTEND_BUILD_DIR)
@@ -127,38 +208,100 @@ def read_microbes(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
 def create_batch(batch: schemas.AnalysisBatchBase, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     return crud.create_analysis_batch(db, batch, current_user.user_id)
 
+def build_request_lexicon(db: Session, microbe_name: str):
+    """Lexicon mode decodes disks straight to Antibiotics rows for this microbe."""
+    if not analysis.OCR_LEXICON_MODE:
+        return None
+    known_microbe = crud.get_microbe_by_name(db, microbe_name)
+    scope_microbe_id = known_microbe.microbe_id if known_microbe and analysis.OCR_LEXICON_SCOPE == "microbe" else None
+    return analysis.build_ocr_lexicon(crud.get_ocr_lexicon(db, microbe_id=scope_microbe_id))
+
 @app.post("/analyze", response_model=schemas.PlateResultResponse)
-def analyze_image(
+async def analyze_image(
+    request: Request,
     file: UploadFile = File(...), 
     microbe_name: str = Form(...), 
     batch_id: str = Form(None), # Optional batch_id
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    # 1. Save File
+    # The plate id is fixed up front so every log record of the request carries it
+    plate_id = models.generate_uuid()
+    plate_token = logs.current_plate.set(plate_id)
+    started = time.perf_counter()
+    # Opt-in profiling: X-Profile-Token header or PROFILE_SAMPLE_RATE (off by default)
+    profile_reason = profiler.should_profile(request.headers)
+    profile = profiler.SamplingProfiler().start() if profile_reason else None
+    try:
+        with metrics.IN_FLIGHT.track(endpoint="/analyze"), metrics.REQUEST_SECONDS.time(endpoint="/analyze"):
+            try:
+                response = await run_analysis(file, microbe_name, batch_id, db, current_user, profile, plate_id)
+            except HTTPException as e:
+                metrics.ANALYSES.inc(endpoint="/analyze", outcome="rejected" if e.status_code < 500 else "error")
+                log.info("/analyze rejected: %s", e.detail, extra={"status": e.status_code})
+                raise
+            except Exception:
+                metrics.ANALYSES.inc(endpoint="/analyze", outcome="error")
+                log.exception("/analyze failed")
+                raise
+            finally:
+                if profile is not None:
+                    profile.stop()
+            metrics.ANALYSES.inc(endpoint="/analyze", outcome="ok")
+        log.info(
+            "/analyze stored %d result(s)", len(response["plate"].results),
+            extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)},
+        )
+        if profile is not None:
+            meta = await run_in_threadpool(profiler.save_profile, plate_id, profile, "/analyze", profile_reason)
+            log.info("Profiled /analyze: %d samples, peak %s KB", meta["samples"], meta["peak_memory_kb"])
+        return response
+    finally:
+        logs.current_plate.reset(plate_token)
+
+async def run_analysis(file: UploadFile, microbe_name: str, batch_id: str, db: Session, current_user, profile=None, plate_id=None):
+    # 1. Read the upload; the original is written to storage in parallel
     file_ext = os.path.splitext(file.filename)[1]
     filename = f"{uuid.uuid4()}{file_ext}"
     file_path = os.path.join(UPLOAD_DIR, filename)
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
 
-    # 2. Run Analysis
+    data = await file.read()
+    image = None
+    if analysis_pool.shared_memory:
+        # Decode once here (detection and full resolution); workers read the arrays in place from shared memory
+        image = await run_in_threadpool(decode_upload, data)
+        if image is None:
+            raise HTTPException(status_code=400, detail="Uploaded file is not a readable image")
+    saved = storage_executor.submit(write_upload, file_path, data)
+
+    # 2. Run Analysis on a worker process: detect, OCR and draw
+    lexicon = await run_in_threadpool(build_request_lexicon, db, microbe_name)
+    error = None
     try:
-        # Pass the file path to the analysis function
-        # This function should be implemented by YOU to return real data
-        analysis_results = analysis.analyze_disk_image(file_path)
-        print(f"[API] Analysis returned {len(analysis_results)} zones")
+        outcome = await analysis_pool.run(data, lexicon, UPLOAD_DIR, image=image, profile=profile, plate_id=plate_id)
     except Exception as e:
+        outcome, error = None, e
+    if outcome is None:
         # Clean up file if analysis fails
+        await asyncio.wrap_future(saved)
         if os.path.exists(file_path):
             os.remove(file_path)
-        raise HTTPException(status_code=500, detail=str(e))
-    
-    # Draw detections on image for visualization
-    result_image_url = draw_detections_on_image(file_path, analysis_results, UPLOAD_DIR)
-    print(f"[API] Visualization image saved to: {result_image_url}")
+        if error is not None:
+            raise HTTPException(status_code=500, detail=str(error))
+        raise HTTPException(status_code=400, detail="Uploaded file is not a readable image")
+    analysis_results, result_image_url = outcome
+
+    # DB work is blocking; keep it off the event loop
+    await asyncio.wrap_future(saved)
+    return await run_in_threadpool(
+        store_analysis, db, current_user, microbe_name, batch_id, file_path, analysis_results, result_image_url, plate_id
+    )
+
+def store_analysis(db: Session, current_user, microbe_name, batch_id, file_path, analysis_results, result_image_url, plate_id=None):
+    with metrics.timed("persist"):
+        return persist_analysis(db, current_user, microbe_name, batch_id, file_path, analysis_results, result_image_url, plate_id)
 
+def persist_analysis(db: Session, current_user, microbe_name, batch_id, file_path, analysis_results, result_image_url, plate_id=None):
     # 3. Save to Database
     # Use Current User
 
@@ -186,7 +329,7 @@ def analyze_image(
         original_image_url=file_path,
         result_image_url=result_image_url if result_image_url else file_path
     )
-    plate = crud.create_plate(db, plate_data, batch.batch_id)
+    plate = crud.create_plate(db, plate_data, batch.batch_id, plate_id=plate_id)
 
     # Get Standard
     clsi_standard = db.query(models.Standard).filter(models.Standard.standard_name == "CLSI").first()
@@ -197,15 +340,20 @@ def analyze_image(
         medicine_name = res.get('medicine_name', 'Unknown')
         diameter = res.get('diameter_mm', 0.0)
         bbox = res.get('bbox', None)
+        disk_bbox = res.get('disk_bbox', None)
         disk_used_idx = res.get('disk_used_idx', None)
         
-        # Try to find antibiotic in database by medicine name
-        ab = crud.get_best_antibiotic_match(db, query=medicine_name, microbe_id=microbe.microbe_id)
+        # Lexicon-decoded disks carry their antibiotic when the read was a near-exact match of an
+        # unambiguous code; otherwise the microbe-aware match picks the row with a breakpoint for this microbe
+        ab = db.get(models.Antibiotic, res['antibiotic_id']) if res.get('antibiotic_id') is not None else None
+        if not ab:
+            with metrics.timed("match"):
+                ab = crud.get_best_antibiotic_match(db, query=medicine_name, microbe_id=microbe.microbe_id)
         
         if ab:
-            print(f"[API] Matched OCR '{medicine_name}' -> antibiotic '{ab.name}' (abbr={ab.abbreviation}, id={ab.antibiotic_id})")
+            log.debug("Matched OCR %r -> antibiotic %r (abbr=%s, id=%s)", medicine_name, ab.name, ab.abbreviation, ab.antibiotic_id)
         else:
-            print(f"[API] No match for OCR '{medicine_name}' -> auto-creating")
+            log.debug("No match for OCR %r -> auto-creating", medicine_name)
         
         if not ab:
             # Fallback names like Disk_1 can repeat; reuse existing row if present.
@@ -242,9 +390,9 @@ def analyze_image(
             bp = crud.get_breakpoint(db, clsi_standard.standard_id, microbe.microbe_id, ab.antibiotic_id)
             if bp:
                 clsi_interp = interpretation.calculate_interpretation(diameter, bp)
-                print(f"[API] CLSI: diameter={diameter}mm S>={bp.susceptible_min_mm} R<={bp.resistant_max_mm} -> {clsi_interp}")
+                log.debug("CLSI: diameter=%smm S>=%s R<=%s -> %s", diameter, bp.susceptible_min_mm, bp.resistant_max_mm, clsi_interp)
             else:
-                print(f"[API] CLSI: No breakpoint for microbe_id={microbe.microbe_id} + antibiotic_id={ab.antibiotic_id}")
+                log.debug("CLSI: No breakpoint for microbe_id=%s + antibiotic_id=%s", microbe.microbe_id, ab.antibiotic_id)
 
         # Calculate EUCAST Interpretation
         eucast_interp = "Unknown"
@@ -252,9 +400,9 @@ def analyze_image(
             bp_eu = crud.get_breakpoint(db, eucast_standard.standard_id, microbe.microbe_id, ab.antibiotic_id)
             if bp_eu:
                 eucast_interp = interpretation.calculate_interpretation(diameter, bp_eu)
-                print(f"[API] EUCAST: diameter={diameter}mm S>={bp_eu.susceptible_min_mm} R<={bp_eu.resistant_max_mm} -> {eucast_interp}")
+                log.debug("EUCAST: diameter=%smm S>=%s R<=%s -> %s", diameter, bp_eu.susceptible_min_mm, bp_eu.resistant_max_mm, eucast_interp)
             else:
-                print(f"[API] EUCAST: No breakpoint for microbe_id={microbe.microbe_id} + antibiotic_id={ab.antibiotic_id}")
+                log.debug("EUCAST: No breakpoint for microbe_id=%s + antibiotic_id=%s", microbe.microbe_id, ab.antibiotic_id)
 
         result_data = schemas.PlateResultBase(
             antibiotic_id=ab.antibiotic_id,
@@ -266,6 +414,10 @@ def analyze_image(
             bbox_x2=float(bbox[2]) if bbox and len(bbox) >= 4 else None,
             bbox_y2=float(bbox[3]) if bbox and len(bbox) >= 4 else None,
             disk_used_idx=int(disk_used_idx) if disk_used_idx is not None else None,
+            disk_x1=float(disk_bbox[0]) if disk_bbox and len(disk_bbox) >= 4 else None,
+            disk_y1=float(disk_bbox[1]) if disk_bbox and len(disk_bbox) >= 4 else None,
+            disk_x2=float(disk_bbox[2]) if disk_bbox and len(disk_bbox) >= 4 else None,
+            disk_y2=float(disk_bbox[3]) if disk_bbox and len(disk_bbox) >= 4 else None,
         )
         crud.create_plate_result(db, result_data, plate.plate_id)
     
@@ -413,8 +565,21 @@ def delete_antibiotic(antibiotic_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=409, detail=str(e))
     return {"message": "Deleted"}
 
+def upload_path(url):
+    """Local path of a stored upload, whether saved as uploaded_images/x.jpg or served as /uploaded_images/x.jpg."""
+    return os.path.join(UPLOAD_DIR, os.path.basename(url))
+
+def learn_confirmed_disk(image_path, disk_bbox, antibiotic_id, code, result_id):
+    try:
+        if analysis.learn_disk_template(image_path, disk_bbox, antibiotic_id, code):
+            log.info("Learned disk template %r from result %s", code, result_id)
+        else:
+            log.warning("Could not learn disk template from result %s (%s)", result_id, image_path)
+    except Exception:
+        log.exception("Learning disk template from result %s failed", result_id)
+
 @app.put("/results/{result_id}", response_model=schemas.PlateResultUpdateResponse)
-def update_result(result_id: str, result_update: schemas.PlateResultUpdate, db: Session = Depends(get_db)):
+def update_result(result_id: str, result_update: schemas.PlateResultUpdate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     # 1. Get existing result
     result = crud.get_plate_result(db, result_id)
     if not result:
@@ -455,6 +620,18 @@ def update_result(result_id: str, result_update: schemas.PlateResultUpdate, db:
         eucast=eucast_interp
     )
 
+    # A user-chosen antibiotic confirms what the disk shows: teach the template bank
+    if result_update.antibiotic_id is not None and result.disk_x1 is not None and plate.original_image_url:
+        ab = db.get(models.Antibiotic, new_ab_id)
+        if ab and (ab.abbreviation or "").strip():
+            abbreviation = ab.abbreviation.strip().upper()
+            code = f"{abbreviation} {ab.concentration_ug}" if ab.concentration_ug else abbreviation
+            disk_bbox = [result.disk_x1, result.disk_y1, result.disk_x2, result.disk_y2]
+            # Reading the original and building the template happen after the response is sent
+            background_tasks.add_task(
+                learn_confirmed_disk, upload_path(plate.original_image_url), disk_bbox, ab.antibiotic_id, code, result_id
+            )
+
     # Reload updated result with antibiotic relationship for frontend display
     updated_result = db.query(models.PlateResult).options(
         joinedload(models.PlateResult.antibiotic),
@@ -484,7 +661,8 @@ def update_result(result_id: str, result_update: schemas.PlateResultUpdate, db:
                 })
 
         if detected_zones:
-            new_result_image_url = draw_detections_on_image(plate.original_image_url, detected_zones, UPLOAD_DIR)
+            with metrics.timed("render"):
+                new_result_image_url = draw_detections_on_image(plate.original_image_url, detected_zones, UPLOAD_DIR)
             if new_result_image_url:
                 plate.result_image_url = new_result_image_url
                 db.commit()
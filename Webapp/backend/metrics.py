@@ -0,0 +1,262 @@
+import contextlib
+import contextvars
+import math
+import threading
+import time
+
+# Endpoint the current analysis runs for; the label of the per-endpoint counters
+current_endpoint = contextvars.ContextVar("metrics_endpoint", default="none")
+
+# Seconds; covers a 2 ms crop up to a 30 s Gemini timeout
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, math.inf)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return [[list(key), v] for key, v in values.items()]
+
+    def merge(self, state):
+        with self._lock:
+            for key, v in state:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0.0) + v
+
+
+class Gauge(_Metric):
+    """Current value; not shipped from worker processes (see Registry.drain)."""
+    kind = "gauge"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0.0)
+
+    @contextlib.contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    samples = Counter.samples
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(set(buckets) | {math.inf}))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return sum(state["counts"]) if state else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, dict(state, counts=list(state["counts"]))) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state["counts"]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return [[list(key), state] for key, state in values.items()]
+
+    def merge(self, state):
+        with self._lock:
+            for key, other in state:
+                key = tuple(key)
+                mine = self._values.get(key)
+                if mine is None:
+                    self._values[key] = {"counts": list(other["counts"]), "sum": other["sum"]}
+                else:
+                    mine["counts"] = [a + b for a, b in zip(mine["counts"], other["counts"])]
+                    mine["sum"] += other["sum"]
+
+
+class Registry:
+    """
+    Process-local metrics rendered in the Prometheus text exposition format.
+
+    Analysis worker processes record into their own registry; after each task
+    the worker drain()s its counters and histograms and the API process
+    merge()s them, so /metrics covers every process.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def drain(self):
+        """Counter and histogram changes since the last drain (picklable); resets them."""
+        return {name: m.drain() for name, m in self._metrics.items() if not isinstance(m, Gauge)}
+
+    def merge(self, delta):
+        for name, state in (delta or {}).items():
+            if name in self._metrics:
+                self._metrics[name].merge(state)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "zone_analyzer_stage_seconds",
+    "Time spent in each analysis stage (decode, detect, detect_hough, crop, preprocess, ocr_*, measure, match, persist, render).",
+    ["stage"],
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "zone_analyzer_request_seconds", "End-to-end time of analysis requests.", ["endpoint"],
+)
+IN_FLIGHT = REGISTRY.gauge(
+    "zone_analyzer_analyses_in_flight", "Analyses currently being processed.", ["endpoint"],
+)
+ANALYSES = REGISTRY.counter(
+    "zone_analyzer_analyses_total", "Finished analyses by outcome (ok, rejected, error).", ["endpoint", "outcome"],
+)
+OCR_CACHE_HITS = REGISTRY.counter(
+    "zone_analyzer_ocr_cache_hits_total", "Disks read from the OCR result cache.", ["endpoint"],
+)
+OCR_CACHE_MISSES = REGISTRY.counter(
+    "zone_analyzer_ocr_cache_misses_total", "Disks not found in the OCR result cache.", ["endpoint"],
+)
+OCR_ENGINE_DISKS = REGISTRY.counter(
+    "zone_analyzer_ocr_disks_total", "Disks read, by the engine that produced the result.", ["endpoint", "engine"],
+)
+GEMINI_FALLBACKS = REGISTRY.counter(
+    "zone_analyzer_gemini_fallbacks_total",
+    "Disks sent to local EasyOCR because Gemini was unavailable, failed or was not confident.",
+    ["endpoint"],
+)
+GEMINI_BREAKER_STATE = REGISTRY.gauge(
+    "zone_analyzer_gemini_breaker_state",
+    "Gemini circuit breaker state in this process (0 closed, 1 half-open, 2 open).",
+)
+GEMINI_REJECTED = REGISTRY.counter(
+    "zone_analyzer_gemini_rejected_total", "Gemini calls the circuit breaker turned away without a request.",
+)
+DETECTIONS = REGISTRY.counter(
+    "zone_analyzer_detections_total", "Plates detected, by the detector whose result was used (yolo, hough).",
+    ["endpoint", "detector"],
+)
+DISK_FALLBACKS = REGISTRY.counter(
+    "zone_analyzer_disk_name_fallbacks_total", "Disks left unread and reported as Disk_N.", ["endpoint"],
+)
+
+
+def timed(stage):
+    """with timed("detect"): ... records the block in zone_analyzer_stage_seconds."""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def endpoint():
+    return current_endpoint.get()
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import logs
+
+log = logs.get_logger("models")
+
+
+class ModelRegistry:
+    """
+    Named models loaded on first use or by a background warm-up thread.
+
+    Each entry has a loader (returns the model, or raises) and an optional
+    warmup(model) that runs a dummy inference so the first real request does
+    not pay cold-start costs. A failed load is remembered and not retried.
+    States: registered -> loading -> warming -> ready | failed.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._warmup_thread = None
+
+    def register(self, name, loader, warmup=None, required=True):
+        """required models must be ready for ready() to report True."""
+        self._entries[name] = {
+            "loader": loader,
+            "warmup": warmup,
+            "required": required,
+            "state": "registered",
+            "model": None,
+            "error": None,
+            "load_seconds": None,
+            "warmup_seconds": None,
+            "lock": threading.Lock(),
+        }
+
+    def get(self, name, warm=False):
+        """
+        The loaded model (loading it now if needed), or None if loading failed.
+        Callers arriving during a background load or warm-up wait for it, so the
+        model is never used by two threads before it is ready.
+        """
+        entry = self._entries[name]
+        if entry["state"] in ("ready", "failed"):
+            return entry["model"]
+        with entry["lock"]:
+            if entry["state"] == "registered":
+                entry["state"] = "loading"
+                start = time.perf_counter()
+                try:
+                    entry["model"] = entry["loader"]()
+                except Exception as e:
+                    log.error("Error loading %s: %s", name, e)
+                    entry["error"] = str(e)
+                    entry["state"] = "failed"
+                    return None
+                entry["load_seconds"] = round(time.perf_counter() - start, 3)
+                log.info("Loaded %s", name, extra={"duration_ms": round(entry["load_seconds"] * 1000, 1)})
+                entry["state"] = "warming" if warm and entry["warmup"] else "ready"
+            if entry["state"] == "warming" and warm:
+                start = time.perf_counter()
+                try:
+                    entry["warmup"](entry["model"])
+                except Exception as e:
+                    # A failed warm-up only costs the first request its cold start
+                    log.warning("Warm-up of %s failed: %s", name, e)
+                entry["warmup_seconds"] = round(time.perf_counter() - start, 3)
+                entry["state"] = "ready"
+            return entry["model"]
+
+    def warm_up(self, names=None):
+        """Load and warm the given models (all by default) in the calling thread."""
+        for name in names or list(self._entries):
+            self.get(name, warm=True)
+
+    def start_background(self, names=None):
+        """Warm models on a daemon thread; returns immediately."""
+        with self._lock:
+            if self._warmup_thread is None:
+                self._warmup_thread = threading.Thread(
+                    target=self.warm_up, args=(names,), name="model-warmup", daemon=True
+                )
+                self._warmup_thread.start()
+        return self._warmup_thread
+
+    def ready(self):
+        return all(e["state"] == "ready" for e in self._entries.values() if e["required"])
+
+    def status(self):
+        return {
+            name: {
+                "state": e["state"],
+                "required": e["required"],
+                "load_seconds": e["load_seconds"],
+                "warmup_seconds": e["warmup_seconds"],
+                "error": e["error"],
+            }
+            for name, e in self._entries.items()
+        }
@@ -132,6 +132,11 @@ class PlateResult(Base):
     bbox_x2 = Column(Float, nullable=True)
     bbox_y2 = Column(Float, nullable=True)
     disk_used_idx = Column(Integer, nullable=True)
+    # Disk bbox, so a confirmed result can be cropped again for the template bank.
+    disk_x1 = Column(Float, nullable=True)
+    disk_y1 = Column(Float, nullable=True)
+    disk_x2 = Column(Float, nullable=True)
+    disk_y2 = Column(Float, nullable=True)
 
     plate = relationship("Plate", back_populates="results")
     antibiotic = relationship("Antibiotic", back_populates="plate_results")
@@ -0,0 +1,131 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class OCRCache:
+    """
+    Two-tier memo of disk OCR results keyed by a perceptual hash (an int, see analysis.disk_phashes).
+
+    - Memory tier: LRU of the most recent `capacity` hashes. With `max_distance`
+      > 0, lookups also accept near duplicates within that many differing bits;
+      keep it well under the distance between similar codes ("CN 10", "CN 30").
+    - SQLite tier: every stored result, so the cache survives restarts. It is
+      queried by exact hash, and its most recent rows warm the memory tier on first
+      use and again on refresh() after another process wrote to it.
+    """
+
+    def __init__(self, path, capacity=2048, max_distance=0):
+        self.path = path
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._data_version = None
+        self.stats = {"memory_hits": 0, "near_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    def _connect(self):
+        # Opened lazily so importing analysis does not create the cache file
+        if self._conn is None and self.path:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_cache ("
+                "phash TEXT PRIMARY KEY, text TEXT NOT NULL, confidence REAL NOT NULL, "
+                "engine TEXT, hits INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+            self._warm()
+        return self._conn
+
+    def _warm(self):
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        rows = self._conn.execute(
+            "SELECT phash, text, confidence, engine FROM ocr_cache ORDER BY updated_at DESC LIMIT ?",
+            (self.capacity,),
+        ).fetchall()
+        self._lru.clear()
+        for phash, text, confidence, engine in reversed(rows):
+            self._lru[int(phash, 16)] = (text, confidence, engine)
+
+    def refresh(self):
+        """
+        Re-warm the memory tier if another connection committed to the file
+        since it was read, so entries confirmed elsewhere replace stale ones.
+        """
+        with self._lock:
+            if self._conn is None:
+                return False
+            # data_version only moves for commits made through other connections
+            if self._conn.execute("PRAGMA data_version").fetchone()[0] == self._data_version:
+                return False
+            self._warm()
+            return True
+
+    def get(self, *phashes):
+        """
+        Return (text, confidence, engine, distance) for the closest cached hash
+        to any of phashes (variants of one disk, e.g. both text orientations),
+        else None. distance is 0 for an exact hit.
+        """
+        with self._lock:
+            conn = self._connect()
+            match_key = next((phash for phash in phashes if phash in self._lru), None)
+            best_distance = 0
+            if match_key is None and self.max_distance > 0:
+                best_distance = self.max_distance + 1
+                for key in self._lru:
+                    distance = min((key ^ phash).bit_count() for phash in phashes)
+                    if distance < best_distance:
+                        best_distance, match_key = distance, key
+            if match_key is not None:
+                entry = self._lru[match_key]
+                self._lru.move_to_end(match_key)
+                self.stats["near_hits" if best_distance else "memory_hits"] += 1
+                return entry + (best_distance,)
+
+            row = None
+            for phash in phashes if conn is not None else ():
+                row = conn.execute(
+                    "SELECT text, confidence, engine FROM ocr_cache WHERE phash = ?", (format(phash, "x"),)
+                ).fetchone()
+                if row is not None:
+                    break
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            conn.execute("UPDATE ocr_cache SET hits = hits + 1 WHERE phash = ?", (format(phash, "x"),))
+            conn.commit()
+            self._remember(phash, tuple(row))
+            self.stats["disk_hits"] += 1
+            return tuple(row) + (0,)
+
+    def put(self, phash, text, confidence, engine=None):
+        with self._lock:
+            conn = self._connect()
+            self._remember(phash, (text, confidence, engine))
+            if conn is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO ocr_cache (phash, text, confidence, engine, hits, updated_at) "
+                    "VALUES (?, ?, ?, ?, COALESCE((SELECT hits FROM ocr_cache WHERE phash = ?), 0), ?)",
+                    (format(phash, "x"), text, confidence, engine, format(phash, "x"), time.time()),
+                )
+                conn.commit()
+            self.stats["stores"] += 1
+
+    def _remember(self, phash, entry):
+        self._lru[phash] = entry
+        self._lru.move_to_end(phash)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+    def snapshot(self):
+        """Counters plus hit rate, for sizing the cache."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._lru)
+        hits = stats["memory_hits"] + stats["near_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,195 @@
+import threading
+
+import cv2
+import numpy as np
+
+
+# ==========================================
+# Stages: name -> fn(img, **params) -> img
+# ==========================================
+
+_clahe_local = threading.local()
+
+
+def get_clahe(clip=2.0, tile=8):
+    """CLAHE object for (clip, tile), built once per thread (apply() is not safe to share across threads)."""
+    cache = getattr(_clahe_local, "cache", None)
+    if cache is None:
+        cache = _clahe_local.cache = {}
+    key = (clip, tile)
+    if key not in cache:
+        cache[key] = cv2.createCLAHE(clipLimit=clip, tileGridSize=(tile, tile))
+    return cache[key]
+
+
+_SHARPEN_KERNEL = np.array([[-0.5, -0.5, -0.5],
+                            [-0.5, 5, -0.5],
+                            [-0.5, -0.5, -0.5]])
+_MORPH_SHAPES = {"rect": cv2.MORPH_RECT, "ellipse": cv2.MORPH_ELLIPSE}
+
+
+def _kernel(size, shape="rect"):
+    return cv2.getStructuringElement(_MORPH_SHAPES[shape], (size, size))
+
+
+def _clahe(img, clip=2.0, tile=8):
+    return get_clahe(clip, tile).apply(img)
+
+
+def _equalize(img):
+    return cv2.equalizeHist(img)
+
+
+def _blur(img, ksize=3):
+    return cv2.GaussianBlur(img, (ksize, ksize), 0)
+
+
+def _sharpen(img):
+    return np.clip(cv2.filter2D(img, -1, _SHARPEN_KERNEL), 0, 255).astype(np.uint8)
+
+
+def _laplacian_sharpen(img, ksize=5, weight=1.5, lap_weight=0.5):
+    lap = cv2.convertScaleAbs(cv2.Laplacian(img, cv2.CV_16S, ksize=ksize, scale=1, delta=0))
+    return cv2.addWeighted(img, weight, lap, lap_weight, 0)
+
+
+def _threshold(img, value=200):
+    return cv2.threshold(img, value, 255, cv2.THRESH_BINARY)[1]
+
+
+def _otsu(img):
+    return cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+
+def _adaptive(img, block=49, c=6):
+    return cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, blockSize=block, C=c)
+
+
+def _invert(img):
+    return cv2.bitwise_not(img)
+
+
+def _dilate(img, size=2, shape="rect"):
+    return cv2.dilate(img, _kernel(size, shape), iterations=1)
+
+
+def _erode(img, size=2, shape="rect"):
+    return cv2.erode(img, _kernel(size, shape), iterations=1)
+
+
+def _close(img, size=5, shape="ellipse"):
+    return cv2.morphologyEx(img, cv2.MORPH_CLOSE, _kernel(size, shape), iterations=1)
+
+
+def _stroke_fix(img, thin=0.15, thick=0.35, size=2):
+    """On white-on-black text: dilate thin strokes, erode thick ones."""
+    text_pixel_ratio = np.count_nonzero(img == 255) / img.size
+    if text_pixel_ratio < thin:
+        return _dilate(img, size)
+    if text_pixel_ratio > thick:
+        return _erode(img, size)
+    return img
+
+
+STAGES = {
+    "clahe": _clahe,
+    "equalize": _equalize,
+    "blur": _blur,
+    "sharpen": _sharpen,
+    "laplacian_sharpen": _laplacian_sharpen,
+    "threshold": _threshold,
+    "otsu": _otsu,
+    "adaptive": _adaptive,
+    "invert": _invert,
+    "dilate": _dilate,
+    "erode": _erode,
+    "close": _close,
+    "stroke_fix": _stroke_fix,
+}
+
+
+# ==========================================
+# Pipelines: name -> [(stage, params), ...]
+# ==========================================
+
+PIPELINES = {
+    # Black text on white: CLAHE, blur, Laplacian sharpening, adaptive threshold, morphology
+    "pipeline_4": [
+        ("clahe", {"clip": 3.0}),
+        ("blur", {"ksize": 7}),
+        ("laplacian_sharpen", {}),
+        ("adaptive", {"block": 49, "c": 6}),
+        ("invert", {}),
+        ("dilate", {"size": 2}),
+        ("close", {"size": 5, "shape": "ellipse"}),
+        ("erode", {"size": 2}),
+        ("invert", {}),
+    ],
+    "denoise_otsu": [
+        ("clahe", {"clip": 2.0}),
+        ("sharpen", {}),
+        ("blur", {"ksize": 3}),
+        ("otsu", {}),
+        ("invert", {}),
+        ("stroke_fix", {}),
+        ("invert", {}),
+    ],
+    "clahe": [("clahe", {"clip": 2.0})],
+    "sharpen": [("sharpen", {})],
+    "equalize": [("equalize", {})],
+    "global_threshold": [("threshold", {"value": 200})],
+}
+
+
+def register_pipeline(name, stages):
+    """Add or replace a named pipeline; every stage must be a key of STAGES."""
+    for stage, _ in stages:
+        if stage not in STAGES:
+            raise ValueError(f"Unknown preprocessing stage: {stage}")
+    PIPELINES[name] = [(stage, dict(params)) for stage, params in stages]
+
+
+def _stage_key(stage, params):
+    return (stage, tuple(sorted(params.items())))
+
+
+class PreprocessGraph:
+    """
+    Runs named pipelines on one crop, computing every shared prefix once.
+
+    Pipelines are lists of (stage, params); the intermediate after each prefix
+    is memoized for the lifetime of the graph, so e.g. "denoise_otsu" and
+    "clahe" apply the same CLAHE only once. This only pays off when several
+    pipelines are compared on the same crop (run_many, e.g. when tuning
+    PREPROCESS_PIPELINE); the analysis itself runs one pipeline per crop.
+    """
+
+    def __init__(self, img):
+        self.img = img
+        self.stats = {"computed": 0, "reused": 0}
+        self._memo = {(): img}
+
+    def run(self, name):
+        if name not in PIPELINES:
+            raise KeyError(f"Unknown preprocessing pipeline: {name}")
+        prefix = ()
+        out = self.img
+        for stage, params in PIPELINES[name]:
+            prefix = prefix + (_stage_key(stage, params),)
+            cached = self._memo.get(prefix)
+            if cached is None:
+                cached = self._memo[prefix] = STAGES[stage](out, **params)
+                self.stats["computed"] += 1
+            else:
+                self.stats["reused"] += 1
+            out = cached
+        return out
+
+    def run_many(self, names):
+        """{name: output} for several strategies on the same crop."""
+        return {name: self.run(name) for name in names}
+
+
+def preprocess(gray, name="pipeline_4"):
+    """Output of one named pipeline on a grayscale crop."""
+    return PreprocessGraph(gray).run(name)
@@ -0,0 +1,197 @@
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Off by default. PROFILE_TOKEN enables the X-Profile-Token request header and the
+# /profiles endpoints (admins share the token); PROFILE_SAMPLE_RATE profiles that
+# fraction of /analyze requests on its own.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "").strip()
+try:
+    PROFILE_SAMPLE_RATE = min(1.0, max(0.0, float(os.getenv("PROFILE_SAMPLE_RATE", "0"))))
+    PROFILE_INTERVAL_MS = max(1.0, float(os.getenv("PROFILE_INTERVAL_MS", "5")))
+    # Oldest profiles are deleted beyond this many
+    PROFILE_KEEP = max(1, int(os.getenv("PROFILE_KEEP", "200")))
+except (ValueError, TypeError):
+    PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, PROFILE_KEEP = 0.0, 5.0, 200
+PROFILE_DIR = os.getenv("PROFILE_DIR", "").strip() or os.path.join(BASE_DIR, "profiles")
+PROFILE_HEADER = "X-Profile-Token"
+
+# Leaf frames of threads that are parked, not working; their samples are dropped
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("base_events.py", "_run_once"),
+    ("thread.py", "_worker"),
+    ("_base.py", "wait"),
+}
+
+_PLATE_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def token_valid(token):
+    return bool(PROFILE_TOKEN) and bool(token) and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def should_profile(headers):
+    """Profiling reason for a request ("header" or "sampled"), or None; costs nothing when profiling is off."""
+    if PROFILE_TOKEN and token_valid(headers.get(PROFILE_HEADER)):
+        return "header"
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread snapshots every other thread's
+    stack (sys._current_frames) each interval and counts identical stacks.
+
+    The result is in the collapsed "folded" format (one "thread;outer;...;leaf
+    count" line per stack) that flamegraph.pl, speedscope and inferno read.
+    Samples cover the whole process while the profiler runs, so concurrent
+    requests show up too; idle threads are left out. Peak traced memory
+    (tracemalloc) over the same span is recorded with it.
+    """
+
+    def __init__(self, interval_ms=None):
+        self.interval = (interval_ms or PROFILE_INTERVAL_MS) / 1000.0
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.duration = 0.0
+        self.peak_memory = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        global _tracemalloc_users, _tracemalloc_owned
+        with _tracemalloc_lock:
+            # Concurrent profiles share one tracemalloc session; leave one started elsewhere running
+            if _tracemalloc_users == 0:
+                _tracemalloc_owned = not tracemalloc.is_tracing()
+                if _tracemalloc_owned:
+                    tracemalloc.start()
+            _tracemalloc_users += 1
+            tracemalloc.reset_peak()
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        global _tracemalloc_users
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+        with _tracemalloc_lock:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0 and _tracemalloc_owned:
+                tracemalloc.stop()
+        return self
+
+    def add(self, other, prefix):
+        """Fold another profile (e.g. from an analysis worker process) in under prefix."""
+        for stack, count in other["stacks"].items():
+            self.stacks[f"{prefix};{stack}"] += count
+        self.peak_memory = max(self.peak_memory or 0, other.get("peak_memory") or 0)
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def export(self):
+        """Picklable result, for shipping from a worker process."""
+        return {"stacks": dict(self.stacks), "samples": self.samples, "peak_memory": self.peak_memory}
+
+
+def save_profile(plate_id, profile, endpoint, reason):
+    """Write profiles/<plate_id>.folded and .json; drops the oldest beyond PROFILE_KEEP."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, f"{plate_id}.folded"), "w") as f:
+        f.write(profile.folded())
+    meta = {
+        "plate_id": plate_id,
+        "endpoint": endpoint,
+        "reason": reason,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "duration_s": round(profile.duration, 3),
+        "interval_ms": profile.interval * 1000,
+        "samples": profile.samples,
+        "peak_memory_kb": round(profile.peak_memory / 1024, 1) if profile.peak_memory is not None else None,
+    }
+    with open(os.path.join(PROFILE_DIR, f"{plate_id}.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    stored = sorted(
+        (p for p in os.listdir(PROFILE_DIR) if p.endswith(".json")),
+        key=lambda p: os.path.getmtime(os.path.join(PROFILE_DIR, p)),
+    )
+    for old in stored[:-PROFILE_KEEP]:
+        for ext in (".json", ".folded"):
+            path = os.path.join(PROFILE_DIR, old[:-5] + ext)
+            if os.path.exists(path):
+                os.remove(path)
+    return meta
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        if name.endswith(".json"):
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                profiles.append(json.load(f))
+    return sorted(profiles, key=lambda p: p["created_at"], reverse=True)
+
+
+def profile_path(plate_id):
+    """Path of a stored folded profile, or None (also for ids that are not plain file names)."""
+    if not _PLATE_ID.match(plate_id or ""):
+        return None
+    path = os.path.join(PROFILE_DIR, f"{plate_id}.folded")
+    return path if os.path.exists(path) else None
@@ -113,6 +113,10 @@ class PlateResultBase(BaseModel):
     bbox_x2: Optional[float] = None
     bbox_y2: Optional[float] = None
     disk_used_idx: Optional[int] = None
+    disk_x1: Optional[float] = None
+    disk_y1: Optional[float] = None
+    disk_x2: Optional[float] = None
+    disk_y2: Optional[float] = None
 
 class PlateResult(PlateResultBase):
     result_id: str
@@ -0,0 +1,326 @@
+"""
+Synthetic antibiotic susceptibility plates with exact ground truth.
+
+    python synthetic_plates.py --count 200 --out synthetic_data/          # codes from senior_project.db
+    python synthetic_plates.py --count 20 --out synthetic_data/ --no-db --rotation 180 --blur 1.5
+
+Each plate is a 90 mm Petri dish on a dark bench: an agar lawn with texture,
+6.35 mm (1/4") paper disks printed with an antibiotic code ("MEM" over "10", at a random
+angle) and an inhibition zone of known diameter around each, then a lighting
+gradient, blur, sensor noise, a whole-image rotation and JPEG compression.
+Every plate_NNNN.jpg gets a plate_NNNN.json with the disk and zone centres,
+bounding boxes and diameters in pixels and mm; manifest.jsonl lists them all.
+
+evaluate() scores analyze_disk_image output against that ground truth.
+"""
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+import zone_profile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DISH_DIAMETER_MM = 90.0
+# The disk size the analysis calibrates on, so measured diameters compare to the truth directly
+DISK_DIAMETER_MM = zone_profile.DISK_DIAMETER_MM
+# Used when no Antibiotics table is available
+DEFAULT_CODES = ["AMP 10", "CIP 5", "GEN 10", "TCY 30", "MEM 10", "AMC 30", "SXT 25", "FOX 30", "CN 10", "TE 30"]
+
+
+def lexicon_codes(db_path=None):
+    """[(code, antibiotic_id)] printed on disks, from the Antibiotics table (abbreviation + concentration)."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    import models
+
+    db_path = db_path or os.path.join(BASE_DIR, "senior_project.db")
+    if not os.path.exists(db_path):
+        return [(code, None) for code in DEFAULT_CODES]
+    engine = create_engine(f"sqlite:///{db_path}")
+    try:
+        with Session(engine) as db:
+            rows = db.query(models.Antibiotic).filter(
+                models.Antibiotic.abbreviation.isnot(None),
+                models.Antibiotic.abbreviation != "",
+                models.Antibiotic.concentration_ug > 0,
+            ).order_by(models.Antibiotic.antibiotic_id).all()
+            codes, seen = [], set()
+            for ab in rows:
+                code = f"{ab.abbreviation.strip().upper()} {ab.concentration_ug}"
+                if code not in seen:
+                    seen.add(code)
+                    codes.append((code, ab.antibiotic_id))
+    finally:
+        engine.dispose()
+    return codes or [(code, None) for code in DEFAULT_CODES]
+
+
+def _smooth_noise(rng, shape, scale):
+    """Low-frequency noise in [-1, 1]: upsampled random field."""
+    h, w = shape
+    small = rng.standard_normal((max(2, h // scale), max(2, w // scale))).astype(np.float32)
+    field = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+    return field / (np.abs(field).max() + 1e-6)
+
+
+def _layout(rng, count, dish_r_mm, max_zone_mm):
+    """Disk centres (mm, relative to the dish centre) on one or two rings, and each one's largest zone."""
+    rings = [count] if count <= 8 else [count - count // 3, count // 3]
+    centres = []
+    for ring, n in enumerate(rings):
+        radius = dish_r_mm * (0.58 if ring == 0 else 0.2)
+        offset = rng.uniform(0, 2 * np.pi)
+        for k in range(n):
+            angle = offset + 2 * np.pi * k / n + rng.uniform(-0.08, 0.08)
+            centres.append((radius * np.cos(angle), radius * np.sin(angle)))
+    centres = np.array(centres)
+    # Zones may touch their neighbours and the rim, as on real plates, but not overlap
+    gaps = np.linalg.norm(centres[:, None] - centres[None], axis=2) + np.eye(len(centres)) * 1e9
+    limits = np.minimum(gaps.min(axis=1), 2 * (dish_r_mm - np.linalg.norm(centres, axis=1)))
+    return centres, np.minimum(limits, max_zone_mm)
+
+
+def _draw_disk_text(img, centre, radius, code, angle, ink):
+    """Print the code on the disk as two lines (abbreviation over concentration), rotated by angle."""
+    size = int(radius * 2)
+    patch = np.zeros((size, size), dtype=np.uint8)
+    lines = code.split(" ", 1)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    # Largest scale that fits the longest line in ~65% of the disk width and the lines in ~50% of its height
+    widest = max(cv2.getTextSize(line, font, 1.0, 2)[0][0] for line in lines)
+    tallest = cv2.getTextSize("0", font, 1.0, 2)[0][1] * (1.5 * len(lines) - 0.5)
+    scale = min(0.65 * size / max(widest, 1), 0.5 * size / tallest)
+    thickness = max(1, int(round(scale * 2)))
+    line_h = cv2.getTextSize("0", font, scale, thickness)[0][1]
+    top = size // 2 - (len(lines) * line_h + (len(lines) - 1) * line_h // 2) // 2
+    for i, line in enumerate(lines):
+        (tw, _), _ = cv2.getTextSize(line, font, scale, thickness)
+        y = top + (i + 1) * line_h + i * line_h // 2
+        cv2.putText(patch, line, ((size - tw) // 2, y), font, scale, 255, thickness, cv2.LINE_AA)
+    rotation = cv2.getRotationMatrix2D((size / 2, size / 2), angle, 1.0)
+    patch = cv2.warpAffine(patch, rotation, (size, size))
+    # Ink stays on the paper
+    cv2.circle(patch, (size // 2, size // 2), size // 2 + size, 0, 2 * size)
+
+    x0, y0 = int(round(centre[0] - size / 2)), int(round(centre[1] - size / 2))
+    region = img[y0:y0 + size, x0:x0 + size]
+    alpha = (patch[:region.shape[0], :region.shape[1]].astype(np.float32) / 255.0)[..., None]
+    region[:] = region * (1 - alpha) + np.array(ink, dtype=np.float32) * alpha
+
+
+def render_plate(seed, codes=None, size=2400, disks=6, disk_mm=DISK_DIAMETER_MM, zone_range=(6.35, 32.0),
+                 noise=4.0, blur=0.8, gradient=0.25, rotation=180.0, jpeg_quality=90):
+    """
+    One synthetic plate as (BGR image, ground truth dict).
+
+    codes are (code, antibiotic_id) pairs; disks draw from them without
+    repetition where possible. A zone diameter equal to disk_mm means no
+    inhibition. rotation is the maximum whole-image rotation in degrees.
+    Coordinates in the ground truth are pixels of the returned image.
+    """
+    rng = np.random.default_rng(seed)
+    codes = codes or [(code, None) for code in DEFAULT_CODES]
+    px_per_mm = size * 0.92 / DISH_DIAMETER_MM
+    centre = np.array([size / 2, size / 2])
+    dish_r = DISH_DIAMETER_MM / 2 * px_per_mm
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+
+    # Bench, dish rim and agar lawn (float BGR)
+    img = np.empty((size, size, 3), dtype=np.float32)
+    bench = rng.uniform(25, 45)
+    img[:] = bench
+    img += 10 * _smooth_noise(rng, (size, size), 64)[..., None]
+    agar = np.array([95, 165, 205]) * rng.uniform(0.85, 1.1)
+    lawn = agar * 1.08 + 12 * _smooth_noise(rng, (size, size), 24)[..., None] + 5 * _smooth_noise(rng, (size, size), 4)[..., None]
+    dist_dish = np.hypot(xx - centre[0], yy - centre[1])
+    inside = dist_dish < dish_r
+    img[inside] = lawn[inside]
+    rim = (dist_dish >= dish_r) & (dist_dish < dish_r + 0.8 * px_per_mm)
+    img[rim] = 200
+    # Inhibition zones: clearer agar, so darker than the lawn against the dark bench
+    cleared = agar * 0.78 + 4 * _smooth_noise(rng, (size, size), 16)[..., None]
+
+    picks = rng.permutation(len(codes))
+    picks = np.concatenate([picks] * (disks // len(codes) + 1))[:disks]
+    centres_mm, zone_limits = _layout(rng, disks, DISH_DIAMETER_MM / 2, zone_range[1])
+    disk_r = disk_mm / 2 * px_per_mm
+
+    truth_disks = []
+    for k, (offset_mm, limit_mm) in enumerate(zip(centres_mm, zone_limits)):
+        code, antibiotic_id = codes[picks[k]]
+        c = centre + offset_mm * px_per_mm
+        # Some disks show no inhibition at all (resistant)
+        zone_mm = disk_mm if rng.random() < 0.15 else float(rng.uniform(max(zone_range[0], disk_mm), max(limit_mm, disk_mm)))
+        zone_r = zone_mm / 2 * px_per_mm
+        if zone_r > disk_r:
+            # Cleared agar inside the zone, with a ~0.8 mm soft edge (computed on the zone's window only)
+            x0, y0 = (np.floor(c - zone_r - px_per_mm)).astype(int).clip(0, size)
+            x1, y1 = (np.ceil(c + zone_r + px_per_mm)).astype(int).clip(0, size)
+            dist = np.hypot(xx[y0:y1, x0:x1] - c[0], yy[y0:y1, x0:x1] - c[1])
+            edge = (np.clip((zone_r - dist) / (0.8 * px_per_mm) + 0.5, 0, 1) * inside[y0:y1, x0:x1])[..., None]
+            img[y0:y1, x0:x1] = img[y0:y1, x0:x1] * (1 - edge) + cleared[y0:y1, x0:x1] * edge
+        # Disk with a faint shadow, then the printed code
+        cv2.circle(img, tuple(int(v) for v in c + 0.06 * disk_r), int(disk_r), (60, 80, 95), -1, cv2.LINE_AA)
+        cv2.circle(img, tuple(int(v) for v in c), int(disk_r), tuple(float(v) for v in rng.uniform(232, 250, 3)), -1, cv2.LINE_AA)
+        text_angle = float(rng.uniform(-180, 180))
+        _draw_disk_text(img, c, disk_r, code, text_angle, (25, 25, 30))
+        truth_disks.append({
+            "code": code,
+            "antibiotic_id": antibiotic_id,
+            "center": c.tolist(),
+            "disk_diameter_mm": disk_mm,
+            "zone_diameter_mm": round(zone_mm, 3),
+            "text_angle": text_angle,
+        })
+
+    # Lighting: linear gradient in a random direction plus vignetting
+    direction = rng.uniform(0, 2 * np.pi)
+    ramp = ((xx - centre[0]) * np.cos(direction) + (yy - centre[1]) * np.sin(direction)) / size
+    light = 1 + gradient * ramp - 0.15 * (dist_dish / size) ** 2
+    img *= light[..., None]
+
+    if blur > 0:
+        img = cv2.GaussianBlur(img, (0, 0), blur)
+    if noise > 0:
+        img += rng.normal(0, noise, img.shape).astype(np.float32)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+
+    angle = float(rng.uniform(-rotation, rotation)) if rotation else 0.0
+    if angle:
+        matrix = cv2.getRotationMatrix2D((size / 2, size / 2), angle, 1.0)
+        img = cv2.warpAffine(img, matrix, (size, size), borderMode=cv2.BORDER_CONSTANT, borderValue=(bench,) * 3)
+        for disk in truth_disks:
+            disk["center"] = (matrix[:, :2] @ np.array(disk["center"]) + matrix[:, 2]).tolist()
+            disk["text_angle"] = (disk["text_angle"] + angle + 180) % 360 - 180
+
+    for disk in truth_disks:
+        cx, cy = disk["center"]
+        for name, diameter_mm in (("disk_bbox", disk["disk_diameter_mm"]), ("zone_bbox", disk["zone_diameter_mm"])):
+            r = diameter_mm / 2 * px_per_mm
+            disk[name] = [round(cx - r, 2), round(cy - r, 2), round(cx + r, 2), round(cy + r, 2)]
+        disk["center"] = [round(cx, 2), round(cy, 2)]
+
+    truth = {
+        "seed": seed,
+        "width": size,
+        "height": size,
+        "px_per_mm": round(px_per_mm, 4),
+        "dish": {"center": centre.tolist(), "diameter_mm": DISH_DIAMETER_MM},
+        "rotation": round(angle, 3),
+        "params": {"noise": noise, "blur": blur, "gradient": gradient, "jpeg_quality": jpeg_quality},
+        "disks": truth_disks,
+    }
+    return img, truth
+
+
+def encode_plate(img, jpeg_quality=90):
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
+
+
+def evaluate(results, truth, max_distance_mm=3.0):
+    """
+    Score analyze_disk_image results against a plate's ground truth.
+    Results are paired with true disks by disk (else zone) centre within max_distance_mm.
+
+    The analysis turns pixels into mm by taking every disk to be
+    zone_profile.DISK_DIAMETER_MM across, so for plates rendered with another
+    --disk-mm the true diameters are scaled by the same factor first; a
+    constant offset from the disk size would otherwise hide real errors.
+    """
+    px_per_mm = truth["px_per_mm"]
+    remaining = list(range(len(truth["disks"])))
+    errors, codes_ok, matched = [], 0, 0
+    for res in results:
+        bbox = res.get("disk_bbox") or res.get("bbox")
+        if not bbox:
+            continue
+        cx, cy = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+        best, best_d = None, max_distance_mm * px_per_mm
+        for i in remaining:
+            d = np.hypot(truth["disks"][i]["center"][0] - cx, truth["disks"][i]["center"][1] - cy)
+            if d <= best_d:
+                best, best_d = i, d
+        if best is None:
+            continue
+        remaining.remove(best)
+        matched += 1
+        disk = truth["disks"][best]
+        if res.get("diameter_mm") is not None and res.get("bbox"):
+            calibration = zone_profile.DISK_DIAMETER_MM / disk["disk_diameter_mm"]
+            errors.append(res["diameter_mm"] - disk["zone_diameter_mm"] * calibration)
+        codes_ok += res.get("medicine_name") == disk["code"]
+    errors = np.array(errors, dtype=float)
+    return {
+        "disks": len(truth["disks"]),
+        "matched": matched,
+        "missed": len(remaining),
+        "extra": len(results) - matched,
+        "code_accuracy": round(codes_ok / len(truth["disks"]), 4) if truth["disks"] else None,
+        "diameter_mae_mm": round(float(np.abs(errors).mean()), 3) if errors.size else None,
+        "diameter_bias_mm": round(float(errors.mean()), 3) if errors.size else None,
+    }
+
+
+def _write_plate(job):
+    index, out_dir, codes, options = job
+    img, truth = render_plate(options["seed"] + index, codes, **options["render"])
+    name = f"plate_{index:04d}"
+    with open(os.path.join(out_dir, name + ".jpg"), "wb") as f:
+        f.write(encode_plate(img, options["render"]["jpeg_quality"]))
+    truth["image"] = name + ".jpg"
+    with open(os.path.join(out_dir, name + ".json"), "w") as f:
+        json.dump(truth, f, indent=2)
+    return truth
+
+
+def generate(out_dir, count, codes=None, seed=0, workers=1, **render):
+    """Write count plates with ground truth to out_dir; returns their truth dicts."""
+    os.makedirs(out_dir, exist_ok=True)
+    render.setdefault("jpeg_quality", 90)
+    options = {"seed": seed, "render": render}
+    jobs = [(i, out_dir, codes, options) for i in range(count)]
+    if workers > 1:
+        with Pool(workers) as pool:
+            truths = pool.map(_write_plate, jobs)
+    else:
+        truths = [_write_plate(job) for job in jobs]
+    with open(os.path.join(out_dir, "manifest.jsonl"), "w") as f:
+        for truth in truths:
+            f.write(json.dumps({"image": truth["image"], "seed": truth["seed"], "disks": len(truth["disks"])}) + "\n")
+    return truths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=os.path.join(BASE_DIR, "synthetic_data"))
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--size", type=int, default=2400, help="image side in pixels")
+    parser.add_argument("--disks", type=int, default=6)
+    parser.add_argument("--disk-mm", type=float, default=DISK_DIAMETER_MM)
+    parser.add_argument("--noise", type=float, default=4.0, help="sensor noise sigma (grey levels)")
+    parser.add_argument("--blur", type=float, default=0.8, help="Gaussian blur sigma (pixels)")
+    parser.add_argument("--gradient", type=float, default=0.25, help="lighting gradient strength")
+    parser.add_argument("--rotation", type=float, default=180.0, help="maximum image rotation (degrees)")
+    parser.add_argument("--jpeg-quality", type=int, default=90)
+    parser.add_argument("--db", default=None, help="database for disk codes (default senior_project.db)")
+    parser.add_argument("--no-db", action="store_true", help="use the built-in code list")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    codes = [(code, None) for code in DEFAULT_CODES] if args.no_db else lexicon_codes(args.db)
+    generate(
+        args.out, args.count, codes, seed=args.seed, workers=args.workers,
+        size=args.size, disks=args.disks, disk_mm=args.disk_mm, noise=args.noise, blur=args.blur,
+        gradient=args.gradient, rotation=args.rotation, jpeg_quality=args.jpeg_quality,
+    )
+    print(f"Wrote {args.count} plate(s) with ground truth to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
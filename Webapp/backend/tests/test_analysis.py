@@ -0,0 +1,886 @@
+import sys
+import os
+
+import numpy as np
+import pytest
+
+# Add parent directory to path to allow importing analysis
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+
+
+class FakeReader:
+    """Stand-in for easyocr.Reader: reads 'MEM 10' when the dark bar lies flat on the right."""
+
+    def __init__(self, conf=0.5):
+        self.conf = conf
+        self.readtext_calls = 0
+        self.batched_calls = 0
+
+    def _read(self, img):
+        h, w = img.shape[:2]
+        dark_rows = np.flatnonzero((img[:, w // 2:] < 128).sum(axis=1))
+        if dark_rows.size and np.ptp(dark_rows) < 80:
+            return [([[0, 0]] * 4, "MEM 10", self.conf + 0.1 / (1 + np.ptp(dark_rows)))]
+        return [([[0, 0]] * 4, "M%", 0.2)]
+
+    def readtext(self, img, **kwargs):
+        self.readtext_calls += 1
+        return self._read(img)
+
+    def readtext_batched(self, images, **kwargs):
+        self.batched_calls += 1
+        return [self._read(img) for img in images]
+
+
+def make_disk(angle=0):
+    """Binary disk with a wide text-like bar right of centre, rotated by angle."""
+    img = np.full((640, 640), 255, dtype=np.uint8)
+    img[295:345, 340:560] = 0
+    return analysis.rotate_image(img, angle)
+
+
+def test_vectorized_regex_matches_scalar():
+    texts = ["MEM 10", "MEM_10", "MEM10", "AMP", "AM?P 1 x1", "", None, "  CN 10  "]
+    confs = [0.5, 0.9, 0.95, 0.4, 0.2, 0.8, 0.7, 0.75]
+    expected = [analysis.adjust_confidence_with_regex(t, c) for t, c in zip(texts, confs)]
+    assert np.allclose(analysis.adjust_confidences_with_regex(texts, confs), expected)
+
+
+def test_estimate_text_orientation():
+    for angle in (30, -50, 80):
+        estimate = analysis.estimate_text_orientation(make_disk(angle))
+        # Rotating by the estimate makes the bar horizontal again (up to 180 degrees)
+        assert analysis._angle_distance(estimate, -angle) < 2 or analysis._angle_distance(estimate, 180 - angle) < 2
+    assert analysis.estimate_text_orientation(np.full((640, 640), 255, dtype=np.uint8)) is None
+
+
+def test_easyocr_search_exits_early(monkeypatch):
+    reader = FakeReader(conf=0.7)
+    monkeypatch.setattr(analysis, "ocr_reader", reader)
+
+    text, conf, angle, tried = analysis.extract_medicine_easyocr(make_disk(40))
+
+    assert (text, conf) == ("MEM 10", 1.0)
+    assert analysis._angle_distance(angle, -40) < 2
+    # The orientation estimate is right: one angle tried, not the 360 / OCR_COARSE_STEP grid
+    assert tried == 1 and reader.readtext_calls == 1
+
+    # The estimate is only known up to 180 degrees; here the flipped twin is the upright one
+    assert analysis.extract_medicine_easyocr(make_disk(-120))[2:] == (120.0, 2)
+    assert reader.readtext_calls == 3
+
+
+def test_batched_easyocr_matches_sequential(monkeypatch):
+    monkeypatch.setattr(analysis, "ocr_reader", FakeReader())
+    monkeypatch.setattr(analysis, "OCR_EARLY_EXIT_CONF", 2.0)
+    disks = [make_disk(0), make_disk(70), make_disk(-120), np.full((640, 640), 255, dtype=np.uint8)]
+
+    sequential = [analysis.extract_medicine_easyocr(d) for d in disks]
+    reader = FakeReader()
+    monkeypatch.setattr(analysis, "ocr_reader", reader)
+    batched = analysis.extract_medicine_easyocr_batched(disks, batch_size=30)
+
+    assert batched == sequential
+    assert [r[0] for r in batched] == ["MEM 10", "MEM 10", "MEM 10", "Unknown"]
+    assert batched[3] == ("Unknown", 0.0, 0, 360 // analysis.OCR_COARSE_STEP)
+    # Round 1: 4 priority angles x 4 disks; round 2: the remaining coarse angles; round 3: fine pass
+    assert reader.batched_calls >= 3
+
+    # With early exit every disk stops after the first round (its OCR_PRIORITY_ANGLES angles)
+    monkeypatch.setattr(analysis, "OCR_EARLY_EXIT_CONF", 0.9)
+    reader = FakeReader(conf=0.7)
+    monkeypatch.setattr(analysis, "ocr_reader", reader)
+    batched = analysis.extract_medicine_easyocr_batched(disks[:3], batch_size=30)
+    assert [r[3] for r in batched] == [analysis.OCR_PRIORITY_ANGLES] * 3
+    assert reader.batched_calls == 1
+
+
+def test_polar_strip_matches_rotate_image():
+    img = np.full((640, 640), 255, dtype=np.uint8)
+    img[295:345, 180:460] = 0
+    polar = analysis.unwrap_disk_polar(img)
+    inside = np.hypot(*np.mgrid[-320:320, -320:320]) < 300
+
+    for angle in (0, 15, -40, 165):
+        expected = analysis.rotate_image(img, angle).astype(int)
+        assert np.abs(analysis.polar_strip(polar, angle) - expected)[inside].mean() < 3
+
+    strip = analysis.polar_strip(polar, 30, height=200)
+    assert strip.shape == (200, 640)
+
+
+def test_ocr_cache_near_duplicates_and_persistence(tmp_path):
+    from ocr_cache import OCRCache
+
+    path = str(tmp_path / "ocr_cache.db")
+    cache = OCRCache(path, capacity=4, max_distance=2)
+    cache.put(0b1011, "CN 10", 0.9, "easyocr")
+
+    assert cache.get(0b1011) == ("CN 10", 0.9, "easyocr", 0)
+    assert cache.get(0b0011) == ("CN 10", 0.9, "easyocr", 1)  # 1 bit away
+    assert cache.get(0b0100) is None  # 4 bits away
+    assert cache.snapshot()["hit_rate"] == round(2 / 3, 4)
+    assert cache.snapshot()["near_hits"] == 1
+
+    # A fresh process sees the SQLite tier; exact lookup is the default
+    reopened = OCRCache(path, capacity=4)
+    assert reopened.get(0b1011) == ("CN 10", 0.9, "easyocr", 0)
+    assert reopened.get(0b0011) is None
+
+
+def test_plate_ocr_skips_engines_on_cache_hit(monkeypatch, tmp_path):
+    from ocr_cache import OCRCache
+
+    reader = FakeReader(conf=0.7)
+    monkeypatch.setattr(analysis, "ocr_reader", reader)
+    monkeypatch.setattr(analysis, "gemini_client", None)
+    monkeypatch.setattr(analysis, "template_bank", None)
+    monkeypatch.setattr(analysis, "ocr_cache", OCRCache(str(tmp_path / "c.db"), max_distance=analysis.OCR_CACHE_MAX_DISTANCE))
+
+    first = analysis.extract_medicine_ocr_plate([make_disk(0)])
+    calls = reader.batched_calls + reader.readtext_calls
+    again = analysis.extract_medicine_ocr_plate([make_disk(0)])
+    assert first[0][0] == again[0][0] == "MEM 10"
+    assert reader.batched_calls + reader.readtext_calls == calls
+    assert analysis.ocr_cache.snapshot()["memory_hits"] == 1
+
+
+def make_text_disk(dx=0, dy=0):
+    """Binary disk printed "MEM" over "10", offset by (dx, dy) pixels."""
+    import cv2
+
+    img = np.full((640, 640), 255, dtype=np.uint8)
+    cv2.putText(img, "MEM", (200 + dx, 300 + dy), cv2.FONT_HERSHEY_SIMPLEX, 3, 0, 12)
+    cv2.putText(img, "10", (250 + dx, 400 + dy), cv2.FONT_HERSHEY_SIMPLEX, 3, 0, 12)
+    return img
+
+
+class FailingGemini:
+    def available(self):
+        return True
+
+    def generate(self, *args, **kwargs):
+        raise AssertionError("Gemini called on a cached disk")
+
+    generate_many = generate
+
+
+def test_plate_ocr_takes_near_cache_hits(monkeypatch, tmp_path):
+    import cv2
+    from ocr_cache import OCRCache
+
+    reader = FakeReader(conf=0.7)
+    monkeypatch.setattr(analysis, "ocr_reader", reader)
+    monkeypatch.setattr(analysis, "gemini_client", FailingGemini())
+    monkeypatch.setattr(analysis, "template_bank", None)
+    monkeypatch.setattr(analysis, "ocr_cache", OCRCache(str(tmp_path / "c.db"), max_distance=analysis.OCR_CACHE_MAX_DISTANCE))
+    analysis.ocr_cache.put(analysis.disk_phashes(make_text_disk())[0], "MEM 10", 0.9, "easyocr")
+
+    # The same print re-captured: shifted, speckled and re-thresholded
+    perturbed = make_text_disk(-4, 3)
+    ys, xs = np.random.default_rng(0).integers(0, 640, (2, 300))
+    perturbed[ys, xs] = 255 - perturbed[ys, xs]
+    perturbed = np.where(cv2.GaussianBlur(perturbed, (3, 3), 0) < 128, 0, 255).astype(np.uint8)
+    stored = analysis.disk_phashes(make_text_disk())[0]
+    distance = min((stored ^ h).bit_count() for h in analysis.disk_phashes(perturbed))
+    assert 0 < distance <= analysis.OCR_CACHE_MAX_DISTANCE
+
+    assert analysis.extract_medicine_ocr_plate([perturbed]) == [("MEM 10", 0.9, 0, 0)]
+    assert reader.batched_calls + reader.readtext_calls == 0
+    assert analysis.ocr_cache.snapshot()["near_hits"] == 1
+
+
+def make_lexicon():
+    from types import SimpleNamespace as Row
+
+    return analysis.build_ocr_lexicon([
+        Row(antibiotic_id=1, abbreviation="MEM", concentration_ug=10),
+        Row(antibiotic_id=2, abbreviation="CN", concentration_ug=10),
+        Row(antibiotic_id=3, abbreviation="CN", concentration_ug=30),
+        Row(antibiotic_id=4, abbreviation="OX", concentration_ug=0),
+        Row(antibiotic_id=5, abbreviation="MEM", concentration_ug=10),  # shared code, resolved per microbe
+        Row(antibiotic_id=6, abbreviation=None, concentration_ug=0),
+    ])
+
+
+def test_decode_with_lexicon():
+    lexicon = make_lexicon()
+    assert lexicon["codes"] == ["MEM 10", "CN 10", "CN 30", "OX"]
+    assert set(lexicon["allowlist"]) == set("MECNOX0123456789.")
+    assert lexicon["id_by_code"] == {"MEM 10": None, "CN 10": 2, "CN 30": 3, "OX": 4}
+
+    scores, codes = analysis.decode_with_lexicon(["MEM10", "CN 3O", "0X", "ZZZZZZ", "", "CM 1O"], [0.7, 0.6, 0.5, 0.9, 0.9, 0.9], lexicon)
+    assert codes[:3] == ["MEM 10", "CN 30", "OX"]
+    assert scores[0] == pytest.approx(1.0)
+    # O for 0 is a quarter of an edit: 1 - 0.25 / 4
+    assert scores[1] == pytest.approx(0.9375 * 0.9)
+    # Short codes survive a confusable swap: 1 - 0.25 / 2
+    assert scores[2] == pytest.approx(0.875 * 0.8)
+    assert scores[3] == 0 and scores[4] == 0
+    # A real misread (M for N) is scored but not trusted: the text is kept for the fuzzy matcher
+    assert codes[5] == "CM 1O" and scores[5] == pytest.approx(0.6875)
+
+
+def test_lexicon_does_not_snap_out_of_scope_codes():
+    from types import SimpleNamespace as Row
+
+    # Narrowed to the microbe's breakpoint rows, where meropenem is missing
+    in_scope = analysis.build_ocr_lexicon([
+        Row(antibiotic_id=7, abbreviation="IPM", concentration_ug=10),
+        Row(antibiotic_id=2, abbreviation="CN", concentration_ug=10),
+    ])
+    # "MEM10" is 0.6 similar to "IPM 10": enough to score, not to become it
+    scores, codes = analysis.decode_with_lexicon(["MEM10", "IPM10", "1PM 10"], [0.9] * 3, in_scope)
+    assert codes == ["MEM10", "IPM 10", "IPM 10"]
+    assert scores[0] == pytest.approx(0.6)
+    assert in_scope["id_by_code"].get(codes[0]) is None
+    assert analysis._decode_one("MEM 10", 0.9, in_scope) == ("MEM 10", 0.6)
+
+
+def test_easyocr_search_decodes_to_lexicon(monkeypatch):
+    monkeypatch.setattr(analysis, "ocr_reader", FakeReader(conf=0.7))
+    text, conf, _, _ = analysis.extract_medicine_easyocr(make_disk(0), lexicon=make_lexicon())
+    assert (text, conf) == ("MEM 10", 1.0)
+    assert make_lexicon()["id_by_code"][text] is None
+
+
+def make_other_disk(angle=0):
+    """Binary disk with two short blocks, a different 'code' from make_disk."""
+    img = np.full((640, 640), 255, dtype=np.uint8)
+    img[280:360, 360:420] = 0
+    img[280:360, 470:530] = 0
+    return analysis.rotate_image(img, angle)
+
+
+def test_template_bank_matches_any_rotation(tmp_path):
+    from disk_templates import TemplateBank
+
+    path = str(tmp_path / "templates.db")
+    bank = TemplateBank(path)
+    bank.add(analysis.disk_signature(make_disk(0)), 1, "MEM 10")
+    bank.add(analysis.disk_signature(make_other_disk(0)), 2, "CN 10")
+
+    for angle in (0, 45, 135, -100):
+        ab_id, code, score, runner_up, _ = bank.match(analysis.disk_signature(make_disk(angle)))
+        assert (ab_id, code) == (1, "MEM 10")
+        assert score > 0.9 and score - runner_up > 0.05
+
+    # Templates persist across processes
+    assert TemplateBank(path).match(analysis.disk_signature(make_other_disk(70)))[:2] == (2, "CN 10")
+
+
+def test_learned_tiers_refresh_across_processes(tmp_path):
+    from disk_templates import TemplateBank
+    from ocr_cache import OCRCache
+
+    # Two handles on one file stand in for the API process and a worker
+    api, worker = TemplateBank(str(tmp_path / "t.db")), TemplateBank(str(tmp_path / "t.db"))
+    assert len(worker) == 0 and not worker.refresh()
+    api.add(analysis.disk_signature(make_other_disk(0)), 2, "CN 10")
+    assert worker.match(analysis.disk_signature(make_other_disk(0))) is None
+    assert worker.refresh() and not worker.refresh()
+    assert worker.match(analysis.disk_signature(make_other_disk(0)))[:2] == (2, "CN 10")
+
+    api, worker = OCRCache(str(tmp_path / "c.db")), OCRCache(str(tmp_path / "c.db"))
+    api.put(0b1011, "CN 30", 0.5, "easyocr")
+    assert worker.get(0b1011)[0] == "CN 30"
+    api.put(0b1011, "CN 10", 1.0, "confirmed")
+    assert worker.get(0b1011)[0] == "CN 30"  # stale memory tier
+    assert worker.refresh()
+    assert worker.get(0b1011)[:3] == ("CN 10", 1.0, "confirmed")
+
+
+def test_plate_ocr_uses_confirmed_template(monkeypatch, tmp_path):
+    from disk_templates import TemplateBank
+
+    reader = FakeReader(conf=0.7)
+    monkeypatch.setattr(analysis, "ocr_reader", reader)
+    monkeypatch.setattr(analysis, "gemini_client", None)
+    monkeypatch.setattr(analysis, "ocr_cache", None)
+    monkeypatch.setattr(analysis, "template_bank", TemplateBank(str(tmp_path / "t.db")))
+    analysis.template_bank.add(analysis.disk_signature(make_other_disk(0)), 2, "CN 10")
+    # One learned antibiotic leaves no runner-up to measure a margin against: nothing is matched
+    assert analysis.classify_disk_template(make_other_disk(60)) is None
+
+    cross = np.full((640, 640), 255, dtype=np.uint8)
+    cross[200:440, 310:330] = 0
+    analysis.template_bank.add(analysis.disk_signature(cross), 4, "OX")
+    results = analysis.extract_medicine_ocr_plate([make_other_disk(60), make_disk(0)])
+
+    assert results[0][0] == "CN 10" and results[0][3] == 0
+    assert results[1][0] == "MEM 10"  # no confident template, read by EasyOCR
+    assert reader.batched_calls + reader.readtext_calls > 0
+
+
+@pytest.fixture
+def gemini_server(monkeypatch):
+    """Local stand-in for the Gemini generateContent REST endpoint; analysis.gemini_client points at it."""
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from gemini_client import GeminiClient
+
+    state = {"requests": [], "plate_answer": "[]", "disk_answer": "CN 10", "status": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            prompt = body["contents"][0]["parts"][0]["text"]
+            state["requests"].append((self.path, prompt))
+            status = state["status"].pop(0) if state["status"] else 200
+            if status == 200:
+                answer = state["plate_answer"] if "grid" in prompt else state["disk_answer"]
+                payload = json.dumps({"candidates": [{
+                    "content": {"parts": [{"text": answer}], "role": "model"},
+                    "finishReason": "STOP", "index": 0,
+                }]}).encode()
+            else:
+                payload = json.dumps({"error": {"code": status, "status": "RESOURCE_EXHAUSTED"}}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["client"] = GeminiClient("test-key", endpoint=f"http://127.0.0.1:{server.server_port}",
+                                   rate_per_minute=6000, timeout=5, recovery_time=0.2)
+    monkeypatch.setattr(analysis, "gemini_client", state["client"])
+    monkeypatch.setattr(analysis, "ocr_cache", None)
+    monkeypatch.setattr(analysis, "template_bank", None)
+    yield state
+    server.shutdown()
+
+
+def test_parse_gemini_plate_response():
+    assert analysis.parse_gemini_plate_response(
+        '```json\n[{"index": 0, "code": "mem 10"}, {"index": 2, "code": null}, {"index": 9, "code": "CN 10"}]\n```', 3
+    ) == ["MEM 10", None, None]
+    assert analysis.parse_gemini_plate_response('{"1": "OX"}', 2) == [None, "OX"]
+    assert analysis.parse_gemini_plate_response("not json", 2) == [None, None]
+
+
+def test_gemini_plate_mode_single_request(gemini_server, monkeypatch):
+    monkeypatch.setattr(analysis, "ocr_reader", None)
+    gemini_server["plate_answer"] = '[{"index": 0, "code": "MEM 10"}, {"index": 1, "code": null}, {"index": 2, "code": "OX"}]'
+    disks = [make_disk(0), make_other_disk(0), make_disk(90)]
+
+    results = analysis.extract_medicine_ocr_plate(disks)
+
+    assert [r[0] for r in results] == ["MEM 10", "CN 10", "OX"]
+    assert results[0][1] == 0.98
+    # One montage request, then a per-disk request only for the unread index
+    prompts = [prompt for _, prompt in gemini_server["requests"]]
+    assert len(prompts) == 2 and "grid" in prompts[0] and "grid" not in prompts[1]
+    assert gemini_server["requests"][0][0].startswith("/v1beta/models/gemini-2.0-flash:generateContent")
+
+
+def test_gemini_breaker_opens_on_quota_and_recovers(gemini_server):
+    import time
+
+    client = gemini_server["client"]
+    gemini_server["status"] = [429]
+
+    assert analysis.extract_medicine_gemini(make_disk(0)) == (None, 0.0)
+    assert client.snapshot()["breaker"]["state"] == "open"
+    # While open, calls never reach the server
+    assert analysis.extract_medicine_gemini(make_disk(0)) == (None, 0.0)
+    assert len(gemini_server["requests"]) == 1
+
+    time.sleep(0.25)
+    assert analysis.extract_medicine_gemini(make_disk(0)) == ("CN 10", 0.98)
+    assert client.snapshot()["breaker"] == {"state": "closed", "consecutive_failures": 0, "trips": 1, "retry_in_s": 0.0}
+
+
+def test_token_bucket_limits_rate():
+    import asyncio
+    import time
+
+    from gemini_client import TokenBucket
+
+    async def take(n):
+        bucket = TokenBucket(rate=20, capacity=2)
+        start = time.monotonic()
+        for _ in range(n):
+            assert await bucket.acquire()
+        assert not await bucket.acquire(max_wait=0.01)
+        return time.monotonic() - start
+
+    # 2 burst tokens, then 20 per second
+    assert 0.18 <= asyncio.run(take(6)) < 0.5
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_plate_easyocr_thread_pool_keeps_order(monkeypatch, batched):
+    import threading
+
+    readers = {}
+
+    def create_reader():
+        reader = FakeReader()
+        readers[threading.current_thread().name] = reader
+        return reader
+
+    monkeypatch.setattr(analysis, "ocr_reader", FakeReader())
+    monkeypatch.setattr(analysis, "_create_reader", create_reader)
+    monkeypatch.setattr(analysis, "gemini_client", None)
+    monkeypatch.setattr(analysis, "ocr_cache", None)
+    monkeypatch.setattr(analysis, "template_bank", None)
+    monkeypatch.setattr(analysis, "OCR_BATCHED", batched)
+    monkeypatch.setattr(analysis, "OCR_EARLY_EXIT_CONF", 2.0)
+    blank = np.full((640, 640), 255, dtype=np.uint8)
+    disks = [make_disk(0), blank, make_disk(70), make_disk(-120), blank, make_disk(30)]
+
+    monkeypatch.setattr(analysis, "OCR_WORKERS", 1)
+    expected = analysis.extract_medicine_ocr_plate(disks)
+    monkeypatch.setattr(analysis, "OCR_WORKERS", 3)
+    results = analysis.extract_medicine_ocr_plate(disks)
+
+    assert results == expected
+    assert [r[0] for r in results] == ["MEM 10", "Unknown", "MEM 10", "MEM 10", "Unknown", "MEM 10"]
+    # Work ran on pool threads, each with its own reader
+    assert readers and all(name.startswith("ocr") for name in readers)
+    assert len(set(map(id, readers.values()))) == len(readers)
+
+
+def test_assign_zones_to_disks_one_to_one_with_gate():
+    disks = [[90, 90, 110, 110], [190, 90, 210, 110], [500, 500, 520, 520]]
+    zones = [
+        [60, 60, 140, 140],   # around disk 0
+        [70, 60, 150, 140],   # also closest to disk 0, must not take it twice
+        [150, 50, 250, 150],  # around disk 1
+        [800, 800, 860, 860], # no disk inside its radius
+    ]
+    assert analysis.assign_zones_to_disks(zones, disks) == [0, -1, 1, -1]
+    # A loose gate lets the far disk go to the nearer of the two leftover zones
+    assert analysis.assign_zones_to_disks(zones, disks, gate=40) == [0, -1, 1, 2]
+    assert analysis.assign_zones_to_disks([], disks) == []
+    assert analysis.assign_zones_to_disks(zones, []) == [-1, -1, -1, -1]
+
+
+def test_decoded_upload_is_shared_without_rereading(tmp_path):
+    import cv2
+
+    ok, encoded = cv2.imencode(".png", np.dstack([make_disk(0)] * 3))
+    image = analysis.decode_image_bytes(encoded.tobytes())
+    assert image.shape == (640, 640, 3)
+    assert analysis.decode_image_bytes(b"not an image") is None
+    assert analysis.load_image(image) is image
+
+    before = image.copy()
+    url = analysis.draw_detections_on_image(image, [{"bbox": [100, 100, 300, 300], "medicine_name": "MEM 10"}], str(tmp_path))
+    assert url.startswith("/uploaded_images/detection_result_")
+    assert np.array_equal(image, before)
+
+
+def test_plate_image_detects_on_reduced_decode(tmp_path):
+    import io
+
+    from PIL import Image
+
+    # 3000x2000 JPEG stored sideways (EXIF orientation 6: displayed as 2000x3000)
+    pixels = np.full((2000, 3000, 3), 200, dtype=np.uint8)
+    pixels[100:300, 100:400] = 0
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", exif=exif)
+
+    plate = analysis.PlateImage(buffer.getvalue(), min_side=1280)
+    assert plate.size == (2000, 3000)
+    assert plate.factor == 2
+    assert plate.detection.shape == (1500, 1000, 3)
+    assert plate._full is None
+    assert plate.scale == (2.0, 2.0)
+    assert analysis.load_image(plate).shape == (3000, 2000, 3)
+
+    assert analysis.PlateImage(buffer.getvalue(), min_side=0).factor == 1
+    assert analysis.PlateImage(buffer.getvalue(), min_side=400).factor == 4
+    assert analysis.PlateImage(b"not an image").detection is None
+
+
+def _reference_pipeline_4(gray):
+    """Pipeline 4 as written before it was split into stages."""
+    import cv2
+
+    img = cv2.GaussianBlur(cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8)).apply(gray), (7, 7), 0)
+    lap = cv2.convertScaleAbs(cv2.Laplacian(img, cv2.CV_16S, ksize=5, scale=1, delta=0))
+    img = cv2.adaptiveThreshold(cv2.addWeighted(img, 1.5, lap, 0.5, 0), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, blockSize=49, C=6)
+    kernel = np.ones((2, 2), np.uint8)
+    img = cv2.dilate(cv2.bitwise_not(img), kernel, iterations=1)
+    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)), iterations=1)
+    return cv2.bitwise_not(cv2.erode(img, kernel, iterations=1))
+
+
+def _reference_denoise_otsu(gray):
+    """denoise_otsu as written before it was split into stages."""
+    import cv2
+
+    img = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(gray)
+    kernel = np.array([[-0.5, -0.5, -0.5], [-0.5, 5, -0.5], [-0.5, -0.5, -0.5]])
+    img = cv2.GaussianBlur(np.clip(cv2.filter2D(img, -1, kernel), 0, 255).astype(np.uint8), (3, 3), 0)
+    inverted = cv2.bitwise_not(cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1])
+    ratio = np.sum(inverted == 255) / inverted.size
+    rect = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
+    if ratio < 0.15:
+        inverted = cv2.dilate(inverted, rect, iterations=1)
+    elif ratio > 0.35:
+        inverted = cv2.erode(inverted, rect, iterations=1)
+    return cv2.bitwise_not(inverted)
+
+
+def test_preprocess_graph_shares_prefixes(monkeypatch):
+    import preprocessing
+
+    # A grey, noisy print so every stage changes the image
+    rng = np.random.default_rng(0)
+    ramp = np.linspace(60, 140, 640)[None, :]
+    gray = np.clip(make_disk(0) * 0.5 + ramp + rng.normal(0, 12, (640, 640)), 0, 255).astype(np.uint8)
+
+    graph = preprocessing.PreprocessGraph(gray)
+    outputs = graph.run_many(["clahe", "denoise_otsu", "pipeline_4"])
+    # denoise_otsu reuses the CLAHE(2.0) stage computed for "clahe"; pipeline_4 uses CLAHE(3.0)
+    assert graph.stats == {"computed": 1 + 6 + 9, "reused": 1}
+    assert np.array_equal(outputs["pipeline_4"], _reference_pipeline_4(gray))
+    assert np.array_equal(outputs["denoise_otsu"], _reference_denoise_otsu(gray))
+    assert np.array_equal(preprocessing.preprocess(gray, "pipeline_4"), _reference_pipeline_4(gray))
+    assert preprocessing.get_clahe(2.0, 8) is preprocessing.get_clahe(2.0, 8)
+
+    # Registered for this test only
+    monkeypatch.setitem(preprocessing.PIPELINES, "test_clahe_otsu", [])
+    preprocessing.register_pipeline("test_clahe_otsu", [["clahe", {"clip": 2.0}], ["otsu", {}]])
+    graph.run("test_clahe_otsu")
+    assert graph.stats["reused"] == 2
+    with pytest.raises(ValueError):
+        preprocessing.register_pipeline("broken", [("no_such_stage", {})])
+    with pytest.raises(KeyError):
+        graph.run("no_such_pipeline")
+
+
+def test_radial_zone_measurement_matches_synthetic_plates():
+    import cv2
+
+    import synthetic_plates
+    import zone_profile
+
+    img, truth = synthetic_plates.render_plate(11, size=1800, disks=6, noise=4.0)
+    disks = [zone_profile.disk_circle(d["disk_bbox"]) for d in truth["disks"]]
+    disk_mm = truth["disks"][0]["disk_diameter_mm"]
+    measured = zone_profile.measure_zones(img, disks, disk_mm=disk_mm)
+    for d, m in zip(truth["disks"], measured):
+        assert abs(m["diameter_mm"] - d["zone_diameter_mm"]) < 0.5
+        if d["zone_diameter_mm"] > disk_mm + 2:
+            assert m["coverage"] > 0.9 and m["spread_mm"] < 1.0
+
+    # No zone around the disk: plain lawn reads as the disk itself
+    lawn = np.full((400, 400), 200, np.uint8)
+    cv2.circle(lawn, (200, 200), 20, 250, -1)
+    assert zone_profile.measure_zones(lawn, [(200, 200, 20)], disk_mm=6.0) == [
+        {"diameter_mm": 6.0, "spread_mm": 0.0, "coverage": 0.0, "contrast": 0.0}
+    ]
+    # A disk at the image edge: rays leaving the image are skipped, the rest still measure the zone
+    edge = np.full((400, 400), 200, np.uint8)
+    cv2.circle(edge, (30, 200), 60, 90, -1)
+    cv2.circle(edge, (30, 200), 20, 250, -1)
+    (m,) = zone_profile.measure_zones(edge, [(30, 200, 20)], disk_mm=6.0)
+    assert abs(m["diameter_mm"] - 18.0) < 0.5 and 0.2 < m["coverage"] < 0.8
+
+
+def test_hough_detection_and_auto_mode(monkeypatch):
+    import cv2
+
+    import benchmark
+    import synthetic_plates
+
+    img, truth = synthetic_plates.render_plate(4, size=2000, disks=6, noise=3.0)
+    disks, zones, confidence = analysis.detect_hough(img)
+    assert len(disks) == 6 and confidence >= analysis.HOUGH_MIN_CONFIDENCE
+    centres = [((b["bbox"][0] + b["bbox"][2]) / 2, (b["bbox"][1] + b["bbox"][3]) / 2) for b in disks]
+    disk_radius = truth["disks"][0]["disk_diameter_mm"] / 2 * truth["px_per_mm"]
+    for d in truth["disks"]:
+        assert min(np.hypot(x - d["center"][0], y - d["center"][1]) for x, y in centres) < 0.1 * disk_radius
+    assert all(set(z) == {"bbox", "confidence", "radial"} for z in zones)
+    assert analysis.detect_hough(np.full((600, 600, 3), 128, np.uint8)) == ([], [], 0.0)
+
+    calls = []
+    stub = benchmark.StubDetector()
+    monkeypatch.setattr(analysis, "model", lambda images, **kw: calls.append(1) or stub(images))
+    monkeypatch.setattr(analysis, "detector_batcher", None)
+    monkeypatch.setattr(analysis, "ocr_reader", FakeReader())
+    for name in ("ocr_cache", "template_bank", "gemini_client"):
+        monkeypatch.setattr(analysis, name, None)
+    monkeypatch.setattr(analysis, "OCR_WORKERS", 1)
+    plate = analysis.PlateImage(cv2.imencode(".jpg", img)[1].tobytes())
+
+    # Confident Hough result: YOLO is not called, and the results keep the YOLO path's shape
+    monkeypatch.setattr(analysis, "DETECTION_MODE", "auto")
+    results = analysis.analyze_disk_image(plate)
+    assert not calls and len(results) == 6
+    measured = sorted(r["diameter_mm"] for r in results if r["zone_measurement"] == "radial")
+    expected = sorted(d["zone_diameter_mm"] for d in truth["disks"] if d["zone_diameter_mm"] > d["disk_diameter_mm"] + 1)
+    assert len(measured) == len(expected) and np.allclose(measured, expected, atol=0.6)
+    # Low confidence escalates to YOLO
+    monkeypatch.setattr(analysis, "HOUGH_MIN_CONFIDENCE", 1.01)
+    analysis.analyze_disk_image(plate)
+    assert calls == [1]
+
+
+def test_metrics_exposition_and_worker_merge():
+    from metrics import Registry
+
+    worker = Registry()
+    stage = worker.histogram("stage_seconds", "Stage time.", ["stage"], buckets=(0.1, 1.0))
+    hits = worker.counter("hits_total", "Cache hits.", ["endpoint"])
+    busy = worker.gauge("busy", "In flight.", ["endpoint"])
+    stage.observe(0.05, stage="detect")
+    stage.observe(0.5, stage="detect")
+    stage.observe(3.0, stage="detect")
+    hits.inc(2, endpoint="/analyze")
+    busy.inc(endpoint="/analyze")
+    with pytest.raises(ValueError):
+        hits.inc(endpoint="/analyze", engine="x")
+
+    text = worker.render()
+    assert "# TYPE stage_seconds histogram" in text
+    assert 'stage_seconds_bucket{stage="detect",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="detect",le="+Inf"} 3' in text
+    assert 'stage_seconds_count{stage="detect"} 3' in text
+    assert 'hits_total{endpoint="/analyze"} 2' in text
+
+    api = Registry()
+    api_stage = api.histogram("stage_seconds", "Stage time.", ["stage"], buckets=(0.1, 1.0))
+    api_hits = api.counter("hits_total", "Cache hits.", ["endpoint"])
+    api_stage.observe(0.2, stage="detect")
+    delta = worker.drain()
+    assert set(delta) == {"stage_seconds", "hits_total"}  # gauges stay per process
+    api.merge(delta)
+    api.merge(worker.drain())  # drained: nothing more to add
+    assert api_stage.count(stage="detect") == 4 and api_hits.value(endpoint="/analyze") == 2
+    assert stage.count(stage="detect") == 0 and busy.value(endpoint="/analyze") == 1
+
+
+def test_structured_logs_carry_plate_and_stage_levels(monkeypatch):
+    import io
+    import json
+    import logging
+
+    import logs
+
+    # Reconfigure onto a buffer; the app's stdout listener (if any) is restored afterwards
+    configured = logs._listener is not None
+    logs.shutdown()
+    monkeypatch.setattr(logs, "LOG_LEVEL", "INFO")
+    monkeypatch.setattr(logs, "LOG_STAGE_LEVELS", "ocr=DEBUG,bogus")
+    monkeypatch.setattr(analysis, "OCR_WORKERS", 2)
+    buffer = io.StringIO()
+    logs.configure(stream=buffer)
+    token = logs.current_plate.set("plate-1")
+    try:
+        analysis.ocr_map(lambda i: analysis.ocr_log.debug("disk %d", i, extra={"duration_ms": 1.5}), range(3))
+        analysis.log.debug("dropped at INFO")
+        analysis.log.info("kept")
+    finally:
+        logs.current_plate.reset(token)
+        logs.shutdown()
+        logs.get_logger("ocr").setLevel(logging.NOTSET)
+        if configured:
+            logs.configure()
+
+    records = [json.loads(line) for line in buffer.getvalue().splitlines()]
+    assert sorted(r["msg"] for r in records) == ["disk 0", "disk 1", "disk 2", "kept"]
+    # Pool threads log under the caller's plate
+    assert all(r["plate_id"] == "plate-1" for r in records)
+    ocr = [r for r in records if r["stage"] == "ocr"]
+    assert len(ocr) == 3 and all(r["level"] == "DEBUG" and r["duration_ms"] == 1.5 for r in ocr)
+    assert logs.parse_stage_levels("ocr=DEBUG, gemini=warning,x=LOUD") == {"ocr": logging.DEBUG, "gemini": logging.WARNING}
+
+
+def test_micro_batcher_groups_concurrent_requests():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    from batching import MicroBatcher
+
+    calls = []
+
+    def batch_fn(items):
+        calls.append((threading.current_thread().name, list(items)))
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(batch_fn, max_batch=4, window_ms=50, name="test-batcher")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(batcher, range(8)))
+
+    assert results == [i * 2 for i in range(8)]
+    assert len(calls) < 8 and max(len(items) for _, items in calls) <= 4
+    assert {name for name, _ in calls} == {"test-batcher"}
+    with pytest.raises(ValueError):
+        batcher("bad")
+    assert batcher.snapshot()["items"] == 9
+
+    # A bad item sharing a batch fails alone; its neighbours are retried one by one
+    calls.clear()
+    futures = [batcher.submit(item) for item in (1, "bad", 2, 3)]
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    assert [futures[i].result(timeout=5) for i in (0, 2, 3)] == [2, 4, 6]
+    assert calls[0][1] == [1, "bad", 2, 3] and [items for _, items in calls[1:]] == [[1], ["bad"], [2], [3]]
+    snapshot = batcher.snapshot()
+    assert snapshot["split_batches"] == 1 and snapshot["failed_items"] == 2 and snapshot["items"] == 13
+
+
+def test_model_registry_loads_once_and_remembers_failures():
+    from model_registry import ModelRegistry
+
+    loads, warmups = [], []
+    registry = ModelRegistry()
+    registry.register("good", lambda: loads.append(1) or "model", warmup=warmups.append)
+    registry.register("broken", lambda: 1 / 0, required=False)
+
+    assert registry.get("good") == "model" and registry.get("good") == "model"
+    assert len(loads) == 1 and warmups == []  # loaded on demand, no warm-up
+    assert registry.get("broken") is None and registry.get("broken") is None
+    assert registry.status()["broken"]["state"] == "failed"
+    assert registry.ready()  # broken is optional
+
+    registry = ModelRegistry()
+    registry.register("good", lambda: "model", warmup=warmups.append)
+    registry.warm_up()
+    assert warmups == ["model"] and registry.status()["good"]["state"] == "ready"
+
+
+@pytest.mark.parametrize("workers,shm_slots", [(0, 0), (1, 0), (1, 2)])
+def test_analysis_pool_runs_uploads(tmp_path, workers, shm_slots):
+    import asyncio
+
+    import cv2
+    import metrics
+    from analysis_workers import AnalysisPool, decode_upload
+
+    pool = AnalysisPool(workers=workers, torch_threads=1, shm_slots=shm_slots)
+    pool.start()
+    try:
+        png = cv2.imencode(".png", np.dstack([make_disk(0)] * 3))[1].tobytes()
+        renders = metrics.STAGE_SECONDS.count(stage="render")
+        results, url = asyncio.run(pool.run(png, None, str(tmp_path), image=decode_upload(png)))
+        assert isinstance(results, list)
+        assert url.startswith("/uploaded_images/") and os.listdir(tmp_path)
+        # Recorded in the worker process and merged back into this one
+        assert metrics.STAGE_SECONDS.count(stage="render") == renders + 1
+        assert asyncio.run(pool.run(b"not an image", None, str(tmp_path))) is None
+        snapshot = pool.snapshot()
+        assert snapshot["completed"] == 2 and snapshot["shared_memory"] == (1 if shm_slots else 0)
+        assert pool.ready() == bool(workers)
+    finally:
+        pool.shutdown()
+
+
+def test_analysis_pool_keeps_slot_until_worker_finishes(monkeypatch):
+    import asyncio
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    import analysis_workers
+
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_analysis(handle, *args):
+        started.set()
+        release.wait(5)
+        return [], None
+
+    monkeypatch.setattr(analysis_workers, "analyze_shared", slow_analysis)
+    pool = analysis_workers.AnalysisPool(workers=1, shm_slots=1, shm_slot_bytes=640 * 640 * 3)
+    # A thread stands in for the worker process: the task keeps running after the request is cancelled
+    pool._executor = ThreadPoolExecutor(1)
+    pool._ring = analysis_workers.SharedImageRing(1, pool.shm_slot_bytes)
+    image = np.dstack([make_disk(0)] * 3)
+
+    async def cancelled_request():
+        task = asyncio.ensure_future(pool.run(b"", None, image=image))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(cancelled_request())
+        assert pool._ring.write(image) is None  # still in use by the worker
+        release.set()
+        pool._executor.shutdown(wait=True)
+        assert pool._ring.write(image) is not None
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_shared_image_ring_hands_off_without_copy():
+    from analysis_workers import SharedImageRing, attach_image
+
+    ring = SharedImageRing(slots=1, slot_bytes=640 * 640 * 3)
+    try:
+        image = np.dstack([make_disk(30)] * 3)
+        handle = ring.write(image)
+        assert ring.write(image) is None  # the only slot is taken
+        view = attach_image(handle)
+        assert np.array_equal(view, image)
+        # The view maps the slot itself: writes through the ring are visible in place
+        ring.release(handle)
+        handle = ring.write(255 - image)
+        assert np.array_equal(view, 255 - image)
+        assert ring.write(np.zeros((700, 700, 3), np.uint8)) is None  # larger than a slot
+        ring.release(handle)
+        # Several arrays share a slot, each at its own offset
+        small = image[::2, ::2].copy()
+        handle = ring.write(small, small[::2, ::2].copy())
+        assert np.array_equal(attach_image(handle, 1), small[::2, ::2])
+        assert np.array_equal(attach_image(handle), small)
+        del view
+    finally:
+        import analysis_workers
+        for block in analysis_workers._attached.values():
+            block.close()
+        analysis_workers._attached.clear()
+        ring.close()
+
+
+def test_shared_plate_keeps_reduced_detection_decode(monkeypatch, tmp_path):
+    import cv2
+
+    import analysis_workers
+
+    monkeypatch.setattr(analysis, "DETECTION_MIN_SIDE", 1280)
+    jpeg = cv2.imencode(".jpg", np.full((1920, 2560, 3), 200, dtype=np.uint8))[1].tobytes()
+    plate = analysis_workers.decode_upload(jpeg)
+    assert plate.factor == 2
+    assert analysis_workers.decode_upload(b"not an image") is None
+
+    seen = {}
+
+    def fake_analysis(image, lexicon=None):
+        seen["detection"], seen["scale"] = image.detection.shape, image.scale
+        return []
+
+    monkeypatch.setattr(analysis, "analyze_disk_image", fake_analysis)
+    monkeypatch.setattr(analysis, "draw_detections_on_image", lambda image, results, output_dir: "/uploaded_images/x.jpg")
+    ring = analysis_workers.SharedImageRing(slots=1, slot_bytes=32 << 20)
+    try:
+        handle = ring.write(plate.full, plate.detection)
+        assert analysis_workers.analyze_shared(handle, None, str(tmp_path)) == ([], "/uploaded_images/x.jpg")
+        # The worker detects on the API's reduced decode, not on the full-resolution array
+        assert seen == {"detection": (960, 1280, 3), "scale": (2.0, 2.0)}
+    finally:
+        for block in analysis_workers._attached.values():
+            block.close()
+        analysis_workers._attached.clear()
+        ring.close()
@@ -27,3 +27,88 @@ def test_missing_auth():
     response = client.get("/users/me")
     assert response.status_code == 401
     assert response.json()["detail"] == "Not authenticated"
+
+def test_health_endpoints(monkeypatch):
+    import analysis
+    from model_registry import ModelRegistry
+
+    registry = ModelRegistry()
+    registry.register("detector", lambda: object(), warmup=lambda m: None)
+    monkeypatch.setattr(analysis, "registry", registry)
+
+    assert client.get("/health/live").json() == {"status": "ok"}
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["models"]["detector"]["state"] == "registered"
+
+    registry.start_background().join(timeout=5)
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+
+def test_ocr_stats_requires_auth():
+    assert client.get("/ocr/stats").status_code == 401
+
+def test_metrics_endpoint():
+    import metrics
+
+    with metrics.timed("detect"):
+        pass
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'zone_analyzer_stage_seconds_count{stage="detect"}' in response.text
+    assert "# TYPE zone_analyzer_gemini_fallbacks_total counter" in response.text
+
+    # Breaker state and turned-away calls of a Gemini client whose breaker tripped
+    from gemini_client import GeminiClient
+
+    gemini = GeminiClient("test-key", failure_threshold=1)
+    rejected = metrics.GEMINI_REJECTED.value()
+    gemini.breaker.record_failure()
+    assert gemini.generate("prompt", b"") is None
+    text = client.get("/metrics").text
+    assert "zone_analyzer_gemini_breaker_state 2" in text
+    assert metrics.GEMINI_REJECTED.value() == rejected + 1
+    assert f"zone_analyzer_gemini_rejected_total {int(rejected) + 1}" in text
+    gemini.breaker.record_success()
+    assert "zone_analyzer_gemini_breaker_state 0" in client.get("/metrics").text
+
+def test_profiles_endpoints(tmp_path, monkeypatch):
+    import threading
+    import profiler
+
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    assert client.get("/profiles").status_code == 404  # disabled without PROFILE_TOKEN
+    assert profiler.should_profile({}) is None
+    monkeypatch.setattr(profiler, "PROFILE_TOKEN", "secret")
+    assert client.get("/profiles", headers={"X-Profile-Token": "wrong"}).status_code == 403
+    assert profiler.should_profile({"X-Profile-Token": "secret"}) == "header"
+
+    def busy_loop_for_profile(stop):
+        while not stop.is_set():
+            sum(i * i for i in range(1000))
+
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop_for_profile, args=(stop,), name="busy")
+    profile = profiler.SamplingProfiler(interval_ms=2).start()
+    worker.start()
+    blocks = [bytearray(1 << 20) for _ in range(4)]
+    threading.Event().wait(0.2)
+    stop.set()
+    worker.join()
+    profile.stop()
+    del blocks
+    assert profile.samples > 10 and profile.peak_memory >= 4 << 20
+    assert any(stack.startswith("busy;") and "busy_loop_for_profile" in stack for stack in profile.stacks)
+    profile.add({"stacks": {"run (x.py:1)": 3}, "peak_memory": 1}, prefix="analysis-worker")
+
+    profiler.save_profile("plate-1", profile, "/analyze", "header")
+    headers = {"X-Profile-Token": "secret"}
+    listed = client.get("/profiles", headers=headers).json()
+    assert [p["plate_id"] for p in listed] == ["plate-1"] and listed[0]["peak_memory_kb"] >= 4096
+    folded = client.get("/profiles/plate-1", headers=headers).text.splitlines()
+    assert "analysis-worker;run (x.py:1) 3" in folded
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in folded)
+    assert client.get("/profiles/plate-1.json", headers=headers).status_code == 404
+    assert client.get("/profiles/missing", headers=headers).status_code == 404
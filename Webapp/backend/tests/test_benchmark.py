@@ -0,0 +1,38 @@
+import argparse
+import json
+import sys
+import os
+
+# Add parent directory to path to allow importing benchmark
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+import benchmark
+
+
+def test_benchmark_runs_offline_with_stubs(tmp_path, monkeypatch):
+    # run() swaps in stubs and switches caches off; restore the module afterwards
+    for name in ("model", "ocr_reader", "_create_reader", "ocr_cache", "template_bank", "gemini_client"):
+        monkeypatch.setattr(analysis, name, getattr(analysis, name))
+
+    out = tmp_path / "bench.json"
+    args = argparse.Namespace(
+        images=str(tmp_path), synthetic=1, limit=1, repeat=2, warmup=0, models="stub",
+        microbe=None, no_alloc=False, out=str(out), verbose=False,
+    )
+    report = benchmark.run(args)
+
+    assert json.loads(out.read_text()) == report
+    assert report["meta"]["models"] == {"detector": "stub", "ocr": "stub"}
+    stages = report["stages"]
+    assert set(benchmark.STAGES) <= set(stages)
+    # 6 disks per synthetic plate, 2 timed repeats
+    assert stages["crop"]["count"] == 12 and stages["handler"]["count"] == 2
+    assert stages["analyze"]["p50_ms"] <= stages["analyze"]["p99_ms"]
+    assert "alloc_peak_kb" in stages["decode"]
+
+    slower = json.loads(json.dumps(report))
+    slower["stages"]["detect"]["p50_ms"] = stages["detect"]["p50_ms"] * 2
+    rows, regressions = benchmark.compare(report, slower, threshold=10)
+    assert regressions == ["detect"]
+    assert dict((name, change) for name, _, _, change in rows)["detect"] == 100.0
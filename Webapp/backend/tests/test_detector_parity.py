@@ -0,0 +1,80 @@
+import sys
+import os
+import glob
+
+import numpy as np
+import pytest
+
+# Add parent directory to path to allow importing analysis
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEIGHTS = os.path.join(BACKEND_DIR, "models", "yolo_best.pt")
+ONNX_MODELS = [
+    (os.path.join(BACKEND_DIR, "models", "yolo_best.onnx"), 0.9, 0.05),
+    (os.path.join(BACKEND_DIR, "models", "yolo_best_int8.onnx"), 0.8, 0.1),
+]
+
+pytest.importorskip("onnxruntime")
+if not os.path.exists(WEIGHTS):
+    pytest.skip("models/yolo_best.pt not available", allow_module_level=True)
+
+
+def plate_images(limit=5):
+    import cv2
+
+    paths = sorted(
+        p for p in glob.glob(os.path.join(BACKEND_DIR, "uploaded_images", "*.jp*g"))
+        if not os.path.basename(p).startswith("detection_result_")
+    )
+    return [img for img in (cv2.imread(p) for p in paths[:limit]) if img is not None]
+
+
+def detections(model, img):
+    result = model(img, conf=0.1, verbose=False)[0]
+    boxes = result.boxes
+    return (
+        boxes.cls.cpu().numpy().astype(int),
+        boxes.xyxy.cpu().numpy(),
+        boxes.conf.cpu().numpy(),
+    )
+
+
+def iou(a, b):
+    x1, y1 = np.maximum(a[:2], b[:2])
+    x2, y2 = np.minimum(a[2:], b[2:])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+@pytest.mark.parametrize("onnx_path,min_iou,max_conf_diff", ONNX_MODELS)
+def test_onnx_detections_match_torch(onnx_path, min_iou, max_conf_diff):
+    from ultralytics import YOLO
+
+    if not os.path.exists(onnx_path):
+        pytest.skip(f"{os.path.basename(onnx_path)} not exported (run export_onnx.py)")
+    images = plate_images()
+    if not images:
+        pytest.skip("no plate images in uploaded_images")
+
+    reference, candidate = YOLO(WEIGHTS), YOLO(onnx_path, task="detect")
+    matched = total = 0
+    for img in images:
+        ref_cls, ref_boxes, ref_conf = detections(reference, img)
+        cand_cls, cand_boxes, cand_conf = detections(candidate, img)
+        # Detections near the confidence threshold may legitimately flip; compare the clear ones
+        for cls, box, conf in zip(ref_cls, ref_boxes, ref_conf):
+            if conf < 0.25:
+                continue
+            total += 1
+            same_class = np.flatnonzero(cand_cls == cls)
+            if same_class.size == 0:
+                continue
+            ious = np.array([iou(box, cand_boxes[j]) for j in same_class])
+            best = same_class[ious.argmax()]
+            if ious.max() >= min_iou and abs(cand_conf[best] - conf) <= max_conf_diff:
+                matched += 1
+
+    assert total > 0
+    assert matched / total >= 0.95
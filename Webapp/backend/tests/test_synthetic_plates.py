@@ -0,0 +1,65 @@
+import json
+import sys
+import os
+
+import cv2
+import numpy as np
+
+# Add parent directory to path to allow importing synthetic_plates
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic_plates
+
+
+def test_rendered_plate_matches_ground_truth():
+    img, truth = synthetic_plates.render_plate(7, size=1200, disks=8, noise=2.0)
+    again, _ = synthetic_plates.render_plate(7, size=1200, disks=8, noise=2.0)
+    assert np.array_equal(img, again)
+    assert img.shape == (1200, 1200, 3) and len(truth["disks"]) == 8
+
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    px_per_mm = truth["px_per_mm"]
+    for disk in truth["disks"]:
+        x1, y1, x2, y2 = disk["zone_bbox"]
+        assert abs((x2 - x1) - disk["zone_diameter_mm"] * px_per_mm) < 0.05
+        cx, cy = (int(round(v)) for v in disk["center"])
+        # Paper disk: bright and unsaturated next to the printed code (sample off-centre on both sides)
+        r = int(disk["disk_diameter_mm"] / 2 * px_per_mm * 0.8)
+        paper = [hsv[cy, cx + dx] for dx in (-r, r)]
+        assert any(s < 60 and v > 150 for _, s, v in paper)
+        # Zone (when wider than the disk) is darker than the lawn just outside it
+        if disk["zone_diameter_mm"] > disk["disk_diameter_mm"] + 4:
+            mid = (disk["zone_diameter_mm"] + disk["disk_diameter_mm"]) / 4 * px_per_mm
+            outside = disk["zone_diameter_mm"] / 2 * px_per_mm + 1.5 * px_per_mm
+            angles = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+            sample = lambda radius: np.median([
+                hsv[int(cy + radius * np.sin(a)), int(cx + radius * np.cos(a)), 2] for a in angles
+            ])
+            assert sample(mid) < sample(outside) - 15
+
+    perfect = [
+        {"medicine_name": d["code"], "diameter_mm": d["zone_diameter_mm"], "bbox": d["zone_bbox"], "disk_bbox": d["disk_bbox"]}
+        for d in truth["disks"]
+    ]
+    score = synthetic_plates.evaluate(perfect[:-1] + [{"medicine_name": "X", "bbox": [0, 0, 5, 5]}], truth)
+    assert score["matched"] == 7 and score["missed"] == 1 and score["extra"] == 1
+    assert score["diameter_mae_mm"] == 0.0 and score["code_accuracy"] == 7 / 8
+    assert {d["disk_diameter_mm"] for d in truth["disks"]} == {synthetic_plates.zone_profile.DISK_DIAMETER_MM}
+
+    # Plates with other disks: the analysis reads every disk as 6.35 mm, and so does the score
+    _, small = synthetic_plates.render_plate(7, size=600, disks=3, disk_mm=6.0)
+    calibrated = [
+        {"diameter_mm": d["zone_diameter_mm"] * 6.35 / 6.0, "bbox": d["zone_bbox"], "disk_bbox": d["disk_bbox"]}
+        for d in small["disks"]
+    ]
+    assert synthetic_plates.evaluate(calibrated, small)["diameter_mae_mm"] == 0.0
+
+
+def test_generate_writes_images_and_manifest(tmp_path):
+    truths = synthetic_plates.generate(str(tmp_path), 2, seed=3, size=600, disks=4, rotation=0)
+    assert sorted(os.listdir(tmp_path)) == [
+        "manifest.jsonl", "plate_0000.jpg", "plate_0000.json", "plate_0001.jpg", "plate_0001.json",
+    ]
+    assert json.loads((tmp_path / "plate_0001.json").read_text()) == json.loads(json.dumps(truths[1]))
+    assert cv2.imread(str(tmp_path / "plate_0000.jpg")).shape == (600, 600, 3)
+    assert [json.loads(line)["seed"] for line in (tmp_path / "manifest.jsonl").read_text().splitlines()] == [3, 4]
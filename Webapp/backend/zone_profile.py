@@ -0,0 +1,170 @@
+import cv2
+import numpy as np
+
+# Standard 1/4" susceptibility disk
+DISK_DIAMETER_MM = 6.35
+# Lawn minus zone grey level below which no zone is visible
+MIN_CONTRAST = 12.0
+
+# ==========================================
+# Radial profiles
+# ==========================================
+
+
+def disk_circle(bbox):
+    """(cx, cy, radius_px) of a disk from its [x1, y1, x2, y2] box."""
+    x1, y1, x2, y2 = bbox
+    return (x1 + x2) / 2, (y1 + y2) / 2, ((x2 - x1) + (y2 - y1)) / 4
+
+
+def polar_profiles(image, disks, rays=72, samples=256, reach=8.0):
+    """
+    Radial intensity profiles around each disk, stacked into one
+    (len(disks), rays, samples) float32 array.
+
+    disks are (cx, cy, radius_px). Each disk is unwrapped with cv2.warpPolar
+    out to reach disk radii, so sample j lies j * reach / samples disk radii
+    from the centre for every disk, whatever its size in pixels. Row i is the
+    ray at i * 360 / rays degrees. Samples outside the image are NaN.
+    """
+    disks = np.asarray(disks, dtype=np.float64).reshape(-1, 3)
+    profiles = np.empty((len(disks), rays, samples), np.float32)
+    for k, (cx, cy, radius) in enumerate(disks):
+        polar = cv2.warpPolar(
+            image, (samples, rays), (float(cx), float(cy)), float(radius * reach),
+            cv2.WARP_POLAR_LINEAR | cv2.INTER_LINEAR | cv2.WARP_FILL_OUTLIERS,
+        )
+        # Colour plates are converted after unwrapping: rays x samples pixels, not the whole photo
+        profiles[k] = cv2.cvtColor(polar, cv2.COLOR_BGR2GRAY) if polar.ndim == 3 else polar
+
+    h, w = image.shape[:2]
+    theta = np.arange(rays) * (2 * np.pi / rays)
+    rho = (disks[:, 2] * reach / samples)[:, None, None] * np.arange(samples)
+    xs = disks[:, 0, None, None] + rho * np.cos(theta)[None, :, None]
+    ys = disks[:, 1, None, None] + rho * np.sin(theta)[None, :, None]
+    profiles[(xs < 0) | (ys < 0) | (xs > w - 1) | (ys > h - 1)] = np.nan
+    return profiles
+
+
+def refine_disk_radii(image, disks, rays=72, samples=64):
+    """
+    Disk radii re-measured at each disk's rim: the median over rays of the
+    steepest fall in brightness between 0.7 and 1.4 times the given radius
+    (white paper against the agar). Sharper than a Hough radius, which sets
+    the mm scale of every zone on the disk.
+    """
+    disks = np.asarray(disks, dtype=np.float64).reshape(-1, 3)
+    if len(disks) == 0:
+        return disks[:, 2]
+    reach = 1.6
+    profiles = polar_profiles(image, disks, rays, samples, reach)
+    grad = np.gradient(np.nan_to_num(profiles, nan=np.inf), axis=-1)
+    lo, hi = int(samples * 0.7 / reach), int(samples * 1.4 / reach)
+    window = grad[:, :, lo:hi]
+    window[~np.isfinite(window)] = 0
+    rim = (lo + window.argmin(-1)) * (reach / samples)
+    return disks[:, 2] * np.median(rim, axis=1)
+
+
+# ==========================================
+# Zone edges
+# ==========================================
+
+
+def _fill_tails(flat, valid):
+    """Repeat the last valid sample of each row over the NaN run after it (rays leaving the image)."""
+    idx = np.where(valid, np.arange(flat.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    return np.take_along_axis(flat, idx, axis=1)
+
+
+def find_zone_edges(profiles, start, smooth=2.0, min_contrast=MIN_CONTRAST, window=4):
+    """
+    Zone edge of every ray, in samples: (edges (n, rays) with NaN where a ray
+    has none, contrast (n,)).
+
+    The zone is the dark (clear) ring between the disk and the bright lawn.
+    Per disk, the zone level is the median of the first samples past start and
+    the lawn level the 90th percentile beyond it; a ray's edge is where its
+    smoothed profile first climbs back over the midpoint after dipping under
+    it, moved to the steepest gradient within window samples and refined to a
+    sub-sample position with a parabola through the gradient peak. Disks whose
+    lawn is not min_contrast grey levels above the zone get no edges.
+    """
+    n, rays, samples = profiles.shape
+    flat = profiles.reshape(n * rays, samples)
+    valid = ~np.isnan(flat)
+    ksize = 2 * int(3 * smooth) + 1
+    # Smoothed along each ray only (a 1-pixel-high kernel): rays stay independent
+    smoothed = cv2.GaussianBlur(_fill_tails(np.nan_to_num(flat), valid), (ksize, 1), smooth)
+    p = smoothed.reshape(n, rays, samples)
+    valid = valid.reshape(n, rays, samples)
+
+    band = max(2, samples // 32)
+    masked = np.where(valid, p, np.nan)
+    with np.errstate(all="ignore"):
+        zone = np.nanmedian(masked[:, :, start:start + band].reshape(n, -1), axis=1)
+        lawn = np.nanpercentile(masked[:, :, start:].reshape(n, -1), 90, axis=1)
+    contrast = np.nan_to_num(lawn - zone)
+    threshold = ((zone + lawn) / 2)[:, None, None]
+
+    idx = np.arange(samples)
+    searched = valid & (idx >= start)
+    below = searched & (p < threshold)
+    first_below = np.where(below.any(-1), below.argmax(-1), samples)
+    above = searched & (p >= threshold) & (idx > first_below[..., None])
+    found = above.any(-1) & (contrast >= min_contrast)[:, None]
+    crossing = above.argmax(-1)
+
+    grad = np.gradient(p, axis=-1)
+    candidates = np.clip(crossing[..., None] + np.arange(-window, window + 1), start, samples - 2)
+    peak = np.take_along_axis(
+        candidates, np.take_along_axis(grad, candidates, -1).argmax(-1)[..., None], -1
+    )[..., 0]
+    g0 = np.take_along_axis(grad, peak[..., None], -1)[..., 0]
+    gm = np.take_along_axis(grad, np.maximum(peak - 1, 0)[..., None], -1)[..., 0]
+    gp = np.take_along_axis(grad, (peak + 1)[..., None], -1)[..., 0]
+    curvature = gm - 2 * g0 + gp
+    with np.errstate(all="ignore"):
+        offset = np.where(curvature < 0, 0.5 * (gm - gp) / curvature, 0.0)
+    edges = peak + np.clip(offset, -0.5, 0.5)
+
+    found &= (g0 > 0) & np.take_along_axis(valid, peak[..., None], -1)[..., 0]
+    return np.where(found, edges, np.nan), contrast
+
+
+def measure_zones(image, disks, disk_mm=DISK_DIAMETER_MM, rays=72, samples=256, reach=8.0, min_contrast=MIN_CONTRAST):
+    """
+    Inhibition zone diameter around each disk from its radial profiles.
+
+    image is the plate (BGR or grey) and disks (cx, cy, radius_px) in its
+    pixels; the disk's own size sets the mm scale. All rays of all disks are
+    unwrapped and searched as one array. Returns one dict per disk:
+    diameter_mm (median over rays; disk_mm when no zone is visible),
+    spread_mm (interquartile range of the per-ray diameters, a quality signal:
+    round, clean zones spread well under 1 mm), coverage (fraction of rays with
+    an edge) and contrast (lawn minus zone grey level).
+    """
+    if len(disks) == 0:
+        return []
+    profiles = polar_profiles(image, disks, rays, samples, reach)
+    # Skip the disk rim: its bright edge and shadow are not the zone
+    start = int(np.ceil(samples * 1.15 / reach))
+    edges, contrast = find_zone_edges(profiles, start, min_contrast=min_contrast)
+
+    diameters = edges * (reach * disk_mm / samples)
+    coverage = np.mean(~np.isnan(diameters), axis=1)
+    measured = []
+    for k in range(len(diameters)):
+        ray_mm = diameters[k][~np.isnan(diameters[k])]
+        if ray_mm.size == 0:
+            measured.append({"diameter_mm": disk_mm, "spread_mm": 0.0, "coverage": 0.0, "contrast": round(float(contrast[k]), 1)})
+            continue
+        q25, q50, q75 = np.percentile(ray_mm, [25, 50, 75])
+        measured.append({
+            "diameter_mm": round(float(max(q50, disk_mm)), 2),
+            "spread_mm": round(float(q75 - q25), 2),
+            "coverage": round(float(coverage[k]), 3),
+            "contrast": round(float(contrast[k]), 1),
+        })
+    return measured